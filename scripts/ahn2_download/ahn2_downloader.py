@@ -5,124 +5,517 @@ Python3
 Chris Lucas
 """
 
-from io import BytesIO
 import sys
 import os
+import zlib
+import json
 import zipfile
+import time
+import threading
 import argparse
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import requests
-import xml.etree.ElementTree as etree
+from requests.adapters import HTTPAdapter
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'common'))
+import las_io
+import metrics
+from ahn2_feed import AtomFeed, DEFAULT_CACHE_DIR
+from remote_zip import (open_remote_zip, HTTPRangeFile, SpooledDownload,
+                        BUFFER_SIZE)
 
+FEED_URLS = {'u': 'http://geodata.nationaalgeoregister.nl/ahn2/'
+                  'atom/ahn2_uitgefilterd.xml',
+             'g': 'http://geodata.nationaalgeoregister.nl/ahn2/'
+                  'atom/ahn2_gefilterd.xml'}
+MANIFEST_FILE = '.ahn2_manifest.json'
 
-def request_data(root, tile_id, output_folder, verbose=False):
-    namespaces = {"xmlns": "http://www.w3.org/2005/Atom",
-                  "xmlns:georss": "http://www.georss.org/georss"}
+_manifest_lock = threading.Lock()
 
-    tile = root.find('xmlns:entry[xmlns:id="{}.laz.zip"]'.format(tile_id),
-                     namespaces=namespaces)
 
-    if tile is None:
+def create_session(pool_size=10):
+    """
+    Create a requests session with a keep-alive connection pool large
+    enough to serve `pool_size` concurrent downloads.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def request_feeds(session=None, cache_dir=DEFAULT_CACHE_DIR,
+                  feed_urls=None):
+    """
+    Load the uitgefilterd ('u') and gefilterd ('g') atom feeds, using the
+    cached feed indices if the feeds did not change.
+
+    Parameters
+    ----------
+    feed_urls : dict
+        The urls of the feeds by prefix. (default: None, FEED_URLS)
+
+    Returns
+    -------
+    feeds : dict
+        The loaded feeds by prefix.
+    """
+    feeds = {}
+    for prefix, url in (feed_urls or FEED_URLS).items():
+        with metrics.stage('feed_fetch', feed=prefix):
+            feeds[prefix] = AtomFeed(url, cache_dir, session)
+            feeds[prefix].load()
+    return feeds
+
+
+def print_progress(dl, total_length):
+    """
+    Print a progress bar of a download to stdout.
+    """
+    if total_length:
+        done = min(int(100 * dl / total_length), 100)
+        sys.stdout.write("\r[{}{}] - {}% {:0.1f}/{:0.1f} mb".format(
+            '=' * done, ' ' * (100 - done), done,
+            dl/1048576, total_length/1048576))
+    else:
+        sys.stdout.write("\r {:0.1f} mb downloaded..".format(dl/1048576))
+    sys.stdout.flush()
+
+
+def file_crc(filename):
+    """
+    Compute the CRC-32 of a file, as stored in zip archives.
+    """
+    crc = 0
+    with open(filename, 'rb') as f:
+        for data in iter(lambda: f.read(BUFFER_SIZE), b''):
+            crc = zlib.crc32(data, crc)
+    return crc & 0xffffffff
+
+
+def read_manifest(output_folder):
+    manifest_file = os.path.join(output_folder, MANIFEST_FILE)
+    if not os.path.isfile(manifest_file):
+        return {}
+    try:
+        with open(manifest_file) as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def update_manifest(output_folder, tile_id, files):
+    """
+    Record the size, CRC-32 and modification time of the files extracted
+    for a tile in the manifest of the output folder.
+    """
+    with _manifest_lock:
+        manifest = read_manifest(output_folder)
+        manifest[tile_id] = files
+        manifest_file = os.path.join(output_folder, MANIFEST_FILE)
+        tmp_file = '{}.{}.tmp'.format(manifest_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_file, manifest_file)
+
+
+def is_complete(output_folder, tile_id):
+    """
+    Check whether the files of a tile were already downloaded and verified.
+    Files whose size and modification time match the manifest are trusted,
+    other files are verified against the recorded CRC-32.
+    """
+    files = read_manifest(output_folder).get(tile_id)
+    if not files:
         return False
 
-    url = tile.find('xmlns:link', namespaces=namespaces).attrib['href']
+    for name, info in files.items():
+        filename = os.path.join(output_folder, name)
+        if (not os.path.isfile(filename) or
+                os.path.getsize(filename) != info['size']):
+            return False
+        if (os.path.getmtime(filename) != info['mtime'] and
+                file_crc(filename) != info['crc']):
+            return False
+    return True
 
-    zip_file = '{}{}.laz.zip'.format(output_folder, tile_id)
-    with open(zip_file, 'wb') as f:
-        if not verbose:
-            zipped_data = requests.get(url)
-            f.write(zipped_data.content)
-        else:
-            zipped_data = requests.get(url, stream=True, timeout=10)
-            total_length = zipped_data.headers.get('content-length')
-            if total_length is not None:
-                total_length = int(total_length)
-            else:
-                size = tile.find('xmlns:content', namespaces=namespaces).text
-                size = float(size.split(':')[1].split(
-                    ' ')[1].replace(',', '.'))
-                total_length = int(size * 1048576)
-
-            dl = 0
-            chunk = total_length//100 if total_length is not None else 1048576
-            for data in zipped_data.iter_content(chunk_size=chunk):
-                f.write(data)
-                dl += len(data)
-
-                if total_length is not None:
-                    done = int(100 * dl / total_length)
-                    sys.stdout.write("\r[{}{}] - {}% {}/{} mb".format('=' * done,
-                                                                      ' ' *
-                                                                      (100 - done),
-                                                                      done,
-                                                                      dl/1048576,
-                                                                      total_length/1048576))
-                    sys.stdout.flush()
-                elif verbose:
-                    sys.stdout.write(
-                        "\r {:0.1f} mb downloaded..".format(dl/1048576))
-                    sys.stdout.flush()
 
-            if verbose:
+def member_path(output_folder, name):
+    """
+    The output path of an archive member. Raises ValueError for absolute
+    names and names containing '..', which would be written outside the
+    output folder.
+    """
+    parts = name.replace('\\', '/').split('/')
+    if (os.path.isabs(name) or os.path.splitdrive(name)[0] or
+            name.startswith(('/', '\\')) or '..' in parts):
+        raise ValueError("Unsafe file name in the archive: {}".format(name))
+    return os.path.join(output_folder, *[p for p in parts if p])
+
+
+def extract_archive(fileobj, source, output_folder, tile_id, verbose=False):
+    """
+    Extract the members of a downloaded (or downloading) zip archive to the
+    output folder, and close it.
+
+    Returns
+    -------
+    files : dict
+        The size, CRC-32 and modification time of each extracted file, by
+        name.
+    """
+    files = {}
+    try:
+        with zipfile.ZipFile(fileobj) as data, \
+                metrics.stage('unzip', tile=tile_id) as record:
+            total_length = sum(i.compress_size for i in data.infolist())
+            if verbose and isinstance(source, SpooledDownload):
                 sys.stdout.write("\n")
+                print("Download complete, unzipping..")
 
-    if verbose:
-        print("Download complete, unzipping..")
-    with zipfile.ZipFile(zip_file) as data:
-        data.extractall(output_folder)
-    os.remove(zip_file)
+            for info in data.infolist():
+                if info.is_dir():
+                    continue
+                filename = member_path(output_folder, info.filename)
+                os.makedirs(os.path.dirname(filename), exist_ok=True)
+                part_file = filename + '.part'
+                with data.open(info) as src, open(part_file, 'wb') as dst:
+                    for chunk in iter(lambda: src.read(BUFFER_SIZE), b''):
+                        dst.write(chunk)
+                        if verbose and isinstance(source, HTTPRangeFile):
+                            print_progress(source.bytes_read, total_length)
+                os.replace(part_file, filename)
+                files[info.filename] = {'size': info.file_size,
+                                        'crc': info.CRC,
+                                        'mtime': os.path.getmtime(filename)}
+            record['bytes'] = sum(f['size'] for f in files.values())
+            record['downloaded'] = source.bytes_read
+    finally:
+        fileobj.close()
+        source.close()
+    return files
 
-    return True
 
+def request_data(feed, tile_id, output_folder, verbose=False, session=None):
+    """
+    Download and unzip a single LAZ archive listed in an atom feed.
+
+    If the server supports range requests the archive members are
+    extracted while they are downloaded, without writing the archive to
+    disk, and interrupted transfers are resumed with a range request.
+    Otherwise the archive is spooled to a temporary file first. Tiles that
+    were already downloaded and verified are skipped.
 
-def request_tile(tile_id, output_folder, verbose=False):
-    # uitgefilterd
-    if verbose:
-        print("Downloading filtered out AHN 2 data..")
+    Returns
+    -------
+    downloaded : int or None
+        The number of bytes downloaded, or None if the tile is not
+        listed in the feed.
+    """
+    session = session or requests
 
-    r = requests.get('http://geodata.nationaalgeoregister.nl/ahn2/'
-                     'atom/ahn2_uitgefilterd.xml')
-    root = etree.fromstring(r.content)
-    success = request_data(root, 'u{}'.format(tile_id), output_folder, verbose)
+    tile = feed.lookup(tile_id)
 
-    if verbose:
-        if success:
-            print("Complete.")
-        else:
+    if tile is None:
+        return None
+
+    if is_complete(output_folder, tile_id):
+        if verbose:
+            print("Already downloaded, skipping.")
+        return 0
+
+    url = tile[0]
+    callback = print_progress if verbose else None
+
+    with metrics.stage('download', tile=tile_id) as record:
+        fileobj, source = open_remote_zip(url, session,
+                                          spool_dir=output_folder,
+                                          callback=callback)
+        # with range requests the archive is downloaded while unzipping,
+        # so the download includes the unzipping
+        record['streamed'] = streamed = isinstance(source, HTTPRangeFile)
+        if streamed:
+            files = extract_archive(fileobj, source, output_folder, tile_id,
+                                    verbose)
+        record['bytes'] = source.bytes_read
+    if not streamed:
+        files = extract_archive(fileobj, source, output_folder, tile_id,
+                                verbose)
+
+    if verbose and isinstance(source, HTTPRangeFile):
+        sys.stdout.write("\n")
+
+    update_manifest(output_folder, tile_id, files)
+
+    return source.bytes_read
+
+
+def request_tile(tile_id, output_folder, verbose=False, session=None,
+                 feeds=None):
+    """
+    Download the uitgefilterd and gefilterd data of a tile.
+
+    Parameters
+    ----------
+    tile_id : str
+        The id of the tile to download.
+    output_folder : str
+        The folder to write the data to, ending with a '/'.
+    verbose : bool
+        Print out the progress.
+    session : requests.Session
+        The session to download with. (default: None, no shared session)
+    feeds : dict
+        Already loaded atom feeds as returned by `request_feeds`.
+        (default: None, the feeds are loaded)
+
+    Returns
+    -------
+    downloaded : int
+        The total number of bytes downloaded.
+    found : bool
+        Whether the tile was found in at least one of the feeds.
+    """
+    if feeds is None:
+        feeds = request_feeds(session)
+
+    downloaded = 0
+    found = False
+    for prefix, name in (('u', 'filtered out'), ('g', 'filtered')):
+        if verbose:
+            print("Downloading {} AHN 2 data..".format(name))
+
+        dl = request_data(feeds[prefix], '{}{}'.format(prefix, tile_id),
+                          output_folder, verbose, session)
+
+        if dl is not None:
+            downloaded += dl
+            found = True
+            if verbose:
+                print("Download complete.")
+        elif verbose:
             print("Download failed. Tile not found.")
 
-    # gefilterd
-    if verbose:
-        print("Downloading filtered AHN 2 data..")
+    return downloaded, found
+
+
+def merged_file(tile_id, output_folder, merge_mode='native'):
+    """
+    The path of the merged file of a tile.
+    """
+    ext = las_io.MANIFEST_EXT if merge_mode == 'virtual' else '.laz'
+    return '{}{}{}'.format(output_folder, tile_id, ext)
+
+
+def merge_tile(tile_id, output_folder, verbose=False, merge_mode='native'):
+    """
+    Merge the filtered and remaining data of a tile.
 
-    r = requests.get('http://geodata.nationaalgeoregister.nl/ahn2/'
-                     'atom/ahn2_gefilterd.xml')
-    root = etree.fromstring(r.content)
-    success = request_data(root, 'g{}'.format(tile_id), output_folder, verbose)
+    Parameters
+    ----------
+    tile_id : str
+        The id of the tile to merge.
+    output_folder : str
+        The folder containing the data, ending with a '/'.
+    verbose : bool
+        Print out the progress.
+    merge_mode : str
+        'native' streams both files into one LAZ file in-process, 'pdal'
+        uses `pdal merge` and 'virtual' writes a virtual dataset (.lasvrt)
+        referencing both files without recompressing them. With 'native'
+        and 'pdal' the original files are removed if the merge succeeded.
 
+    Returns
+    -------
+    success : bool
+        Whether the merged file was created.
+    """
     if verbose:
-        if success:
-            print("Download complete.")
+        print("Merging point clouds..")
+
+    inputs = ['{}g{}.laz'.format(output_folder, tile_id),
+              '{}u{}.laz'.format(output_folder, tile_id)]
+    inputs = [f for f in inputs if os.path.isfile(f)]
+    if not inputs:
+        if verbose:
+            print("Merging failed. No files of the tile found.")
+        return False
+    output_file = merged_file(tile_id, output_folder, merge_mode)
+
+    with metrics.stage('merge', tile=tile_id, mode=merge_mode,
+                       bytes=sum(os.path.getsize(f) for f in inputs)):
+        if merge_mode == 'virtual':
+            las_io.write_manifest(inputs, output_file)
+        elif merge_mode == 'native':
+            tmp_file = '{}{}.part.laz'.format(output_folder, tile_id)
+            las_io.merge_las(inputs, tmp_file)
+            os.replace(tmp_file, output_file)
         else:
-            print("Download failed. Tile not found.")
+            subprocess.call(['pdal', 'merge'] + inputs + [output_file])
+
+    if merge_mode == 'virtual':
+        if verbose:
+            print("Done!")
+        return True
+
+    if os.path.isfile(output_file):
+        if verbose:
+            print("Done, removing old files..")
+
+        for f in inputs:
+            os.remove(f)
+
+        if verbose:
+            print("Done!")
+        return True
+    elif verbose:
+        print("Merging failed. File not found. Keeping original files.")
+    return False
+
+
+def read_tile_ids(tile_ids=None, tile_file=None):
+    """
+    Combine the tile ids given on the command line and in a tile file
+    (one id per line, lines starting with '#' are ignored) into a list
+    without duplicates.
+    """
+    ids = list(tile_ids or [])
+    if tile_file is not None:
+        with open(tile_file) as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if line:
+                    ids.append(line)
+
+    seen = set()
+    return [i for i in ids if not (i in seen or seen.add(i))]
+
+
+def request_tiles(tile_ids, output_folder, merge=False, jobs=4,
+                  verbose=False, feed_cache=DEFAULT_CACHE_DIR,
+                  merge_mode='native', feed_urls=None):
+    """
+    Download (and optionally merge) multiple tiles concurrently using a
+    bounded pool of workers sharing one keep-alive connection pool. A
+    failing tile does not stop the other downloads.
+
+    Parameters
+    ----------
+    tile_ids : list of str
+        The ids of the tiles to download.
+    output_folder : str
+        The folder to write the data to, ending with a '/'.
+    merge : bool
+        Merge the filtered and remaining data of each tile.
+    jobs : int
+        The maximum number of tiles to download at the same time.
+    verbose : bool
+        Print out the progress.
+    feed_cache : str
+        The folder to cache the atom feeds in, None to disable caching.
+    merge_mode : str
+        How to merge the data, see `merge_tile`.
+    feed_urls : dict
+        The urls of the atom feeds by prefix. (default: None, FEED_URLS)
+
+    Returns
+    -------
+    failed : dict
+        The error message by tile id of the tiles that failed.
+    """
+    jobs = max(1, min(jobs, len(tile_ids)))
+    session = create_session(pool_size=2*jobs)
+
+    start = time.time()
+    feeds = request_feeds(session, feed_cache, feed_urls)
+
+    def process(tile_id):
+        if merge and os.path.isfile(merged_file(tile_id, output_folder,
+                                                merge_mode)):
+            return 0
+        downloaded, found = request_tile(tile_id, output_folder,
+                                         session=session, feeds=feeds)
+        if not found:
+            raise ValueError("Tile not found.")
+        if merge and not merge_tile(tile_id, output_folder,
+                                    merge_mode=merge_mode):
+            raise RuntimeError("Merging failed.")
+        return downloaded
+
+    total_bytes = 0
+    failed = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(process, t): t for t in tile_ids}
+        for i, future in enumerate(as_completed(futures)):
+            tile_id = futures[future]
+            try:
+                total_bytes += future.result()
+                status = 'done'
+            except Exception as e:
+                failed[tile_id] = str(e)
+                status = 'failed ({})'.format(e)
+            if verbose:
+                print("[{}/{}] {} {}".format(i+1, len(tile_ids),
+                                             tile_id, status))
+
+    elapsed = max(time.time() - start, 1e-9)
+    succeeded = len(tile_ids) - len(failed)
+    print("Downloaded {} of {} tiles, {:.1f} mb in {:.1f} s "
+          "({:.2f} mb/s, {:.1f} tiles/min)".format(
+              succeeded, len(tile_ids), total_bytes/1048576, elapsed,
+              total_bytes/1048576/elapsed, succeeded*60/elapsed))
+    if failed:
+        print("Failed tiles: {}".format(', '.join(sorted(failed))))
+
+    return failed
 
 
 def argument_parser():
     """
     Define and return the arguments.
     """
-    description = "Download an AHN2 data tile by tile id."
+    description = "Download AHN2 data tiles by tile id."
     parser = argparse.ArgumentParser(description=description)
     required_named = parser.add_argument_group('required named arguments')
-    required_named.add_argument('-t', '--tileid',
-                                help='The ID of the tile to download.',
-                                required=True)
+    tiles = required_named.add_mutually_exclusive_group(required=True)
+    tiles.add_argument('-t', '--tileid',
+                       help='The ID(s) of the tile(s) to download.',
+                       nargs='+')
+    tiles.add_argument('-f', '--tilefile',
+                       help='A file with the IDs of the tiles to download, '
+                            'one per line.')
     required_named.add_argument('-o', '--output',
                                 help='The folder to write the data to.',
                                 required=True)
     parser.add_argument('-m', '--merge',
-                        help='Merge the filtered and remaining data. '
-                             'Requires PDAL.',
+                        help='Merge the filtered and remaining data.',
+                        action='store_true',
+                        required=False,
+                        default=False)
+    parser.add_argument('--merge_mode',
+                        help='How to merge the data: native (in-process), '
+                             'pdal (requires PDAL) or virtual (a .lasvrt '
+                             'dataset referencing both files). '
+                             '(default: native)',
+                        choices=['native', 'pdal', 'virtual'],
+                        required=False,
+                        default='native')
+    parser.add_argument('-j', '--jobs',
+                        help='The number of tiles to download concurrently '
+                             'when downloading multiple tiles. (default: 4)',
+                        type=int,
+                        required=False,
+                        default=4)
+    parser.add_argument('-c', '--feed_cache',
+                        help='The folder to cache the AHN2 atom feeds in. '
+                             '(default: ~/.cache/ahn2)',
+                        required=False,
+                        default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--no_feed_cache',
+                        help='Disable the atom feed cache.',
                         action='store_true',
                         required=False,
                         default=False)
@@ -131,6 +524,7 @@ def argument_parser():
                         action='store_true',
                         required=False,
                         default=False)
+    metrics.add_arguments(parser)
 
     args = parser.parse_args()
     return args
@@ -140,28 +534,23 @@ def main():
     args = argument_parser()
     args.output.replace('\\', '/')
     args.output = args.output + '/' if args.output[-1] != '/' else args.output
-    request_tile(args.tileid, args.output, args.verbose)
-    if args.merge:
-        if args.verbose:
-            print("Merging point clouds..")
-
-        output_file = '{}{}.laz'.format(args.output, args.tileid)
-        subprocess.call(['pdal', 'merge',
-                         '{}g{}.laz'.format(args.output, args.tileid),
-                         '{}u{}.laz'.format(args.output, args.tileid),
-                         output_file])
-
-        if os.path.isfile(output_file):
-            if args.verbose:
-                print("Done, removing old files..")
-
-            os.remove('{}g{}.laz'.format(args.output, args.tileid))
-            os.remove('{}u{}.laz'.format(args.output, args.tileid))
-
-            if args.verbose:
-                print("Done!")
-        elif args.verbose:
-            print("Merging failed. File not found. Keeping original files.")
+    tile_ids = read_tile_ids(args.tileid, args.tilefile)
+    feed_cache = None if args.no_feed_cache else args.feed_cache
+
+    with metrics.from_args(args):
+        if len(tile_ids) == 1:
+            downloaded, found = request_tile(
+                tile_ids[0], args.output, args.verbose,
+                feeds=request_feeds(cache_dir=feed_cache))
+            if args.merge and found:
+                merge_tile(tile_ids[0], args.output, args.verbose,
+                           args.merge_mode)
+        else:
+            failed = request_tiles(tile_ids, args.output, args.merge,
+                                   args.jobs, args.verbose, feed_cache,
+                                   args.merge_mode)
+            if failed:
+                sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+Chris Lucas
+"""
+
+from io import BytesIO
+import os
+import json
+import hashlib
+import requests
+import xml.etree.ElementTree as etree
+
+ATOM_NS = '{http://www.w3.org/2005/Atom}'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ahn2')
+
+
+def parse_size(content):
+    """
+    Parse the size of a download in bytes from the content text of a feed
+    entry (e.g. 'Bestandsgrootte: 123,4 MB').
+    """
+    try:
+        size = float(content.split(':')[1].split(' ')[1].replace(',', '.'))
+    except (AttributeError, IndexError, ValueError):
+        return None
+    return int(size * 1048576)
+
+
+def build_index(data):
+    """
+    Build a tile id to (url, size) index from the raw XML of an atom feed.
+
+    Parameters
+    ----------
+    data : bytes
+        The atom feed.
+
+    Returns
+    -------
+    index : dict
+        The url and size in bytes (or None if unknown) of each entry, by
+        the entry id without the '.laz.zip' extension (e.g. 'g25bz2').
+    """
+    index = {}
+    for _, elem in etree.iterparse(BytesIO(data)):
+        if elem.tag != ATOM_NS + 'entry':
+            continue
+
+        entry_id = elem.findtext(ATOM_NS + 'id')
+        link = elem.find(ATOM_NS + 'link')
+        if entry_id is not None and link is not None:
+            if entry_id.endswith('.laz.zip'):
+                entry_id = entry_id[:-len('.laz.zip')]
+            index[entry_id] = (link.attrib['href'],
+                               parse_size(elem.findtext(ATOM_NS + 'content')))
+        elem.clear()
+
+    return index
+
+
+class AtomFeed(object):
+    """
+    An AHN2 atom feed, cached on disk as a tile id index. The cache is
+    revalidated with the ETag/Last-Modified headers of the feed, so an
+    unchanged feed is neither downloaded nor parsed again.
+
+    Parameters
+    ----------
+    url : str
+        The url of the atom feed.
+    cache_dir : str
+        The folder to store the cached index in. Caching is disabled if
+        None. (default: ~/.cache/ahn2)
+    session : requests.Session
+        The session to request the feed with. (default: None)
+    """
+
+    def __init__(self, url, cache_dir=DEFAULT_CACHE_DIR, session=None):
+        self.url = url
+        self.cache_dir = cache_dir
+        self.session = session or requests
+        self.index = None
+
+    @property
+    def cache_file(self):
+        if self.cache_dir is None:
+            return None
+        name = hashlib.sha1(self.url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, '{}.json'.format(name))
+
+    def _read_cache(self):
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return None
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+        except ValueError:
+            return None
+        return cache if cache.get('url') == self.url else None
+
+    def _write_cache(self, cache):
+        if self.cache_file is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_file = '{}.{}.tmp'.format(self.cache_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, self.cache_file)
+
+    def load(self):
+        """
+        Load the index, requesting the feed only if it changed since it
+        was cached. Falls back to the cached index if the feed can not be
+        reached.
+
+        Returns
+        -------
+        modified : bool
+            Whether the feed was downloaded and parsed.
+        """
+        cache = self._read_cache()
+
+        headers = {}
+        if cache is not None:
+            if cache.get('etag'):
+                headers['If-None-Match'] = cache['etag']
+            if cache.get('last_modified'):
+                headers['If-Modified-Since'] = cache['last_modified']
+
+        try:
+            r = self.session.get(self.url, headers=headers)
+            r.raise_for_status()
+        except requests.exceptions.RequestException:
+            if cache is None:
+                raise
+            print("Could not reach {}, using the cached feed.".format(
+                self.url))
+            self.index = cache['index']
+            return False
+
+        if r.status_code == 304 and cache is not None:
+            self.index = cache['index']
+            return False
+
+        self.index = build_index(r.content)
+        self._write_cache({'url': self.url,
+                           'etag': r.headers.get('ETag'),
+                           'last_modified': r.headers.get('Last-Modified'),
+                           'index': self.index})
+        return True
+
+    def lookup(self, tile_id):
+        """
+        Look up the url and size of a tile.
+
+        Parameters
+        ----------
+        tile_id : str
+            The id of the tile including its prefix (e.g. 'g25bz2').
+
+        Returns
+        -------
+        entry : tuple of (str, int) or None
+            The url and size in bytes (None if unknown) of the tile, or
+            None if the tile is not in the feed.
+        """
+        if self.index is None:
+            self.load()
+        entry = self.index.get(tile_id)
+        return tuple(entry) if entry is not None else None
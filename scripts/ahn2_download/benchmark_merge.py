@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+Chris Lucas
+
+Benchmark the native, virtual and PDAL merge of the filtered (g) and
+remaining (u) data of an AHN2 tile.
+"""
+
+import sys
+import os
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+_scripts = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+for _folder in ('common', 'benchmark'):
+    sys.path.append(os.path.join(_scripts, _folder))
+import las_io
+from synthetic import synthetic_tile
+
+# The bounds of a synthetic 1 by 1.25 km tile
+TILE_BOUNDS = [120000, 487000, 121000, 488250]
+
+
+def merge_native(inputs, output):
+    las_io.merge_las(inputs, output)
+
+
+def merge_virtual(inputs, output):
+    las_io.write_manifest(inputs, output)
+
+
+def merge_pdal(inputs, output):
+    subprocess.check_call(['pdal', 'merge'] + inputs + [output])
+
+
+METHODS = {'native': (merge_native, '.laz'),
+           'virtual': (merge_virtual, las_io.MANIFEST_EXT),
+           'pdal': (merge_pdal, '.laz')}
+
+
+def _run(method, inputs, output, queue):
+    start = time.time()
+    METHODS[method][0](inputs, output)
+    elapsed = time.time() - start
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    queue.put((elapsed, peak))
+
+
+def run_benchmark(inputs, methods, folder, repeat=1):
+    """
+    Run each merge method in a separate process and measure the wall time,
+    peak memory and output size.
+
+    Returns
+    -------
+    results : dict
+        The best wall time (s), peak resident memory (mb) and output size
+        (mb) by method.
+    """
+    point_count = sum(las_io.read_bounds(f)[1] for f in inputs)
+    # spawn, the LAZ backend does not survive a fork of a process using it
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for method in methods:
+        output = os.path.join(folder, 'merged_{}{}'.format(
+            method, METHODS[method][1]))
+        times = []
+        peaks = []
+        for _ in range(repeat):
+            if os.path.isfile(output):
+                os.remove(output)
+            queue = ctx.Queue()
+            p = ctx.Process(target=_run,
+                            args=(method, inputs, output, queue))
+            p.start()
+            p.join()
+            if p.exitcode != 0:
+                raise RuntimeError("Merge method {} failed.".format(method))
+            elapsed, peak = queue.get()
+            times.append(elapsed)
+            peaks.append(peak)
+
+        results[method] = {'time': min(times),
+                           'peak_memory': max(peaks) / 1024,
+                           'size': os.path.getsize(output) / 1048576,
+                           'points_per_second': point_count / min(times)}
+    return results
+
+
+def argument_parser():
+    """
+    Define and return the arguments.
+    """
+    description = ("Benchmark merging the filtered and remaining AHN2 data "
+                   "in-process, virtually and with `pdal merge`.")
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-i', '--input',
+                        help='The g and u LAZ files to merge. If not given '
+                             'synthetic files are generated.',
+                        nargs=2,
+                        required=False)
+    parser.add_argument('-n', '--points',
+                        help='The number of points of each synthetic file. '
+                             '(int, default: 5000000)',
+                        type=int,
+                        required=False,
+                        default=5000000)
+    parser.add_argument('-m', '--methods',
+                        help='The merge methods to benchmark. '
+                             '(default: native virtual, and pdal if found)',
+                        nargs='+',
+                        choices=sorted(METHODS),
+                        required=False)
+    parser.add_argument('-r', '--repeat',
+                        help='The number of times to run each method. '
+                             '(int, default: 3)',
+                        type=int,
+                        required=False,
+                        default=3)
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = argument_parser()
+    methods = args.methods
+    if methods is None:
+        methods = ['native', 'virtual']
+        if shutil.which('pdal') is not None:
+            methods.append('pdal')
+
+    folder = tempfile.mkdtemp()
+    try:
+        inputs = args.input
+        if inputs is None:
+            inputs = [os.path.join(folder, 'g_synthetic.laz'),
+                      os.path.join(folder, 'u_synthetic.laz')]
+            area = ((TILE_BOUNDS[2] - TILE_BOUNDS[0]) *
+                    (TILE_BOUNDS[3] - TILE_BOUNDS[1]))
+            for i, f in enumerate(inputs):
+                synthetic_tile(f, TILE_BOUNDS, args.points / area, seed=i)
+
+        results = run_benchmark(inputs, methods, folder, args.repeat)
+    finally:
+        shutil.rmtree(folder)
+
+    print('{:<10}{:>10}{:>14}{:>14}{:>12}'.format(
+        'method', 'time (s)', 'points/s', 'peak mem (mb)', 'size (mb)'))
+    for method, r in results.items():
+        print('{:<10}{:>10.2f}{:>14.0f}{:>14.1f}{:>12.1f}'.format(
+            method, r['time'], r['points_per_second'],
+            r['peak_memory'], r['size']))
+
+
+if __name__ == '__main__':
+    main()
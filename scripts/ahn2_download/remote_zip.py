@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+Chris Lucas
+"""
+
+import io
+import time
+import tempfile
+import requests
+from urllib3.exceptions import HTTPError
+
+BUFFER_SIZE = 1048576
+
+
+class HTTPRangeFile(io.RawIOBase):
+    """
+    A read-only, seekable file over HTTP range requests. Sequential reads
+    are served from a single streaming response; if the connection drops
+    the transfer is resumed from the current position with a new range
+    request.
+
+    Parameters
+    ----------
+    url : str
+        The url of the file.
+    size : int
+        The size of the file in bytes.
+    session : requests.Session
+        The session to request the file with. (default: None)
+    retries : int
+        The number of times to resume an interrupted transfer.
+    timeout : int
+        The timeout of the requests in seconds.
+    """
+
+    def __init__(self, url, size, session=None, retries=5, timeout=10):
+        super(HTTPRangeFile, self).__init__()
+        self.url = url
+        self.size = size
+        self.session = session or requests
+        self.retries = retries
+        self.timeout = timeout
+        self.bytes_read = 0
+        self._pos = 0
+        self._response = None
+        self._response_pos = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence ({})".format(whence))
+        return self._pos
+
+    def _open(self):
+        self._close_response()
+        r = self.session.get(self.url,
+                             headers={'Range': 'bytes={}-'.format(self._pos)},
+                             stream=True, timeout=self.timeout)
+        if r.status_code != 206:
+            r.close()
+            raise IOError("Server did not honour the range request "
+                          "(HTTP {}).".format(r.status_code))
+        self._response = r
+        self._response_pos = self._pos
+
+    def _close_response(self):
+        if self._response is not None:
+            self._response.close()
+        self._response = None
+        self._response_pos = None
+
+    def readinto(self, b):
+        if self._pos >= self.size:
+            return 0
+
+        for i in range(self.retries + 1):
+            try:
+                if self._response is None or self._response_pos != self._pos:
+                    self._open()
+                n = self._response.raw.readinto(b)
+                break
+            except (requests.exceptions.RequestException, HTTPError,
+                    IOError) as e:
+                self._close_response()
+                if i == self.retries:
+                    raise e
+                time.sleep(min(2 ** i, 30))
+
+        if n == 0:
+            self._close_response()
+            raise IOError("Unexpected end of data at byte {} of {}.".format(
+                self._pos, self.size))
+
+        self._pos += n
+        self._response_pos = self._pos
+        self.bytes_read += n
+        return n
+
+    def close(self):
+        self._close_response()
+        super(HTTPRangeFile, self).close()
+
+
+def range_size(url, session=None, timeout=10):
+    """
+    Check whether the server supports range requests for a url, with a
+    HEAD request, so no data is transferred when it does not.
+
+    Returns
+    -------
+    size : int or None
+        The size of the file in bytes if range requests are supported,
+        otherwise None.
+    """
+    session = session or requests
+    r = session.head(url, allow_redirects=True, timeout=timeout)
+    r.close()
+    if r.status_code in (405, 501):
+        # HEAD is not allowed, download the file without ranges
+        return None
+    r.raise_for_status()
+    if r.headers.get('Accept-Ranges', '').lower() != 'bytes':
+        return None
+    size = r.headers.get('Content-Length', '')
+    return int(size) if size.isdigit() else None
+
+
+class SpooledDownload(object):
+    """
+    A file downloaded into an anonymous temporary file, used when the
+    server does not support range requests. Tracks `bytes_read` like
+    `HTTPRangeFile`.
+    """
+
+    def __init__(self, url, session=None, timeout=10, callback=None,
+                 dir=None):
+        self.bytes_read = 0
+        self.file = tempfile.TemporaryFile(dir=dir)
+        session = session or requests
+        with session.get(url, stream=True, timeout=timeout) as r:
+            r.raise_for_status()
+            total = r.headers.get('content-length')
+            total = int(total) if total is not None else None
+            for data in r.iter_content(chunk_size=BUFFER_SIZE):
+                self.file.write(data)
+                self.bytes_read += len(data)
+                if callback is not None:
+                    callback(self.bytes_read, total)
+        self.file.seek(0)
+
+    def close(self):
+        self.file.close()
+
+
+def open_remote_zip(url, session=None, timeout=10, spool_dir=None,
+                    callback=None):
+    """
+    Open a remote file for reading with `zipfile`. If the server supports
+    range requests the file is read directly over HTTP, so only the
+    central directory and the requested members are transferred and
+    nothing is written to disk. Otherwise the file is spooled to a
+    temporary file.
+
+    Returns
+    -------
+    fileobj : file-like object
+        A seekable file object to pass to `zipfile.ZipFile`.
+    source : HTTPRangeFile or SpooledDownload
+        The underlying download, with a `bytes_read` counter. Close it when
+        done.
+    """
+    size = range_size(url, session, timeout)
+    if size is not None:
+        source = HTTPRangeFile(url, size, session, timeout=timeout)
+        return io.BufferedReader(source, buffer_size=BUFFER_SIZE), source
+
+    source = SpooledDownload(url, session, timeout, callback, spool_dir)
+    return source.file, source
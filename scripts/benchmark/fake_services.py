@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+Chris Lucas
+
+Local stand-ins for the PDOK services, so the scripts can be benchmarked
+offline and reproducibly: a WMS service rendering a synthetic orthophoto,
+and a host serving AHN2 atom feeds and zip archives. Both run in a
+background thread on a free port of localhost and count the requests and
+bytes they serve (also available as JSON at /stats).
+"""
+
+import os
+import io
+import re
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+from PIL import Image
+
+CAPABILITIES = """<?xml version="1.0" encoding="UTF-8"?>
+<WMS_Capabilities version="1.3.0" xmlns="http://www.opengis.net/wms">
+<Service><Name>WMS</Name><Title>Fake WMS</Title>
+<MaxWidth>{max_size}</MaxWidth><MaxHeight>{max_size}</MaxHeight></Service>
+<Capability><Request>
+<GetCapabilities><Format>text/xml</Format></GetCapabilities>
+<GetMap><Format>image/png</Format><Format>image/jpeg</Format></GetMap>
+</Request>
+<Layer><Title>Fake</Title><CRS>EPSG:28992</CRS>
+<Layer><Name>{layer}</Name><Title>{layer}</Title><CRS>EPSG:28992</CRS></Layer>
+</Layer></Capability></WMS_Capabilities>
+"""
+
+SERVICE_EXCEPTION = """<?xml version="1.0" encoding="UTF-8"?>
+<ServiceExceptionReport version="1.3.0" xmlns="http://www.opengis.net/ogc">
+<ServiceException>{}</ServiceException></ServiceExceptionReport>
+"""
+
+BUFFER_SIZE = 1048576
+FEED_ENTRY = """<entry><id>{name}</id><title>{name}</title>
+<link href="{url}"/><content>Bestandsgrootte: {size:.1f} MB</content></entry>
+"""
+
+
+class FakeService(object):
+    """
+    An HTTP server running in a background thread. Use as a context
+    manager, or call `start` and `stop`.
+
+    Parameters
+    ----------
+    latency : float
+        The time in seconds to wait before answering a request.
+    """
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.stats = {'requests': 0, 'bytes': 0}
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_port)
+
+    def start(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                if self.path == '/stats':
+                    with service._lock:
+                        body = json.dumps(service.stats).encode('utf-8')
+                    self.respond(200, body, 'application/json')
+                    return
+                if service.latency:
+                    time.sleep(service.latency)
+                service.handle(self)
+
+            def do_HEAD(self):
+                # the same headers as GET, without the body
+                self.do_GET()
+
+            def respond(self, status, body, content_type, headers=()):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                for header in headers:
+                    self.send_header(*header)
+                self.end_headers()
+                if self.command == 'HEAD':
+                    return
+                self.wfile.write(body)
+                if self.path != '/stats':
+                    service.count(len(body))
+
+            def respond_file(self, status, f, length, content_type,
+                             headers=()):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(length))
+                for header in headers:
+                    self.send_header(*header)
+                self.end_headers()
+                if self.command == 'HEAD':
+                    return
+                sent = 0
+                try:
+                    while sent < length:
+                        data = f.read(min(BUFFER_SIZE, length - sent))
+                        if not data:
+                            break
+                        self.wfile.write(data)
+                        sent += len(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client read what it needed, e.g. a zip directory
+                    self.close_connection = True
+                service.count(sent)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def count(self, size):
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += size
+
+    def handle(self, request):
+        raise NotImplementedError
+
+
+class FakeWMS(FakeService):
+    """
+    A WMS 1.3.0 service rendering a synthetic orthophoto: a pattern of the
+    world coordinates, so adjacent images fit together. Requests larger
+    than `max_size` are answered with a service exception, like PDOK does.
+
+    Parameters
+    ----------
+    max_size : int
+        The MaxWidth and MaxHeight of the service.
+    latency : float
+        The time in seconds to wait before answering a request.
+    layer : str
+        The name of the layer.
+    """
+
+    def __init__(self, max_size=4096, latency=0.05, layer='Actueel_ortho25'):
+        super(FakeWMS, self).__init__(latency)
+        self.max_size = max_size
+        self.layer = layer
+
+    @property
+    def url(self):
+        return super(FakeWMS, self).url + '/wms?'
+
+    def handle(self, request):
+        params = {k.upper(): v[0] for k, v in
+                  parse_qs(urlparse(request.path).query).items()}
+        operation = params.get('REQUEST', '').lower()
+        if operation == 'getcapabilities':
+            body = CAPABILITIES.format(max_size=self.max_size,
+                                       layer=self.layer)
+            request.respond(200, body.encode('utf-8'), 'text/xml')
+        elif operation == 'getmap':
+            try:
+                body, content_type = self.getmap(params)
+            except ValueError as e:
+                body = SERVICE_EXCEPTION.format(e).encode('utf-8')
+                content_type = 'application/vnd.ogc.se_xml'
+            request.respond(200, body, content_type)
+        else:
+            request.respond(400, b'Unknown request', 'text/plain')
+
+    def getmap(self, params):
+        width = int(params['WIDTH'])
+        height = int(params['HEIGHT'])
+        if width > self.max_size or height > self.max_size:
+            raise ValueError("Image size out of range, WIDTH and HEIGHT "
+                             "must be between 1 and {} pixels.".format(
+                                 self.max_size))
+        xmin, ymin, xmax, ymax = [float(c) for c in
+                                  params['BBOX'].split(',')]
+        x = xmin + (np.arange(width) + 0.5) * (xmax - xmin) / width
+        y = ymax - (np.arange(height) + 0.5) * (ymax - ymin) / height
+        img = np.empty((height, width, 3), dtype=np.uint8)
+        img[:, :, 0] = (x % 256).astype(np.uint8)
+        img[:, :, 1] = (y % 256).astype(np.uint8)[:, np.newaxis]
+        img[:, :, 2] = ((x[np.newaxis, :] + y[:, np.newaxis]) / 4 %
+                        256).astype(np.uint8)
+
+        data = io.BytesIO()
+        if 'jpeg' in params.get('FORMAT', ''):
+            Image.fromarray(img).save(data, 'JPEG', quality=85)
+            return data.getvalue(), 'image/jpeg'
+        Image.fromarray(img).save(data, 'PNG', compress_level=1)
+        return data.getvalue(), 'image/png'
+
+
+class FakeAHN2(FakeService):
+    """
+    A host serving the AHN2 atom feeds (/ahn2_uitgefilterd.xml and
+    /ahn2_gefilterd.xml) listing the zip archives in a folder, named
+    u<tile id>.laz.zip and g<tile id>.laz.zip, and the archives themselves.
+
+    Parameters
+    ----------
+    folder : str
+        The folder with the zip archives.
+    ranges : bool
+        Support (and advertise) range requests, so the archives are
+        unzipped while they are downloaded. Otherwise they are spooled to
+        disk first.
+    latency : float
+        The time in seconds to wait before answering a request.
+    """
+
+    FEEDS = {'u': 'ahn2_uitgefilterd.xml', 'g': 'ahn2_gefilterd.xml'}
+
+    def __init__(self, folder, ranges=True, latency=0):
+        super(FakeAHN2, self).__init__(latency)
+        self.folder = folder
+        self.ranges = ranges
+
+    @property
+    def feed_urls(self):
+        return {prefix: '{}/{}'.format(self.url, name)
+                for prefix, name in self.FEEDS.items()}
+
+    def feed(self, prefix):
+        entries = []
+        for name in sorted(os.listdir(self.folder)):
+            if name.startswith(prefix) and name.endswith('.laz.zip'):
+                size = os.path.getsize(os.path.join(self.folder, name))
+                entries.append(FEED_ENTRY.format(
+                    name=name, url='{}/{}'.format(self.url, name),
+                    size=size / 1048576))
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<feed xmlns="http://www.w3.org/2005/Atom">\n'
+                '<title>AHN2</title>\n{}</feed>\n'.format(''.join(entries)))
+
+    def handle(self, request):
+        name = urlparse(request.path).path.lstrip('/')
+        for prefix, feed_name in self.FEEDS.items():
+            if name == feed_name:
+                request.respond(200, self.feed(prefix).encode('utf-8'),
+                                'application/atom+xml')
+                return
+
+        path = os.path.join(self.folder, os.path.basename(name))
+        if not name.endswith('.zip') or not os.path.isfile(path):
+            request.respond(404, b'Not found', 'text/plain')
+            return
+        size = os.path.getsize(path)
+        match = re.match(r'bytes=(\d+)-(\d*)',
+                         request.headers.get('Range', ''))
+        with open(path, 'rb') as f:
+            if self.ranges and match:
+                start = int(match.group(1))
+                end = min(int(match.group(2)) if match.group(2)
+                          else size - 1, size - 1)
+                f.seek(start)
+                request.respond_file(
+                    206, f, end - start + 1, 'application/zip',
+                    [('Accept-Ranges', 'bytes'),
+                     ('Content-Range', 'bytes {}-{}/{}'.format(start, end,
+                                                               size))])
+            else:
+                request.respond_file(
+                    200, f, size, 'application/zip',
+                    [('Accept-Ranges', 'bytes' if self.ranges else 'none')])
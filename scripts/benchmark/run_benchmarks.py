@@ -0,0 +1,502 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+Chris Lucas
+
+Benchmark the scripts offline on synthetic data, against local stand-ins
+for the PDOK WMS service and AHN2 atom feeds: downloading tiles
+(`request_tiles`), requesting a large orthophoto (`retrieve_image`),
+colorizing a folder (`las_colorize`) and clipping a folder (`clip_las`).
+
+Each scenario runs in its own process, so its peak memory is measured
+separately and module level state (clients, caches) is not shared between
+runs. The results are saved as JSON, to compare runs with each other.
+"""
+
+import sys
+import os
+import io
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import traceback
+import subprocess
+import multiprocessing
+from queue import Empty
+from contextlib import redirect_stdout, ExitStack
+import numpy as np
+import requests
+_scripts = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+for _folder in ('common', 'ahn2_download', 'clip', 'colorize'):
+    sys.path.append(os.path.join(_scripts, _folder))
+import las_io
+import synthetic
+from fake_services import FakeWMS, FakeAHN2
+
+LAS_SRS = 'EPSG:28992'
+WMS_LAYER = 'Actueel_ortho25'
+
+
+def wms_args(ctx):
+    return {'wms_url': ctx['wms_url'],
+            'wms_layer': WMS_LAYER,
+            'wms_srs': LAS_SRS,
+            'wms_version': '1.3.0',
+            'wms_format': ctx['wms_format'],
+            'wms_ppm': ctx['wms_ppm'],
+            'wms_max_image_size': None,
+            'wms_concurrency': ctx['wms_concurrency']}
+
+
+def scenario_download(ctx, work):
+    """
+    Download and unzip the archives of all tiles from the fake feeds.
+    """
+    import ahn2_downloader
+    start = time.time()
+    failed = ahn2_downloader.request_tiles(
+        ctx['tile_ids'], work + '/', jobs=ctx['jobs'], feed_cache=None,
+        feed_urls=ctx['feed_urls'])
+    elapsed = time.time() - start
+    if failed:
+        raise RuntimeError("Failed tiles: {}".format(failed))
+    size = sum(os.path.getsize(os.path.join(work, f))
+               for f in os.listdir(work) if f.endswith('.laz'))
+    return {'time': elapsed, 'amount': size / 1048576, 'unit': 'mb'}
+
+
+def scenario_wms(ctx, work):
+    """
+    Request the orthophoto of the whole grid of tiles.
+    """
+    import pdal_colorize
+    wms = wms_args(ctx)
+    # the capabilities are requested once per process, not timed
+    client = pdal_colorize.wms_client(wms)
+    max_size = pdal_colorize.max_image_size(wms)
+    start = time.time()
+    img = pdal_colorize.retrieve_image(
+        ctx['bbox'], wms['wms_url'], wms['wms_layer'], wms['wms_srs'],
+        wms['wms_version'], pdal_colorize.image_format(wms),
+        int(wms['wms_ppm']), max_size, int(wms['wms_concurrency']),
+        rate=client.rate, max_requests=client.max_requests)
+    elapsed = time.time() - start
+    return {'time': elapsed, 'amount': img.shape[0] * img.shape[1] / 1e6,
+            'unit': 'megapixels'}
+
+
+def scenario_colorize(ctx, work):
+    """
+    Colorize the folder of tiles with the colorize engine.
+    """
+    import las_colorize
+    wms = wms_args(ctx)
+    start = time.time()
+    failed = las_colorize.process_files(
+        ctx['tiles_folder'], work, LAS_SRS, wms['wms_url'],
+        wms['wms_layer'], wms['wms_srs'], wms['wms_version'],
+        wms['wms_format'], wms['wms_ppm'], None, jobs=ctx['jobs'],
+        engine=True, wms_concurrency=wms['wms_concurrency'])
+    elapsed = time.time() - start
+    if failed:
+        raise RuntimeError("Failed files: {}".format(
+            [job.name for job in failed]))
+    return {'time': elapsed, 'amount': ctx['points'], 'unit': 'points'}
+
+
+def count_inside(paths, ring):
+    """
+    Count the points of files inside a polygon ring, with a brute-force
+    even-odd test against all its edges.
+    """
+    count = 0
+    for path in paths:
+        for chunk in las_io.iter_chunks(path):
+            X = np.asarray(chunk.x)
+            Y = np.asarray(chunk.y)
+            inside = np.zeros(len(X), dtype=bool)
+            for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]):
+                crosses = (y1 > Y) != (y2 > Y)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    x = x1 + (Y - y1) * (x2 - x1) / (y2 - y1)
+                inside ^= crosses & (X < x)
+            count += int(np.count_nonzero(inside))
+    return count
+
+
+def scenario_clip(ctx, work):
+    """
+    Clip the folder of tiles in this process to a triangle covering half
+    of the grid, so there are tiles inside, outside and on the boundary.
+    The number of points clipped is checked against a brute-force count.
+    """
+    shp = os.path.join(work, 'polygon.shp')
+    xmin, ymin, xmax, ymax = ctx['bbox']
+    # half a cm off the 1 cm grid of the points, so no point is exactly on
+    # an edge
+    ring = [(xmin - 0.005, ymin - 0.005), (xmax + 0.01, ymin - 0.005),
+            (xmin - 0.005, ymax + 0.01)]
+    synthetic.write_polygon(shp, [ring])
+    import las_clip
+    output = os.path.join(work, 'clipped')
+    os.makedirs(output)
+    start = time.time()
+    failed = las_clip.clip_las(ctx['tiles_folder'], output, shp, LAS_SRS,
+                               ctx['jobs'], engine=True)
+    elapsed = time.time() - start
+    if failed:
+        raise RuntimeError("Failed files: {}".format(
+            [job.name for job in failed]))
+
+    clipped = sum(las_io.read_bounds(os.path.join(output, f))[1]
+                  for f in os.listdir(output))
+    expected = count_inside(ctx['tiles'], ring)
+    if clipped != expected:
+        raise RuntimeError("Clipped {} points, expected {}.".format(
+            clipped, expected))
+    return {'time': elapsed, 'amount': ctx['points'], 'unit': 'points'}
+
+
+SCENARIOS = {'download': (scenario_download, 'archives'),
+             'wms': (scenario_wms, None),
+             'colorize': (scenario_colorize, 'tiles'),
+             'clip': (scenario_clip, 'tiles')}
+
+
+def _run(name, ctx, work, verbose, queue):
+    try:
+        with ExitStack() as stack:
+            if not verbose:
+                stack.enter_context(redirect_stdout(io.StringIO()))
+            result = SCENARIOS[name][0](ctx, work)
+    except BaseException as e:
+        queue.put({'error': '{}: {}'.format(type(e).__name__, e)})
+        if verbose:
+            traceback.print_exc()
+        return
+    result['peak_memory'] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss / 1024
+    queue.put(result)
+
+
+def server_stats(service):
+    return requests.get(service.url.split('/wms')[0] + '/stats').json()
+
+
+def run_scenario(name, ctx, folder, repeat=1, service=None, verbose=False):
+    """
+    Run a scenario `repeat` times, each in a new process with an empty
+    work folder.
+
+    Returns
+    -------
+    result : dict
+        The best time, the throughput at that time, the highest peak
+        memory (mb) and the requests and mb served by the fake service
+        per run, or the error if the scenario failed or could not run.
+    """
+    # spawn, the LAZ backend does not survive a fork of a process using it
+    mp = multiprocessing.get_context('spawn')
+    runs = []
+    before = server_stats(service) if service is not None else None
+    for i in range(repeat):
+        work = os.path.join(folder, '{}_{}'.format(name, i))
+        os.makedirs(work)
+        queue = mp.Queue()
+        p = mp.Process(target=_run, args=(name, ctx, work, verbose, queue))
+        p.start()
+        result = None
+        while result is None:
+            try:
+                result = queue.get(timeout=1)
+            except Empty:
+                if not p.is_alive():
+                    result = {'error': 'The process died (exit code {}).'
+                                       .format(p.exitcode)}
+        p.join()
+        shutil.rmtree(work, ignore_errors=True)
+        if 'error' in result:
+            return {'scenario': name, 'error': result['error']}
+        runs.append(result)
+
+    best = min(runs, key=lambda r: r['time'])
+    result = {'scenario': name,
+              'time': best['time'],
+              'times': [r['time'] for r in runs],
+              'amount': best['amount'],
+              'unit': best['unit'],
+              'throughput': best['amount'] / max(best['time'], 1e-9),
+              'peak_memory': max(r['peak_memory'] for r in runs)}
+    if service is not None:
+        after = server_stats(service)
+        result['requests'] = (after['requests'] - before['requests']) / repeat
+        result['served_mb'] = ((after['bytes'] - before['bytes']) /
+                               1048576 / repeat)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=_scripts,
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(scenarios, tiles=4, tile_size=250, density=10,
+                   data_dir=None, jobs=2, repeat=1, wms_latency=0.05,
+                   wms_max_size=2048, wms_format='image/png', wms_ppm=4,
+                   wms_concurrency=4, feed_ranges=True, seed=0,
+                   verbose=False):
+    """
+    Generate the synthetic data, start the fake services and run the
+    scenarios.
+
+    Parameters
+    ----------
+    tiles : int
+        The number of tiles, laid out in a square grid.
+    tile_size : int
+        The size of a tile in m.
+    density : float
+        The number of points per m².
+    data_dir : str
+        The folder to keep the synthetic data in, to reuse it in later
+        runs. (default: None, a temporary folder)
+    wms_latency : float
+        The time in seconds the fake WMS waits before answering.
+    wms_max_size : int
+        The maximum image width and height of the fake WMS.
+    feed_ranges : bool
+        Whether the fake AHN2 host supports range requests.
+
+    Returns
+    -------
+    run : dict
+        The parameters, environment and results of the run.
+    """
+    params = {'tiles': tiles, 'tile_size': tile_size, 'density': density,
+              'jobs': jobs, 'repeat': repeat, 'wms_latency': wms_latency,
+              'wms_max_size': wms_max_size, 'wms_format': wms_format,
+              'wms_ppm': wms_ppm, 'wms_concurrency': wms_concurrency,
+              'feed_ranges': feed_ranges, 'seed': seed}
+    run = {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+           'commit': git_commit(),
+           'python': platform.python_version(),
+           'platform': platform.platform(),
+           'cpus': os.cpu_count(),
+           'params': params,
+           'results': []}
+
+    folder = tempfile.mkdtemp()
+    data_dir = data_dir or os.path.join(folder, 'data')
+    try:
+        ctx = dict(params)
+        ctx['bbox'] = synthetic.grid_bounds(tiles, tile_size)
+        ctx['points'] = tiles * int(round(density * tile_size ** 2))
+        needs = {SCENARIOS[s][1] for s in scenarios}
+        if 'tiles' in needs:
+            if verbose:
+                print('Generating {} tiles of {} points..'.format(
+                    tiles, ctx['points'] // tiles))
+            ctx['tiles_folder'] = os.path.join(
+                data_dir, 'tiles_{}m_{}pm2_{}'.format(tile_size, density,
+                                                      seed))
+            ctx['tiles'] = synthetic.synthetic_tiles(
+                ctx['tiles_folder'], tiles, tile_size, density, seed=seed)
+        archives = os.path.join(data_dir, 'archives_{}m_{}pm2_{}'.format(
+            tile_size, density, seed))
+        if 'archives' in needs:
+            if verbose:
+                print('Generating the AHN2 archives..')
+            ctx['tile_ids'] = synthetic.synthetic_archives(
+                archives, tiles, tile_size, density, seed)
+
+        with FakeWMS(wms_max_size, wms_latency, WMS_LAYER) as wms, \
+                FakeAHN2(archives, feed_ranges) as ahn2:
+            ctx['wms_url'] = wms.url
+            ctx['feed_urls'] = ahn2.feed_urls
+            for name in scenarios:
+                if verbose:
+                    print('Running {}..'.format(name))
+                service = {'download': ahn2, 'wms': wms,
+                           'colorize': wms}.get(name)
+                run['results'].append(run_scenario(name, ctx, folder, repeat,
+                                                   service, verbose))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return run
+
+
+def save_results(run, folder, label=None):
+    """
+    Save the results of a run as <date>[_<label>].json in a folder.
+    """
+    os.makedirs(folder, exist_ok=True)
+    name = run['date'].replace(':', '')
+    if label:
+        run['label'] = label
+        name = '{}_{}'.format(name, label)
+    path = os.path.join(folder, '{}.json'.format(name))
+    with open(path, 'w') as f:
+        json.dump(run, f, indent=2)
+    return path
+
+
+def print_results(run, previous=None):
+    """
+    Print the results of a run, with the change in time and peak memory
+    relative to a previous run.
+    """
+    before = {}
+    if previous is not None:
+        before = {r['scenario']: r for r in previous['results']
+                  if 'error' not in r}
+        if previous['params'] != run['params']:
+            print('NB: the runs have different parameters.')
+
+    print('{:<10}{:>10}{:>22}{:>16}{:>10}{:>10}{:>10}'.format(
+        'scenario', 'time (s)', 'throughput', 'peak mem (mb)', 'requests',
+        'd time', 'd mem'))
+    for r in run['results']:
+        if 'error' in r:
+            print('{:<10}  {}'.format(r['scenario'], r['error']))
+            continue
+        throughput = '{:.1f} {}/s'.format(r['throughput'], r['unit'])
+        change = ['', '']
+        b = before.get(r['scenario'])
+        if b is not None:
+            change = ['{:+.0f}%'.format(100 * (r['time'] / b['time'] - 1)),
+                      '{:+.0f}%'.format(100 * (r['peak_memory'] /
+                                               b['peak_memory'] - 1))]
+        requests_made = r.get('requests')
+        print('{:<10}{:>10.2f}{:>22}{:>16.1f}{:>10}{:>10}{:>10}'.format(
+            r['scenario'], r['time'], throughput, r['peak_memory'],
+            '{:.0f}'.format(requests_made) if requests_made is not None
+            else '-', change[0], change[1]))
+
+
+def argument_parser():
+    """
+    Define and return the arguments.
+    """
+    description = ("Benchmark downloading, requesting WMS images, "
+                   "colorizing and clipping on synthetic data with local "
+                   "stand-ins for the PDOK services.")
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-s', '--scenarios',
+                        help='The scenarios to run. (default: all)',
+                        nargs='+',
+                        choices=sorted(SCENARIOS),
+                        required=False,
+                        default=['download', 'wms', 'colorize', 'clip'])
+    parser.add_argument('-t', '--tiles',
+                        help='The number of synthetic tiles. (int, default: 4)',
+                        type=int,
+                        required=False,
+                        default=4)
+    parser.add_argument('--tile_size',
+                        help='The size of a tile in m. (int, default: 250)',
+                        type=int,
+                        required=False,
+                        default=250)
+    parser.add_argument('-d', '--density',
+                        help='The number of points per m². (float, default: 10)',
+                        type=float,
+                        required=False,
+                        default=10)
+    parser.add_argument('--data_dir',
+                        help='A folder to keep the synthetic data in, so it is generated once. (default: a temporary folder)',
+                        required=False,
+                        default=None)
+    parser.add_argument('-j', '--jobs',
+                        help='The number of files or tiles to process at the same time. (int, default: 2)',
+                        type=int,
+                        required=False,
+                        default=2)
+    parser.add_argument('-r', '--repeat',
+                        help='The number of times to run each scenario, the best time is reported. (int, default: 1)',
+                        type=int,
+                        required=False,
+                        default=1)
+    parser.add_argument('--wms_latency',
+                        help='The time in seconds the fake WMS waits before answering a request. (float, default: 0.05)',
+                        type=float,
+                        required=False,
+                        default=0.05)
+    parser.add_argument('--wms_max_size',
+                        help='The maximum image width and height of the fake WMS. (int, default: 2048)',
+                        type=int,
+                        required=False,
+                        default=2048)
+    parser.add_argument('-f', '--wms_format',
+                        help='The image format to request, or auto. (str, default: image/png)',
+                        required=False,
+                        default='image/png')
+    parser.add_argument('-p', '--wms_ppm',
+                        help='The pixels per meter of the requested images. (int, default: 4)',
+                        type=int,
+                        required=False,
+                        default=4)
+    parser.add_argument('-c', '--wms_concurrency',
+                        help='The maximum number of simultaneous WMS requests. (int, default: 4)',
+                        type=int,
+                        required=False,
+                        default=4)
+    parser.add_argument('--no_ranges',
+                        help='Let the fake AHN2 host refuse range requests, so the archives are spooled to disk.',
+                        action='store_true',
+                        required=False,
+                        default=False)
+    parser.add_argument('--seed',
+                        help='The seed of the synthetic data. (int, default: 0)',
+                        type=int,
+                        required=False,
+                        default=0)
+    parser.add_argument('-o', '--results',
+                        help='The folder to save the results in. (default: benchmark_results)',
+                        required=False,
+                        default='benchmark_results')
+    parser.add_argument('-l', '--label',
+                        help='A label to add to the name of the results file.',
+                        required=False,
+                        default=None)
+    parser.add_argument('--compare',
+                        help='A results file of an earlier run to compare with.',
+                        required=False,
+                        default=None)
+    parser.add_argument('-v', '--verbose',
+                        help='Print out the progress and the output of the scripts.',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = argument_parser()
+    previous = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    run = run_benchmarks(args.scenarios, args.tiles, args.tile_size,
+                         args.density, args.data_dir, args.jobs, args.repeat,
+                         args.wms_latency, args.wms_max_size,
+                         args.wms_format, args.wms_ppm, args.wms_concurrency,
+                         not args.no_ranges, args.seed, args.verbose)
+    path = save_results(run, args.results, args.label)
+    print_results(run, previous)
+    print('Results saved to {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
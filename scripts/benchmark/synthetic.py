@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+Chris Lucas
+
+Synthetic AHN2-like point clouds: a grid of square LAS/LAZ tiles of a
+given size and point density, and the zipped filtered (g) and remaining
+(u) data of each tile as served by the AHN2 atom feeds. The data is
+generated from a seed, so every run benchmarks the same points.
+"""
+
+import sys
+import os
+import math
+import zipfile
+import numpy as np
+import laspy
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'common'))
+import las_io
+
+ORIGIN = (120000, 487000)
+# The share of the points in the remaining (u) data of an AHN2 tile
+REMAINING_SHARE = 0.2
+
+
+def tile_bounds(i, tiles, tile_size):
+    """
+    The bounds [xmin, ymin, xmax, ymax] of tile `i` of a square grid of
+    `tiles` tiles, filled row by row from the origin.
+    """
+    cols = int(math.ceil(math.sqrt(tiles)))
+    xmin = ORIGIN[0] + (i % cols) * tile_size
+    ymin = ORIGIN[1] + (i // cols) * tile_size
+    return [xmin, ymin, xmin + tile_size, ymin + tile_size]
+
+
+def grid_bounds(tiles, tile_size):
+    """
+    The bounds [xmin, ymin, xmax, ymax] of a grid of tiles.
+    """
+    bounds = np.array([tile_bounds(i, tiles, tile_size)
+                       for i in range(tiles)])
+    return bounds[:, :2].min(axis=0).tolist() + bounds[:, 2:].max(axis=0).tolist()
+
+
+def synthetic_tile(filename, bounds, density, seed=0,
+                   chunk_size=las_io.DEFAULT_CHUNK_SIZE):
+    """
+    Write a synthetic AHN2-like LAS/LAZ file (point format 1, 1 cm
+    precision): points spread uniformly over the bounds, on gently rolling
+    terrain with noise.
+
+    Parameters
+    ----------
+    bounds : list of float
+        [xmin, ymin, xmax, ymax]
+    density : float
+        The number of points per m².
+
+    Returns
+    -------
+    point_count : int
+    """
+    xmin, ymin, xmax, ymax = bounds
+    point_count = int(round(density * (xmax - xmin) * (ymax - ymin)))
+    rng = np.random.default_rng(seed)
+    header = laspy.LasHeader(point_format=1, version='1.2')
+    header.scales = [0.01, 0.01, 0.01]
+    header.offsets = [ORIGIN[0], ORIGIN[1], 0]
+
+    with laspy.open(filename, mode='w', header=header) as writer:
+        for start in range(0, point_count, chunk_size):
+            n = min(chunk_size, point_count - start)
+            points = laspy.ScaleAwarePointRecord.zeros(n, header=header)
+            x = rng.uniform(xmin, xmax, n)
+            y = rng.uniform(ymin, ymax, n)
+            points.x = x
+            points.y = y
+            points.z = (2 * np.sin(x / 50) * np.cos(y / 70) +
+                        rng.exponential(0.5, n))
+            points.intensity = rng.integers(0, 2000, n)
+            points.classification = np.full(n, 2, dtype=np.uint8)
+            writer.write_points(points)
+    return point_count
+
+
+def synthetic_tiles(folder, tiles, tile_size, density, ext='.laz', seed=0):
+    """
+    Write a grid of synthetic tiles to a folder. Tiles that already exist
+    (with the same parameters, which are part of the name) are kept, so the
+    data can be reused between runs.
+
+    Returns
+    -------
+    paths : list of str
+    """
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i in range(tiles):
+        path = os.path.join(folder, 'tile_{}_{}m_{}pm2_{}{}'.format(
+            i, tile_size, density, seed, ext))
+        if not os.path.isfile(path):
+            tmp_file = path + '.part' + ext
+            synthetic_tile(tmp_file, tile_bounds(i, tiles, tile_size),
+                           density, seed + i)
+            os.replace(tmp_file, path)
+        paths.append(path)
+    return paths
+
+
+def tile_id(i):
+    return 'bench{}'.format(i)
+
+
+def synthetic_archives(folder, tiles, tile_size, density, seed=0):
+    """
+    Write the zipped filtered (g<id>.laz.zip) and remaining
+    (u<id>.laz.zip) data of a grid of synthetic tiles to a folder, as
+    listed by `fake_services.FakeAHN2`. Existing archives are kept.
+
+    Returns
+    -------
+    tile_ids : list of str
+    """
+    os.makedirs(folder, exist_ok=True)
+    tile_ids = []
+    for i in range(tiles):
+        bounds = tile_bounds(i, tiles, tile_size)
+        for prefix, share in (('g', 1 - REMAINING_SHARE),
+                              ('u', REMAINING_SHARE)):
+            name = '{}{}.laz'.format(prefix, tile_id(i))
+            archive = os.path.join(folder, name + '.zip')
+            if os.path.isfile(archive):
+                continue
+            las_file = os.path.join(folder, name)
+            synthetic_tile(las_file, bounds, density * share,
+                           seed + 2*i + (prefix == 'u'))
+            with zipfile.ZipFile(archive + '.part', 'w',
+                                 zipfile.ZIP_DEFLATED) as z:
+                z.write(las_file, name)
+            os.remove(las_file)
+            os.replace(archive + '.part', archive)
+        tile_ids.append(tile_id(i))
+    return tile_ids
+
+
+def write_polygon(path, rings, srs='EPSG:28992'):
+    """
+    Write a polygon to a shapefile (requires GDAL).
+
+    Parameters
+    ----------
+    rings : list of list
+        The (x, y) coordinates of the exterior ring, followed by those of
+        the interior rings.
+    """
+    from osgeo import ogr, osr
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    if os.path.exists(path):
+        driver.DeleteDataSource(path)
+    reference = osr.SpatialReference()
+    reference.SetFromUserInput(srs)
+    source = driver.CreateDataSource(path)
+    layer = source.CreateLayer('polygon', reference, ogr.wkbPolygon)
+    polygon = ogr.Geometry(ogr.wkbPolygon)
+    for coordinates in rings:
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in list(coordinates) + [coordinates[0]]:
+            ring.AddPoint_2D(float(x), float(y))
+        polygon.AddGeometry(ring)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(polygon)
+    layer.CreateFeature(feature)
+    source = None
@@ -5,71 +5,277 @@ Python3
 @author: chrisl
 """
 
+import sys
 import os
 import argparse
+import re
+import shutil
 import subprocess
+from contextlib import ExitStack
+import laspy
 from osgeo import ogr
+from point_in_polygon import (PreparedPolygon, PolygonIndex, geometry_rings,
+                              OUTSIDE, INSIDE, BOUNDARY)
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'common'))
+import las_io
+from las_index import LasIndex
+from batch import Job, run_batch, MEMORY_PER_POINT
+import metrics
+
+# The longest polygon WKT passed to PDAL on the command line
+MAX_WKT_LENGTH = 30000
 
 
 def call_pdal(path, las, out, srs, wkt):
-    if len(wkt) > 30000:
-        subprocess.call(['pdal', 'pipeline',
-                         '{}/pdal_pipeline.json'.format(path),
-                         '--readers.las.filename={}'.format(las),
-                         '--writers.las.filename={}'.format(out),
-                         '--writers.las.a_srs={}'.format(srs)])
-    else:
-        subprocess.call(['pdal', 'pipeline',
-                         '{}/pdal_pipeline.json'.format(path),
-                         '--readers.las.filename={}'.format(las),
-                         '--filters.crop.polygon={}'.format(wkt),
-                         '--writers.las.filename={}'.format(out),
-                         '--writers.las.a_srs={}'.format(srs)])
-
-def clip_las(input_path, output_path, shp_path, srs):
-    input_path = os.path.abspath(input_path).replace('\\', '/')
-    output_path = os.path.abspath(output_path).replace('\\', '/')
+    """
+    Clip a LAS/LAZ file with PDAL. Raises CalledProcessError if PDAL fails.
+    """
+    reader_args, tmp_file = las_io.pdal_reader_args(
+        '{}/pdal_pipeline.json'.format(path), las)
+    try:
+        with metrics.stage('pdal_run', file=las):
+            subprocess.check_call(['pdal', 'pipeline'] + reader_args +
+                                  ['--filters.crop.polygon={}'.format(wkt),
+                                   '--writers.las.filename={}'.format(out),
+                                   '--writers.las.a_srs={}'.format(srs)])
+    finally:
+        if tmp_file is not None:
+            os.remove(tmp_file)
+
+
+def clip_native(las, outs, srs, index=None,
+                chunk_size=las_io.DEFAULT_CHUNK_SIZE):
+    """
+    Clip a LAS/LAZ file to one or more polygons in this process, reading
+    the points once in chunks. Each point is written to the output of every
+    polygon it is in.
+
+    Parameters
+    ----------
+    outs : list of str
+        The output path for each polygon of the index. With multiple
+        polygons, outputs are only created for polygons containing points.
+    index : PolygonIndex
+        The polygons to clip to. (default: None, copy all points to the
+        single output)
+
+    Returns
+    -------
+    point_counts : list of int
+        The number of points written to each output.
+    """
+    header = las_io.output_header(las_io.read_header(las))
+    if srs is not None and header.parse_crs() is None:
+        import pyproj
+        header.add_crs(pyproj.CRS.from_user_input(srs))
+
+    point_counts = [0] * len(outs)
+    with ExitStack() as stack:
+        writers = {}
+        if len(outs) == 1:
+            writers[0] = stack.enter_context(
+                laspy.open(outs[0], mode='w', header=header))
+        for chunk in las_io.iter_chunks(las, chunk_size):
+            if index is None:
+                writers[0].write_points(las_io.convert_points(chunk, header))
+                point_counts[0] += len(chunk)
+                continue
+            X, Y = las_io.scaled_xy(chunk, header)
+            for i, points in index.query(X, Y):
+                if i not in writers:
+                    writers[i] = stack.enter_context(
+                        laspy.open(outs[i], mode='w', header=header))
+                writers[i].write_points(las_io.convert_points(chunk[points],
+                                                              header))
+                point_counts[i] += len(points)
+
+    return point_counts
 
+
+def read_features(shp_path, attribute=None):
+    """
+    Read the polygons of a shapefile.
+
+    Parameters
+    ----------
+    attribute : str
+        The attribute to name the features by. (default: None, the feature
+        id)
+
+    Returns
+    -------
+    names : list of str
+        The names of the features, safe to use in file names.
+    geometries : list of ogr.Geometry
+    """
     input_shape = ogr.Open(shp_path)
     layer = input_shape.GetLayer()
-    if len(layer) > 1:
-        raise ValueError("Shapefiles containing more than 1 feature are not supported at this time")
+    names = []
+    geometries = []
+    for feature in layer:
+        name = (feature.GetFID() if attribute is None
+                else feature.GetField(attribute))
+        names.append(re.sub(r'[^\w\-.]+', '_', str(name)))
+        geometries.append(feature.GetGeometryRef().Clone())
+    if len(set(names)) != len(names):
+        raise ValueError("The feature names are not unique, choose another "
+                         "attribute.")
+    return names, geometries
+
+
+def copy_file(las, out, srs):
+    """
+    Copy a file entirely inside the polygon to the output, as is if
+    possible, without testing the points.
+    """
+    same_format = (not las_io.is_manifest(las) and
+                   os.path.splitext(las)[1].lower() ==
+                   os.path.splitext(out)[1].lower())
+    if same_format and (srs is None or
+                        las_io.read_header(las).parse_crs() is not None):
+        shutil.copyfile(las, out)
     else:
-        feature = layer.GetNextFeature()
-        geometry = feature.GetGeometryRef()
-        wkt = geometry.ExportToWkt()
-
-        long_wkt = False
-        if len(wkt) > 30000:
-            print(wkt)
-            print("Polygon WKT too long, please copy the WKT above manually to the pdal_pipeline.json file.")
-            print("Press enter to continue..")
-            raw_input()
-
-        path = os.path.dirname(os.path.realpath(__file__)).replace('\\', '/')
-
-        if os.path.isdir(input_path):
-            for i, f in enumerate(os.listdir(input_path)):
-                if f.endswith(".las") or f.endswith(".laz"):
-                    las = os.path.join(input_path, f).replace('\\', '/')
-
-                    if os.path.isdir(output_path):
-                        output_path = output_path + '/' if output_path[-1] != '/' else output_path
-                        basename, ext = os.path.splitext(f)
-                        out = '{}{}_clip{}'.format(output_path, basename, ext)
-                    else:
-                        basename, ext = os.path.splitext(output_path)
-                        out = '{}_{}{}'.format(basename, i, ext)
-
-                    call_pdal(path, las, out, srs, wkt)
-
-        elif os.path.isdir(output_path):
-            output_path = output_path + '/' if output_path[-1] != '/' else output_path
-            basename, ext = os.path.splitext(os.path.basename(input_path))
-            out = '{}{}_clip{}'.format(output_path, basename, ext)
-            call_pdal(path, input_path, out, srs, wkt)
+        clip_native(las, [out], srs)
+
+
+def feature_output(out, name):
+    """
+    The output path of a feature, the name appended to `out`.
+    """
+    basename, ext = os.path.splitext(out)
+    return '{}_{}{}'.format(basename, name, ext)
+
+
+def output_ext(ext):
+    """
+    The extension of the output file of an input file with extension `ext`.
+    """
+    return '.laz' if ext.lower() == las_io.MANIFEST_EXT else ext
+
+
+def clip_las(input_path, output_path, shp_path, srs, jobs=1,
+             max_memory=None, verbose=False, engine=False, attribute=None):
+    """
+    Clip a LAS/LAZ file or folder by the polygons in a shapefile. With
+    multiple polygons each input is read once, and an output is written
+    for each polygon, named by the input and the polygon's `attribute`.
+
+    Parameters
+    ----------
+    engine : bool
+        Clip in this process instead of running a PDAL pipeline per file.
+        Multiple polygons, and polygons too detailed to pass to PDAL on the
+        command line, are always clipped in this process.
+    attribute : str
+        The attribute to name the outputs of multiple polygons by.
+        (default: None, the feature id)
+
+    Files entirely outside the polygons are skipped and files entirely
+    inside a polygon are copied without testing the points, using the
+    header bounds of the files (stored in an index in the input folder).
+
+    Returns
+    -------
+    failed : list of Job
+        The files of a folder that failed. A single file that fails raises
+        its error.
+    """
+    input_path = os.path.abspath(input_path).replace('\\', '/')
+    output_path = os.path.abspath(output_path).replace('\\', '/')
+
+    names, geometries = read_features(shp_path, attribute)
+    if not geometries:
+        raise ValueError("The shapefile contains no features.")
+
+    if not engine and len(geometries) > 1:
+        engine = True
+    elif not engine:
+        wkt = geometries[0].ExportToWkt()
+        if len(wkt) > MAX_WKT_LENGTH:
+            if verbose:
+                print("Polygon WKT too long for the command line, clipping "
+                      "in this process..")
+            engine = True
+
+    polygons = [PreparedPolygon(geometry_rings(g)) for g in geometries]
+    path = os.path.dirname(os.path.realpath(__file__)).replace('\\', '/')
+
+    def clip_file(las, out, states):
+        if len(names) == 1:
+            outs = [out]
         else:
-            call_pdal(path, input_path, output_path, srs, wkt)
+            outs = [feature_output(out, name) for name in names]
+        for i, state in enumerate(states):
+            if state == INSIDE:
+                with metrics.stage('copy', file=las,
+                                   bytes=os.path.getsize(las)):
+                    copy_file(las, outs[i], srs)
+        partial = [i for i, state in enumerate(states) if state == BOUNDARY]
+        if not partial:
+            return
+        if engine:
+            with metrics.stage('clip', file=las,
+                               polygons=len(partial)) as record:
+                record['points'] = sum(clip_native(
+                    las, [outs[i] for i in partial], srs,
+                    PolygonIndex([polygons[i] for i in partial])))
+        else:
+            call_pdal(path, las, out, srs, wkt)
+
+    if os.path.isdir(input_path):
+        las_index = LasIndex(input_path)
+        batch_jobs = []
+        skipped = 0
+        copied = 0
+        for i, f in enumerate(las_index.names()):
+            las = os.path.join(input_path, f).replace('\\', '/')
+            bounds = las_index.bounds(f)
+            states = [p.box_state(bounds) for p in polygons]
+            if all(state == OUTSIDE for state in states):
+                skipped += 1
+                continue
+            if BOUNDARY not in states:
+                copied += 1
+
+            if os.path.isdir(output_path):
+                output_path = output_path + '/' if output_path[-1] != '/' else output_path
+                basename, ext = os.path.splitext(f)
+                out = '{}{}_clip{}'.format(output_path, basename,
+                                           output_ext(ext))
+            else:
+                basename, ext = os.path.splitext(output_path)
+                out = '{}_{}{}'.format(basename, i, ext)
+
+            job = Job(las, clip_file, las, out, states)
+            if engine or BOUNDARY not in states:
+                # the points are streamed, only a chunk is in memory
+                job.memory = min(job.memory, las_io.DEFAULT_CHUNK_SIZE *
+                                 MEMORY_PER_POINT)
+            batch_jobs.append(job)
+
+        if verbose:
+            print('{} files outside the polygons skipped, {} files inside '
+                  'copied, {} files clipped.'.format(
+                      skipped, copied, len(batch_jobs) - copied))
+        return run_batch(batch_jobs, jobs, max_memory, verbose)
+
+    if os.path.isdir(output_path):
+        output_path = output_path + '/' if output_path[-1] != '/' else output_path
+        basename, ext = os.path.splitext(os.path.basename(input_path))
+        out = '{}{}_clip{}'.format(output_path, basename,
+                                   output_ext(ext))
+    else:
+        out = output_path
+    bounds = las_io.read_bounds(input_path)[0]
+    bounds = [bounds[0], bounds[1], bounds[3], bounds[4]]
+    states = [p.box_state(bounds) for p in polygons]
+    if all(state == OUTSIDE for state in states):
+        print("{} is entirely outside the polygons, no output written.".format(
+            input_path))
+        return []
+    clip_file(input_path, out, states)
+    return []
 
 
 def argument_parser():
@@ -86,12 +292,37 @@ def argument_parser():
                                 help='The output clipped LAS/LAZ file or folder.',
                                 required=True)
     required_named.add_argument('-p', '--polygon',
-                                help='The path to the shapefile containing the polygon to clip to.',
+                                help='The path to the shapefile containing the polygon(s) to clip to.',
                                 required=True)
     parser.add_argument('-s', '--las_srs',
                         help='The spatial reference system of the LAS data. (Default: EPSG:28992)',
                         required=False,
                         default='EPSG:28992')
+    parser.add_argument('-a', '--attribute',
+                        help='The attribute to name the output of each polygon by, if the shapefile contains multiple polygons. (Default: the feature id)',
+                        required=False,
+                        default=None)
+    parser.add_argument('-j', '--jobs',
+                        help='The number of files to clip at the same time. (Default: 1)',
+                        type=int,
+                        required=False,
+                        default=1)
+    parser.add_argument('--max_memory',
+                        help='The memory in mb the files clipped at the same time may use together. (Default: 80%% of the available memory)',
+                        type=int,
+                        required=False,
+                        default=None)
+    parser.add_argument('-e', '--engine',
+                        help='Clip in this process instead of running a PDAL pipeline per file.',
+                        action='store_true',
+                        required=False,
+                        default=False)
+    parser.add_argument('-v', '--verbose',
+                        help='Print out the progress.',
+                        action='store_true',
+                        required=False,
+                        default=False)
+    metrics.add_arguments(parser)
 
     args = parser.parse_args()
     return args
@@ -99,7 +330,13 @@ def argument_parser():
 
 def main():
     args = argument_parser()
-    clip_las(args.input, args.output, args.polygon, args.las_srs)
+    max_memory = args.max_memory * 1048576 if args.max_memory else None
+    with metrics.from_args(args):
+        failed = clip_las(args.input, args.output, args.polygon,
+                          args.las_srs, args.jobs, max_memory, args.verbose,
+                          args.engine, args.attribute)
+    if failed:
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,443 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+@author: Chris Lucas
+
+Vectorized point-in-polygon tests for large, detailed polygons. The
+polygon is prepared once into a grid of cells, each listing the polygon
+edges passing through it, so testing a point only involves the few edges
+of its own cell instead of all edges of the polygon.
+"""
+
+import math
+import numpy as np
+
+# The version of the point-in-polygon tests, increase it when a change alters
+# which points are inside, so results stored with the old version are redone
+VERSION = 2
+
+# The number of grid cells per polygon edge
+CELLS_PER_EDGE = 4
+MAX_CELLS = 4000000
+# The heights of the reference points in their cells, as a fraction of the
+# cell height, in order of preference. The first one without vertices at
+# that height is used.
+REFERENCE_FRACTIONS = (0.5, 0.382, 0.618, 0.236, 0.764, 0.146, 0.854)
+
+OUTSIDE = 0
+INSIDE = 1
+BOUNDARY = 2
+
+
+def geometry_rings(geometry):
+    """
+    The rings of an OGR (multi)polygon geometry.
+
+    Returns
+    -------
+    rings : list of array
+        The (n, 2) coordinates of the exterior and interior rings.
+    """
+    from osgeo import ogr
+
+    if geometry.HasCurveGeometry():
+        geometry = geometry.GetLinearGeometry()
+
+    geometry_type = ogr.GT_Flatten(geometry.GetGeometryType())
+    if geometry_type == ogr.wkbPolygon:
+        polygons = [geometry]
+    elif geometry_type == ogr.wkbMultiPolygon:
+        polygons = [geometry.GetGeometryRef(i)
+                    for i in range(geometry.GetGeometryCount())]
+    else:
+        raise ValueError("Geometry type {} is not a polygon.".format(
+            geometry.GetGeometryName()))
+
+    rings = []
+    for polygon in polygons:
+        for i in range(polygon.GetGeometryCount()):
+            points = polygon.GetGeometryRef(i).GetPoints()
+            if points:
+                rings.append(np.array(points)[:, :2])
+    return rings
+
+
+def segments_intersect_box(ax, ay, bx, by, bbox):
+    """
+    Whether line segments a-b intersect an axis-aligned box, by clipping
+    them to the box (Liang-Barsky).
+    """
+    dx = bx - ax
+    dy = by - ay
+    t0 = np.zeros(len(ax))
+    t1 = np.ones(len(ax))
+    hit = np.ones(len(ax), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for p, q in ((-dx, ax - bbox[0]), (dx, bbox[2] - ax),
+                     (-dy, ay - bbox[1]), (dy, bbox[3] - ay)):
+            parallel = p == 0
+            hit &= ~(parallel & (q < 0))
+            t = q / p
+            t0 = np.where(~parallel & (p < 0), np.maximum(t0, t), t0)
+            t1 = np.where(~parallel & (p > 0), np.minimum(t1, t), t1)
+    return hit & (t0 <= t1)
+
+
+class PreparedPolygon(object):
+    """
+    A polygon (possibly with holes, or consisting of multiple parts)
+    prepared for fast point-in-polygon tests.
+
+    The bounding box of the polygon is divided in a grid. Cells without
+    edges are entirely inside or outside the polygon, so points in them are
+    classified directly. For a point in a cell with edges, the crossings of
+    the segment from a reference point in the cell (of which it is known
+    whether it is inside) to the point with the edges of that cell are
+    counted.
+
+    Parameters
+    ----------
+    rings : list of array
+        The (n, 2) coordinates of the rings of the polygon. Points are
+        inside if they are inside an odd number of rings.
+    """
+
+    def __init__(self, rings):
+        starts = []
+        ends = []
+        for ring in rings:
+            ring = np.asarray(ring, dtype=np.float64)[:, :2]
+            if len(ring) < 2:
+                continue
+            starts.append(ring)
+            ends.append(np.roll(ring, -1, axis=0))
+        if not starts:
+            raise ValueError("The polygon has no rings.")
+        a = np.concatenate(starts)
+        b = np.concatenate(ends)
+        keep = np.any(a != b, axis=1)
+        self.ax, self.ay = a[keep, 0], a[keep, 1]
+        self.bx, self.by = b[keep, 0], b[keep, 1]
+
+        self.bbox = [float(min(self.ax.min(), self.bx.min())),
+                     float(min(self.ay.min(), self.by.min())),
+                     float(max(self.ax.max(), self.bx.max())),
+                     float(max(self.ay.max(), self.by.max()))]
+        self._build_grid()
+
+    def _build_grid(self):
+        xmin, ymin, xmax, ymax = self.bbox
+        width = max(xmax - xmin, 1e-9)
+        height = max(ymax - ymin, 1e-9)
+        cells = min(MAX_CELLS, max(1, CELLS_PER_EDGE * len(self.ax)))
+        self.nx = max(1, int(math.ceil(math.sqrt(cells * width / height))))
+        self.ny = max(1, int(math.ceil(cells / self.nx)))
+        self.dx = width / self.nx
+        self.dy = height / self.ny
+
+        # Split the edges in pieces spanning at most one cell in each
+        # direction, and add the edge to all cells overlapping the
+        # (slightly padded) bounding box of each piece. Rounding can make a
+        # piece touch a third cell, so the cells are not limited to 2x2.
+        ex = self.bx - self.ax
+        ey = self.by - self.ay
+        pieces = np.maximum(1, np.ceil(np.maximum(
+            np.abs(ex) / self.dx, np.abs(ey) / self.dy))).astype(np.intp)
+        edge = np.repeat(np.arange(len(pieces)), pieces)
+        first = np.repeat(np.cumsum(pieces) - pieces, pieces)
+        k = np.arange(len(edge)) - first
+        t0 = k / pieces[edge]
+        t1 = (k + 1) / pieces[edge]
+        px0 = self.ax[edge] + ex[edge] * t0
+        px1 = self.ax[edge] + ex[edge] * t1
+        py0 = self.ay[edge] + ey[edge] * t0
+        py1 = self.ay[edge] + ey[edge] * t1
+
+        pad_x = self.dx * 1e-6
+        pad_y = self.dy * 1e-6
+        ix0 = self._col(np.minimum(px0, px1) - pad_x)
+        ix1 = self._col(np.maximum(px0, px1) + pad_x)
+        iy0 = self._row(np.minimum(py0, py1) - pad_y)
+        iy1 = self._row(np.maximum(py0, py1) + pad_y)
+        cols = ix1 - ix0 + 1
+        counts = cols * (iy1 - iy0 + 1)
+        piece = np.repeat(np.arange(len(edge)), counts)
+        k = np.arange(len(piece)) - np.repeat(np.cumsum(counts) - counts,
+                                              counts)
+        cells = ((iy0[piece] + k // cols[piece]) * self.nx +
+                 ix0[piece] + k % cols[piece])
+        pairs = np.unique(cells * len(self.ax) + edge[piece])
+        cells = pairs // len(self.ax)
+        self.cell_edges = pairs % len(self.ax)
+        counts = np.bincount(cells, minlength=self.nx * self.ny)
+        self.cell_start = np.concatenate([[0], np.cumsum(counts)])
+
+        self._reference_points()
+        self.cell_state = np.where(self.reference_inside, INSIDE,
+                                   OUTSIDE).astype(np.int8)
+        self.cell_state[counts > 0] = BOUNDARY
+
+    def _col(self, X):
+        col = ((X - self.bbox[0]) // self.dx).astype(np.intp)
+        return np.clip(col, 0, self.nx - 1)
+
+    def _row(self, Y):
+        row = ((Y - self.bbox[1]) // self.dy).astype(np.intp)
+        return np.clip(row, 0, self.ny - 1)
+
+    def _reference_points(self):
+        """
+        Choose a reference point in each cell, not on an edge, and test
+        whether it is inside the polygon, by casting a ray along each row
+        of reference points and counting the edge crossings left of each
+        point.
+
+        The ray of a row is at a height without vertices, so no edge lies
+        along it. In each cell the reference point is the middle of the
+        widest gap between the crossings and the cell sides, so it is never
+        on an edge, which would make the crossings counted from it in
+        `contains` ambiguous.
+        """
+        xmin, ymin = self.bbox[0], self.bbox[1]
+        # The height of the ray in each row, as a fraction of the row height
+        fraction = np.full(self.ny, np.nan)
+        for f in REFERENCE_FRACTIONS:
+            row = np.round((self.ay - ymin) / self.dy - f)
+            distance = np.abs(self.ay - ymin - (row + f) * self.dy)
+            row = row[distance < self.dy * 1e-6].astype(np.intp)
+            free = np.isnan(fraction)
+            free[row[(row >= 0) & (row < self.ny)]] = False
+            fraction[free] = f
+        fraction[np.isnan(fraction)] = REFERENCE_FRACTIONS[0]
+        self.reference_y = ymin + (np.arange(self.ny) + fraction) * self.dy
+
+        row0 = self._row(np.minimum(self.ay, self.by))
+        row1 = self._row(np.maximum(self.ay, self.by))
+        counts = row1 - row0 + 1
+        edge = np.repeat(np.arange(len(counts)), counts)
+        row = (row0[edge] + np.arange(len(edge)) -
+               np.repeat(np.cumsum(counts) - counts, counts))
+        yr = self.reference_y[row]
+        crosses = (self.ay[edge] > yr) != (self.by[edge] > yr)
+        edge, row, yr = edge[crosses], row[crosses], yr[crosses]
+        x = self.ax[edge] + ((yr - self.ay[edge]) /
+                             (self.by[edge] - self.ay[edge]) *
+                             (self.bx[edge] - self.ax[edge]))
+
+        order = np.lexsort((x, row))
+        x, row = x[order], row[order]
+        row_start = np.searchsorted(row, np.arange(self.ny + 1))
+        sides = xmin + np.arange(self.nx + 1) * self.dx
+        sides[-1] = self.bbox[2]
+        reference_x = np.empty((self.ny, self.nx))
+        reference_x[:] = (sides[:-1] + sides[1:]) / 2
+        inside = np.zeros((self.ny, self.nx), dtype=bool)
+        for r in range(self.ny):
+            x_row = x[row_start[r]:row_start[r+1]]
+            if len(x_row) == 0:
+                continue
+            # The gaps between the crossings and the cell sides, the widest
+            # gap of each cell holds its reference point
+            limits = np.sort(np.concatenate(
+                [sides, np.clip(x_row, sides[0], sides[-1])]))
+            middle = (limits[:-1] + limits[1:]) / 2
+            width = limits[1:] - limits[:-1]
+            col = np.clip(np.searchsorted(sides, middle, side='right') - 1,
+                          0, self.nx - 1)
+            order = np.lexsort((width, col))
+            widest = order[np.searchsorted(col[order], np.arange(self.nx),
+                                           side='right') - 1]
+            reference_x[r] = middle[widest]
+            inside[r] = np.searchsorted(x_row, middle[widest]) % 2 == 1
+        self.reference_x = reference_x.ravel()
+        self.reference_inside = inside.ravel()
+
+    def box_state(self, bbox):
+        """
+        Whether a bounding box is entirely outside, entirely inside or
+        partly inside the polygon. Only the edges in the grid cells
+        overlapping the box are tested for intersection with the box; if
+        none intersects it, the box is on one side of the boundary.
+
+        Parameters
+        ----------
+        bbox : list of float
+            [xmin, ymin, xmax, ymax]
+
+        Returns
+        -------
+        state : int
+            OUTSIDE, INSIDE or BOUNDARY.
+        """
+        if (bbox[2] < self.bbox[0] or bbox[0] > self.bbox[2] or
+                bbox[3] < self.bbox[1] or bbox[1] > self.bbox[3]):
+            return OUTSIDE
+        c0, c1 = self._col(np.array([bbox[0], bbox[2]]))
+        r0, r1 = self._row(np.array([bbox[1], bbox[3]]))
+        cells = (np.arange(r0, r1 + 1)[:, np.newaxis] * self.nx +
+                 np.arange(c0, c1 + 1)).ravel()
+        cells = cells[self.cell_state[cells] == BOUNDARY]
+        if len(cells):
+            edge = np.unique(np.concatenate(
+                [self.cell_edges[self.cell_start[c]:self.cell_start[c+1]]
+                 for c in cells]))
+            if np.any(segments_intersect_box(
+                    self.ax[edge], self.ay[edge], self.bx[edge],
+                    self.by[edge], bbox)):
+                return BOUNDARY
+        center_inside = self.contains([(bbox[0] + bbox[2]) / 2],
+                                      [(bbox[1] + bbox[3]) / 2])[0]
+        return INSIDE if center_inside else OUTSIDE
+
+    def contains(self, X, Y):
+        """
+        Test which points are inside the polygon.
+
+        Parameters
+        ----------
+        X, Y : array
+            The coordinates of the points.
+
+        Returns
+        -------
+        inside : array of bool
+        """
+        X = np.asarray(X, dtype=np.float64)
+        Y = np.asarray(Y, dtype=np.float64)
+        inside = np.zeros(len(X), dtype=bool)
+
+        candidates = np.flatnonzero((X >= self.bbox[0]) &
+                                    (X <= self.bbox[2]) &
+                                    (Y >= self.bbox[1]) &
+                                    (Y <= self.bbox[3]))
+        if len(candidates) == 0:
+            return inside
+        cX = X[candidates]
+        cY = Y[candidates]
+        cell = self._row(cY) * self.nx + self._col(cX)
+        state = self.cell_state[cell]
+        inside[candidates[state == INSIDE]] = True
+
+        boundary = np.flatnonzero(state == BOUNDARY)
+        if len(boundary) == 0:
+            return inside
+        cell = cell[boundary]
+        px = cX[boundary]
+        py = cY[boundary]
+        cx = self.reference_x[cell]
+        cy = self.reference_y[cell // self.nx]
+
+        counts = self.cell_start[cell + 1] - self.cell_start[cell]
+        point = np.repeat(np.arange(len(cell)), counts)
+        edge = self.cell_edges[
+            np.repeat(self.cell_start[cell], counts) + np.arange(len(point)) -
+            np.repeat(np.cumsum(counts) - counts, counts)]
+
+        ax, ay = self.ax[edge], self.ay[edge]
+        bx, by = self.bx[edge], self.by[edge]
+        qx, qy = cx[point], cy[point]
+        rx, ry = px[point], py[point]
+        # The segment from the reference point q to the point r crosses the
+        # edge a-b if q and r are on either side of the edge and vice
+        # versa. A segment through a vertex only counts the edge with its
+        # other vertex on the positive side, so it counts once when passing
+        # the boundary and zero or two times when touching it.
+        side_q = (bx - ax) * (qy - ay) - (by - ay) * (qx - ax)
+        side_r = (bx - ax) * (ry - ay) - (by - ay) * (rx - ax)
+        side_a = (rx - qx) * (ay - qy) - (ry - qy) * (ax - qx)
+        side_b = (rx - qx) * (by - qy) - (ry - qy) * (bx - qx)
+        crossing = ((side_q > 0) != (side_r > 0)) & ((side_a > 0) != (side_b > 0))
+
+        parity = np.bincount(point[crossing], minlength=len(cell)) % 2 == 1
+        inside[candidates[boundary]] = (self.reference_inside[cell] !=
+                                       parity)
+        return inside
+
+
+class PolygonIndex(object):
+    """
+    A grid index over many polygons, to find the polygons each point is
+    in. A point can be in multiple (overlapping) polygons.
+
+    Parameters
+    ----------
+    polygons : list of PreparedPolygon
+        The polygons to index.
+    cell_size : float
+        The size of the grid cells. (default: None, the median size of the
+        polygon bounding boxes)
+    """
+
+    def __init__(self, polygons, cell_size=None):
+        self.polygons = polygons
+        self.bboxes = np.array([p.bbox for p in polygons])
+        self.bbox = [float(self.bboxes[:, 0].min()),
+                     float(self.bboxes[:, 1].min()),
+                     float(self.bboxes[:, 2].max()),
+                     float(self.bboxes[:, 3].max())]
+        width = max(self.bbox[2] - self.bbox[0], 1e-9)
+        height = max(self.bbox[3] - self.bbox[1], 1e-9)
+        if cell_size is None:
+            cell_size = float(np.median(np.maximum(
+                self.bboxes[:, 2] - self.bboxes[:, 0],
+                self.bboxes[:, 3] - self.bboxes[:, 1])))
+        cell_size = max(cell_size, math.sqrt(width * height / MAX_CELLS),
+                        1e-9)
+        self.cell_size = cell_size
+        self.nx = int(width // cell_size) + 1
+        self.ny = int(height // cell_size) + 1
+
+        self.cols = np.clip(((self.bboxes[:, [0, 2]] - self.bbox[0]) //
+                             cell_size).astype(np.intp), 0, self.nx - 1)
+        self.rows = np.clip(((self.bboxes[:, [1, 3]] - self.bbox[1]) //
+                             cell_size).astype(np.intp), 0, self.ny - 1)
+
+    def query(self, X, Y):
+        """
+        Find the points inside each polygon.
+
+        Parameters
+        ----------
+        X, Y : array
+            The coordinates of the points.
+
+        Yields
+        ------
+        polygon : int
+            The index of the polygon.
+        points : array of int
+            The indices of the points inside the polygon.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        Y = np.asarray(Y, dtype=np.float64)
+        if len(X) == 0:
+            return
+        xmin, xmax = X.min(), X.max()
+        ymin, ymax = Y.min(), Y.max()
+        candidates = np.flatnonzero((self.bboxes[:, 0] <= xmax) &
+                                    (self.bboxes[:, 2] >= xmin) &
+                                    (self.bboxes[:, 1] <= ymax) &
+                                    (self.bboxes[:, 3] >= ymin))
+        if len(candidates) == 0:
+            return
+
+        col = ((X - self.bbox[0]) // self.cell_size)
+        row = ((Y - self.bbox[1]) // self.cell_size)
+        cell = np.where((col >= 0) & (col < self.nx) &
+                        (row >= 0) & (row < self.ny),
+                        row * self.nx + col, -1).astype(np.intp)
+        order = np.argsort(cell, kind='stable')
+        cell = cell[order]
+
+        for i in candidates:
+            (c0, c1), (r0, r1) = self.cols[i], self.rows[i]
+            starts = np.arange(r0, r1 + 1) * self.nx + c0
+            lo = np.searchsorted(cell, starts)
+            hi = np.searchsorted(cell, starts + (c1 - c0), side='right')
+            points = np.concatenate([order[a:b] for a, b in zip(lo, hi)])
+            if len(points) == 0:
+                continue
+            inside = self.polygons[i].contains(X[points], Y[points])
+            if inside.any():
+                yield i, np.sort(points[inside])
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+@author: Chris Lucas
+
+Tests of the skip, copy and clip decisions of las_clip.py, clipping files
+entirely outside, entirely inside and partly inside an L-shaped polygon.
+Run with pytest, requires GDAL.
+"""
+
+import os
+import numpy as np
+import pytest
+import laspy
+
+pytest.importorskip('osgeo')
+from osgeo import ogr  # noqa: E402
+import las_clip  # noqa: E402
+
+from test_point_in_polygon import L_SHAPE, brute_force_contains  # noqa: E402
+
+# Not a multiple of the 1 mm precision of the points, so no point is exactly
+# on an edge
+SCALE = 10.0001
+
+
+def write_polygon(path, rings):
+    driver = ogr.GetDriverByName('ESRI Shapefile')
+    source = driver.CreateDataSource(path)
+    layer = source.CreateLayer('polygon', None, ogr.wkbPolygon)
+    polygon = ogr.Geometry(ogr.wkbPolygon)
+    for coordinates in rings:
+        ring = ogr.Geometry(ogr.wkbLinearRing)
+        for x, y in list(coordinates) + [coordinates[0]]:
+            ring.AddPoint_2D(float(x), float(y))
+        polygon.AddGeometry(ring)
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(polygon)
+    layer.CreateFeature(feature)
+    source = None
+
+
+def write_las(path, bbox, n=10000, seed=0):
+    rng = np.random.default_rng(seed)
+    header = laspy.LasHeader(point_format=1, version='1.2')
+    header.scales = [0.001, 0.001, 0.001]
+    header.offsets = [0, 0, 0]
+    las = laspy.LasData(header)
+    las.x = rng.uniform(bbox[0], bbox[2], n)
+    las.y = rng.uniform(bbox[1], bbox[3], n)
+    las.z = rng.uniform(0, 10, n)
+    las.write(path)
+
+
+@pytest.fixture
+def polygon(tmp_path):
+    rings = [ring * SCALE for ring in L_SHAPE]
+    path = str(tmp_path / 'polygon.shp')
+    write_polygon(path, rings)
+    return path, rings
+
+
+def clip(tmp_path, polygon, bbox):
+    las = str(tmp_path / 'input.las')
+    out = str(tmp_path / 'output.las')
+    write_las(las, bbox)
+    las_clip.clip_las(las, out, polygon[0], None, engine=True)
+    return las, out
+
+
+def test_outside_skipped(tmp_path, polygon, capsys):
+    # in the notch of the L, inside its bounding box
+    las, out = clip(tmp_path, polygon, [60, 60, 90, 90])
+    assert not os.path.exists(out)
+    assert 'entirely outside' in capsys.readouterr().out
+
+
+def test_inside_copied(tmp_path, polygon):
+    las, out = clip(tmp_path, polygon, [5, 5, 35, 95])
+    with open(las, 'rb') as f1, open(out, 'rb') as f2:
+        assert f1.read() == f2.read()
+
+
+def test_boundary_clipped(tmp_path, polygon):
+    las, out = clip(tmp_path, polygon, [20, 20, 80, 80])
+    points = laspy.read(las)
+    expected = brute_force_contains(polygon[1], np.asarray(points.x),
+                                    np.asarray(points.y))
+    assert laspy.read(out).header.point_count == np.count_nonzero(expected)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+@author: Chris Lucas
+
+Tests of the point-in-polygon module against a brute-force even-odd test
+of all edges. Run with pytest.
+"""
+
+import numpy as np
+
+from point_in_polygon import (PreparedPolygon, PolygonIndex, OUTSIDE,
+                              INSIDE, BOUNDARY)
+
+L_SHAPE = [np.array([[0, 0], [10, 0], [10, 4], [4, 4], [4, 10], [0, 10]],
+                    dtype=float)]
+SQUARE_WITH_HOLES = [
+    np.array([[0, 0], [20, 0], [20, 20], [0, 20]], dtype=float),
+    np.array([[2, 2], [8, 2], [5, 8]], dtype=float),
+    np.array([[10, 10], [18, 10], [18, 18], [10, 18]], dtype=float),
+]
+
+
+def brute_force_contains(rings, X, Y):
+    """
+    Even-odd test of the points against all edges of the rings.
+    """
+    inside = np.zeros(len(X), dtype=bool)
+    for ring in rings:
+        ring = np.asarray(ring, dtype=float)
+        for (x1, y1), (x2, y2) in zip(ring, np.roll(ring, -1, axis=0)):
+            crosses = (y1 > Y) != (y2 > Y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x = x1 + (Y - y1) * (x2 - x1) / (y2 - y1)
+            inside ^= crosses & (X < x)
+    return inside
+
+
+def random_points(rings, n, rng):
+    """
+    Random points in the bounding box of the rings, with a margin.
+    """
+    coordinates = np.concatenate(rings)
+    xmin, ymin = coordinates.min(axis=0) - 1
+    xmax, ymax = coordinates.max(axis=0) + 1
+    return rng.uniform(xmin, xmax, n), rng.uniform(ymin, ymax, n)
+
+
+def assert_matches_brute_force(rings, X, Y):
+    inside = PreparedPolygon(rings).contains(X, Y)
+    expected = brute_force_contains(rings, X, Y)
+    assert np.count_nonzero(inside != expected) == 0
+
+
+def test_random_triangles():
+    rng = np.random.default_rng(0)
+    for _ in range(200):
+        rings = [rng.uniform(0, 100, (3, 2))]
+        assert_matches_brute_force(rings, *random_points(rings, 5000, rng))
+
+
+def test_triangle_diagonal_through_center():
+    # the diagonal passes through the center of the bounding box and of
+    # cells of the grid
+    rings = [np.array([[0, 0], [10, 0], [0, 10]], dtype=float)]
+    rng = np.random.default_rng(1)
+    assert_matches_brute_force(rings, *random_points(rings, 100000, rng))
+
+
+def test_l_shape():
+    rng = np.random.default_rng(2)
+    assert_matches_brute_force(L_SHAPE, *random_points(L_SHAPE, 200000, rng))
+
+
+def test_holes():
+    rng = np.random.default_rng(3)
+    assert_matches_brute_force(SQUARE_WITH_HOLES,
+                               *random_points(SQUARE_WITH_HOLES, 200000, rng))
+
+
+def test_random_star_polygons():
+    rng = np.random.default_rng(4)
+    for _ in range(50):
+        n = rng.integers(3, 300)
+        angle = np.sort(rng.uniform(0, 2 * np.pi, n))
+        radius = rng.uniform(1, 10, n)
+        rings = [np.column_stack([radius * np.cos(angle),
+                                  radius * np.sin(angle)])]
+        assert_matches_brute_force(rings, *random_points(rings, 20000, rng))
+
+
+def test_axis_aligned_edges_through_cell_centers():
+    # vertices on whole coordinates, tested on a grid of points between
+    # them, so edges and points line up with the cell centers
+    rings = [np.array([[0, 0], [8, 0], [8, 3], [5, 3], [5, 6], [2, 6],
+                       [2, 9], [0, 9]], dtype=float)]
+    X, Y = np.meshgrid(np.arange(-1, 10, 0.25) + 0.125,
+                       np.arange(-1, 10, 0.25) + 0.125)
+    assert_matches_brute_force(rings, X.ravel(), Y.ravel())
+
+
+def test_box_state_outside():
+    l_shape = PreparedPolygon(L_SHAPE)
+    # beyond the bounding box, and in the notch of the L
+    assert l_shape.box_state([11, 0, 12, 3]) == OUTSIDE
+    assert l_shape.box_state([6, 6, 9, 9]) == OUTSIDE
+    # in a hole
+    holes = PreparedPolygon(SQUARE_WITH_HOLES)
+    assert holes.box_state([11, 11, 17, 17]) == OUTSIDE
+
+
+def test_box_state_inside():
+    assert PreparedPolygon(L_SHAPE).box_state([0.5, 0.5, 3.5, 9.5]) == INSIDE
+    # between the holes
+    holes = PreparedPolygon(SQUARE_WITH_HOLES)
+    assert holes.box_state([0.5, 12, 9, 19]) == INSIDE
+
+
+def test_box_state_boundary():
+    assert PreparedPolygon(L_SHAPE).box_state([3, 3, 6, 6]) == BOUNDARY
+    # around a hole
+    holes = PreparedPolygon(SQUARE_WITH_HOLES)
+    assert holes.box_state([9, 9, 19, 19]) == BOUNDARY
+
+
+def test_box_state_random_boxes():
+    # the state must agree with points sampled in the box
+    rng = np.random.default_rng(6)
+    for rings in [L_SHAPE, SQUARE_WITH_HOLES,
+                  [np.array([[0, 0], [10, 0], [0, 10]], dtype=float)]]:
+        polygon = PreparedPolygon(rings)
+        for _ in range(300):
+            x, y = rng.uniform(-2, 22, 2)
+            width, height = rng.uniform(0.1, 8, 2)
+            bbox = [x, y, x + width, y + height]
+            X = rng.uniform(bbox[0], bbox[2], 500)
+            Y = rng.uniform(bbox[1], bbox[3], 500)
+            inside = brute_force_contains(rings, X, Y)
+            state = polygon.box_state(bbox)
+            if state == INSIDE:
+                assert inside.all()
+            elif state == OUTSIDE:
+                assert not inside.any()
+            else:
+                assert state == BOUNDARY
+            if inside.any() and not inside.all():
+                assert state == BOUNDARY
+
+
+def test_polygon_index():
+    # overlapping triangles, L-shapes and polygons with holes
+    rng = np.random.default_rng(5)
+    polygons = []
+    for i in range(60):
+        offset = rng.uniform(0, 100, 2)
+        if i % 3 == 0:
+            rings = [offset + rng.uniform(0, 20, (3, 2))]
+        elif i % 3 == 1:
+            rings = [offset + ring for ring in L_SHAPE]
+        else:
+            rings = [offset + ring / 2 for ring in SQUARE_WITH_HOLES]
+        polygons.append(rings)
+    index = PolygonIndex([PreparedPolygon(rings) for rings in polygons])
+    X = rng.uniform(-10, 130, 200000)
+    Y = rng.uniform(-10, 130, 200000)
+
+    found = dict(index.query(X, Y))
+    for i, rings in enumerate(polygons):
+        expected = np.flatnonzero(brute_force_contains(rings, X, Y))
+        assert np.array_equal(found.get(i, np.array([], dtype=np.intp)),
+                              expected)
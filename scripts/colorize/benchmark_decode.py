@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+@author: Chris Lucas
+
+Benchmark requesting and decoding WMS images: the bytes transferred per
+km² and the wall time of each image format, and the decode time of the
+Pillow and matplotlib decoders.
+"""
+
+import time
+import argparse
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pdal_colorize
+
+
+def to_uint8(img):
+    """
+    Convert an image decoded by matplotlib to 8 bit RGB.
+    """
+    if img.ndim == 2:
+        img = img[:, :, np.newaxis].repeat(3, axis=2)
+    img = img[:, :, :3]
+    if img.dtype != np.uint8:
+        img = (np.clip(img, 0, 1) * 255 + 0.5).astype(np.uint8)
+    return img
+
+
+def decode_matplotlib(data):
+    """
+    The decoding as done before the Pillow decoder, to float and back to
+    8 bit RGB. matplotlib reads a buffer as PNG unless told otherwise.
+    """
+    import matplotlib.image as mpimg
+    img_format = 'jpeg' if data[:2] == b'\xff\xd8' else 'png'
+    return to_uint8(mpimg.imread(BytesIO(data), format=img_format))
+
+
+DECODERS = {'pillow': pdal_colorize.decode_image,
+            'matplotlib': decode_matplotlib}
+
+
+def fetch_cells(bbox, wms, wms_format, cell_pixels):
+    """
+    Request the cells of `cell_pixels` pixels covering a bbox.
+
+    Returns
+    -------
+    data : list of bytes
+        The encoded images.
+    elapsed : float
+        The wall time in seconds.
+    """
+    ppm = int(wms['wms_ppm'])
+    length = cell_pixels / ppm
+    col_min, col_max, row_min, row_max = pdal_colorize.grid_range(
+        bbox, length, length, bbox[:2])
+    cells = [pdal_colorize.grid_cell(col, row, length, length, bbox[:2])
+             for col in range(col_min, col_max+1)
+             for row in range(row_min, row_max+1)]
+
+    concurrency = int(wms['wms_concurrency'])
+    client = pdal_colorize.wms_client(wms)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        data = list(executor.map(
+            lambda cell: pdal_colorize.request_data(
+                cell, (cell_pixels, cell_pixels), wms['wms_url'],
+                wms['wms_layer'], wms['wms_srs'], wms['wms_version'],
+                wms_format, pdal_colorize.RETRIES, client=client), cells))
+    return data, time.time() - start
+
+
+def run_benchmark(bbox, wms, formats, decoders):
+    """
+    Request the bbox in each format and decode the images with each
+    decoder.
+
+    Returns
+    -------
+    results : list of dict
+    """
+    area = (bbox[2]-bbox[0]) * (bbox[3]-bbox[1]) / 1e6
+    cell_pixels = min(pdal_colorize.max_image_size(wms),
+                      pdal_colorize.CACHE_CELL_PIXELS)
+
+    results = []
+    for wms_format in formats:
+        data, fetch_time = fetch_cells(bbox, wms, wms_format, cell_pixels)
+        size = sum(len(d) for d in data)
+        for decoder in decoders:
+            start = time.time()
+            for d in data:
+                DECODERS[decoder](d)
+            decode_time = time.time() - start
+            results.append({'format': wms_format,
+                            'decoder': decoder,
+                            'cells': len(data),
+                            'fetch_time': fetch_time,
+                            'decode_time': decode_time,
+                            'time': fetch_time + decode_time,
+                            'mb': size / 1048576,
+                            'mb_per_km2': size / 1048576 / area})
+    return results
+
+
+def argument_parser():
+    """
+    Define and return the arguments.
+    """
+    description = "Benchmark requesting and decoding WMS images."
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-b', '--bbox',
+                        help='The area to request: xmin ymin xmax ymax. '
+                             '(default: 1 km² in Amsterdam)',
+                        type=float,
+                        nargs=4,
+                        required=False,
+                        default=[121000, 487000, 122000, 488000])
+    parser.add_argument('-u', '--wms_url',
+                        help='The url of the WMS service to use. (str, default: https://geodata.nationaalgeoregister.nl/luchtfoto/rgb/wms?)',
+                        required=False,
+                        default='https://geodata.nationaalgeoregister.nl/luchtfoto/rgb/wms?')
+    parser.add_argument('-l', '--wms_layer',
+                        help='The layer of the WMS service to use. (str, default: Actueel_ortho25)',
+                        required=False,
+                        default='Actueel_ortho25')
+    parser.add_argument('-r', '--wms_srs',
+                        help='The spatial reference system of the WMS data to request. (str, default: EPSG:28992)',
+                        required=False,
+                        default='EPSG:28992')
+    parser.add_argument('-v', '--wms_version',
+                        help='The version number of the WMS service. (str, default: 1.3.0)',
+                        required=False,
+                        default='1.3.0')
+    parser.add_argument('-p', '--wms_ppm',
+                        help='The approximate desired pixels per meter of the image. (int, default: 4)',
+                        type=int,
+                        required=False,
+                        default=4)
+    parser.add_argument('-c', '--wms_concurrency',
+                        help='The maximum number of simultaneous WMS requests. (int, default: 4)',
+                        type=int,
+                        required=False,
+                        default=pdal_colorize.DEFAULT_CONCURRENCY)
+    parser.add_argument('-f', '--formats',
+                        help='The image formats to benchmark. '
+                             '(default: image/png image/jpeg)',
+                        nargs='+',
+                        required=False,
+                        default=['image/png', 'image/jpeg'])
+    parser.add_argument('-d', '--decoders',
+                        help='The decoders to benchmark. (default: all)',
+                        nargs='+',
+                        choices=sorted(DECODERS),
+                        required=False,
+                        default=['pillow', 'matplotlib'])
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = argument_parser()
+    wms = {'wms_url': args.wms_url,
+           'wms_layer': args.wms_layer,
+           'wms_srs': args.wms_srs,
+           'wms_version': args.wms_version,
+           'wms_ppm': args.wms_ppm,
+           'wms_concurrency': args.wms_concurrency}
+    results = run_benchmark(args.bbox, wms, args.formats, args.decoders)
+
+    print('{:<12}{:<12}{:>7}{:>11}{:>12}{:>10}{:>10}{:>10}'.format(
+        'format', 'decoder', 'cells', 'fetch (s)', 'decode (s)', 'time (s)',
+        'mb', 'mb/km²'))
+    for r in results:
+        print('{:<12}{:<12}{:>7}{:>11.2f}{:>12.2f}{:>10.2f}{:>10.1f}'
+              '{:>10.1f}'.format(r['format'], r['decoder'], r['cells'],
+                                 r['fetch_time'], r['decode_time'],
+                                 r['time'], r['mb'], r['mb_per_km2']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+@author: Chris Lucas
+
+Benchmark sampling point colors from an image: the previous full-array
+implementation against the chunked nearest and bilinear kernels.
+"""
+
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import pdal_colorize
+
+
+def sample_legacy(img, X, Y):
+    """
+    The sampling as done before the chunked kernel, with Python builtin
+    min/max and full-length temporaries.
+    """
+    [xmin, ymin, xmax, ymax] = [min(X), min(Y), max(X), max(Y)]
+    img_size = img.shape[:2]
+    x_img = np.round(((X - xmin) / (xmax-xmin)) *
+                     (img_size[1]-1)).astype(int)
+    y_img = np.round(((ymax - Y) / (ymax-ymin)) *
+                     (img_size[0]-1)).astype(int)
+    rgb = img[y_img, x_img]
+    return (np.array(rgb[:, 0], dtype=np.uint16),
+            np.array(rgb[:, 1], dtype=np.uint16),
+            np.array(rgb[:, 2], dtype=np.uint16))
+
+
+def sample_nearest(img, X, Y):
+    return pdal_colorize.sample_image(img, pdal_colorize.point_bbox(X, Y),
+                                      X, Y, method='nearest')
+
+
+def sample_bilinear(img, X, Y):
+    return pdal_colorize.sample_image(img, pdal_colorize.point_bbox(X, Y),
+                                      X, Y, method='bilinear')
+
+
+METHODS = {'legacy': sample_legacy,
+           'nearest': sample_nearest,
+           'bilinear': sample_bilinear}
+
+
+def run_benchmark(point_counts, methods, ppm=4, tile_size=1000, seed=0):
+    """
+    Time each sampling method on random points in a tile, measuring the
+    peak memory allocated on top of the input with tracemalloc.
+
+    Returns
+    -------
+    results : list of dict
+    """
+    rng = np.random.default_rng(seed)
+    pixels = int(tile_size * ppm)
+    img = rng.integers(0, 256, (pixels, pixels, 3), dtype=np.uint8)
+
+    results = []
+    for n in point_counts:
+        X = rng.uniform(0, tile_size, n)
+        Y = rng.uniform(0, tile_size, n)
+        for method in methods:
+            tracemalloc.start()
+            start = time.time()
+            METHODS[method](img, X, Y)
+            elapsed = time.time() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results.append({'method': method,
+                            'points': n,
+                            'time': elapsed,
+                            'points_per_second': n / elapsed,
+                            'peak_memory': peak / 1048576})
+        del X, Y
+    return results
+
+
+def argument_parser():
+    """
+    Define and return the arguments.
+    """
+    description = "Benchmark sampling point colors from an image."
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-n', '--points',
+                        help='The point counts to benchmark. '
+                             '(default: 10000000 50000000)',
+                        type=int,
+                        nargs='+',
+                        required=False,
+                        default=[10000000, 50000000])
+    parser.add_argument('-m', '--methods',
+                        help='The sampling methods to benchmark. '
+                             '(default: all)',
+                        nargs='+',
+                        choices=sorted(METHODS),
+                        required=False,
+                        default=['legacy', 'nearest', 'bilinear'])
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = argument_parser()
+    results = run_benchmark(args.points, args.methods)
+
+    print('{:<10}{:>12}{:>10}{:>14}{:>16}'.format(
+        'method', 'points', 'time (s)', 'points/s', 'peak mem (mb)'))
+    for r in results:
+        print('{:<10}{:>12}{:>10.2f}{:>14.0f}{:>16.1f}'.format(
+            r['method'], r['points'], r['time'], r['points_per_second'],
+            r['peak_memory']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+@author: Chris Lucas
+
+A long-lived colorize engine, colorizing many files in one process. The
+imports and the WMS client are set up once, instead of once per file as
+with a PDAL pipeline per file, and the WMS connections are kept alive
+between files.
+"""
+
+import sys
+import os
+import time
+import threading
+
+_import_start = time.time()
+import numpy as np
+import laspy
+import pdal_colorize
+IMPORT_TIME = time.time() - _import_start
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'common'))
+import las_io
+import metrics
+
+
+class ColorizeEngine(object):
+    """
+    Colorizes LAS/LAZ files in-process with a WMS service.
+
+    Parameters
+    ----------
+    wms : dict
+        The WMS arguments (wms_url, wms_layer, wms_srs, wms_version,
+        wms_format, wms_ppm, wms_max_image_size, wms_concurrency, ...), as
+        passed to the PDAL filter.
+    las_srs : str
+        The spatial reference system of the LAS data, written to the output
+        if the input has none.
+    chunk_size : int
+        The number of points to read, colorize and write at a time.
+    """
+
+    def __init__(self, wms, las_srs=None,
+                 chunk_size=las_io.DEFAULT_CHUNK_SIZE):
+        self.wms = wms
+        self.las_srs = las_srs
+        self.chunk_size = chunk_size
+
+        start = time.time()
+        pdal_colorize.stage_hook = metrics.stage
+        self.raster = None
+        if wms.get('raster'):
+            self.raster = pdal_colorize.get_raster(wms['raster'])
+        else:
+            pdal_colorize.wms_client(wms)
+            pdal_colorize.max_image_size(wms)
+        self.startup_time = IMPORT_TIME + time.time() - start
+
+        self.stats = []
+        self._lock = threading.Lock()
+
+    def colorize_file(self, input_path, output_path, point_filter=None):
+        """
+        Colorize a LAS/LAZ file or virtual dataset, streaming the points in
+        chunks so the memory use is bounded by the chunk size (and the
+        image), not by the size of the file.
+
+        With a WMS service the points are read twice: first to find their
+        bounding box and the parts of it containing points, then to
+        colorize each chunk against the image and write it out directly.
+        With local rasters the points are read once.
+
+        Parameters
+        ----------
+        point_filter : callable
+            Called with the x and y coordinates of a chunk, returning a
+            boolean mask of the points to keep, e.g. to clip the points
+            while colorizing them. (default: None, keep all points)
+
+        Returns
+        -------
+        stats : dict
+            The number of points and the time in seconds spent reading,
+            colorizing and writing.
+        """
+        with metrics.stage('colorize', file=input_path) as record:
+            stats = self._colorize_file(input_path, output_path,
+                                        point_filter)
+            record['points'] = stats['points']
+        return stats
+
+    def _colorize_file(self, input_path, output_path, point_filter):
+        t0 = time.time()
+        header = las_io.read_header(input_path)
+        out_header = las_io.output_header(
+            header, las_io.rgb_point_format(header.point_format.id))
+        if self.las_srs is not None and header.parse_crs() is None:
+            import pyproj
+            out_header.add_crs(pyproj.CRS.from_user_input(self.las_srs))
+
+        t1 = time.time()
+        method = self.wms.get('interpolation', 'nearest')
+        if self.raster is not None:
+            def sample(X, Y):
+                return self.raster.sample(X, Y, method=method)
+        else:
+            bbox, img = self._wms_image(input_path, out_header,
+                                        point_filter)
+
+            def sample(X, Y):
+                return pdal_colorize.sample_image(img, bbox, X, Y,
+                                                  method=method)
+
+        t2 = time.time()
+        points_written = 0
+        sample_time = 0
+        write_time = 0
+        with laspy.open(output_path, mode='w', header=out_header) as writer:
+            for chunk in las_io.iter_chunks(input_path, self.chunk_size):
+                if point_filter is not None:
+                    chunk = chunk[point_filter(
+                        *las_io.scaled_xy(chunk, out_header))]
+                    if not len(chunk):
+                        continue
+                points = las_io.convert_points(chunk, out_header)
+                start = time.time()
+                with metrics.stage('sampling', points=len(points)):
+                    points.red, points.green, points.blue = sample(
+                        np.asarray(points.x), np.asarray(points.y))
+                sample_time += time.time() - start
+                start = time.time()
+                writer.write_points(points)
+                write_time += time.time() - start
+                points_written += len(points)
+        t3 = time.time()
+
+        stats = {'file': input_path,
+                 'points': points_written,
+                 'read': t3 - t0 - (t2 - t1) - sample_time - write_time,
+                 'colorize': t2 - t1 + sample_time,
+                 'write': write_time,
+                 'total': t3 - t0}
+        with self._lock:
+            self.stats.append(stats)
+        return stats
+
+    def _wms_image(self, input_path, out_header, point_filter=None):
+        """
+        Read the points to find their bounding box and the parts of it
+        containing points, and retrieve the image of those parts.
+
+        Returns
+        -------
+        bbox : list of float
+            [xmin, ymin, xmax, ymax], or None if no points pass the filter.
+        img : array of uint8
+            The RGB image of the bbox, or None.
+        """
+        bounds = las_io.read_bounds(input_path)[0]
+        occupancy = pdal_colorize.OccupancyGrid(
+            [bounds[0], bounds[1], bounds[3], bounds[4]])
+        mins = np.full(2, np.inf)
+        maxs = np.full(2, -np.inf)
+        for chunk in las_io.iter_chunks(input_path, self.chunk_size):
+            X, Y = las_io.scaled_xy(chunk, out_header)
+            if point_filter is not None:
+                mask = point_filter(X, Y)
+                X = X[mask]
+                Y = Y[mask]
+                if not len(X):
+                    continue
+            occupancy.add(X, Y)
+            mins = np.minimum(mins, [X.min(), Y.min()])
+            maxs = np.maximum(maxs, [X.max(), Y.max()])
+        if not np.all(np.isfinite(mins)):
+            return None, None
+        bbox = [float(mins[0]), float(mins[1]),
+                float(maxs[0]), float(maxs[1])]
+
+        return bbox, pdal_colorize.wms_image(bbox, self.wms, occupancy)
+
+    def print_report(self):
+        """
+        Print the startup cost and the per-file time spent on reading,
+        colorizing (WMS requests and sampling) and writing.
+        """
+        print('Engine startup (imports and WMS client): {:.2f} s'.format(
+            self.startup_time))
+        if not self.stats:
+            return
+        n = len(self.stats)
+        totals = {k: sum(s[k] for s in self.stats)
+                  for k in ('points', 'read', 'colorize', 'write', 'total')}
+        print('{} files, {} points. Mean per file: read {:.2f} s, colorize '
+              '{:.2f} s, write {:.2f} s, total {:.2f} s'.format(
+                  n, totals['points'], totals['read'] / n,
+                  totals['colorize'] / n, totals['write'] / n,
+                  totals['total'] / n))
+        print('A PDAL pipeline per file would pay the startup cost {} times '
+              '(~{:.1f} s).'.format(n, n * self.startup_time))
+
@@ -11,65 +11,175 @@ import argparse
 import subprocess
 import json
 import math
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'common'))
+import las_io
+from las_index import LasIndex
+from batch import Job, run_batch, MEMORY_PER_POINT
+import metrics
 
 
-def run_pdal(path, input_path, output_path, las_srs, wms_url,
-             wms_layer, wms_srs, wms_version, wms_format, wms_ppm,
-             wms_max_image_size):
-    subprocess.call(['pdal', 'pipeline',
-                    '{}/pdal_pipeline.json'.format(path),
-                    '--readers.las.filename={}'.format(input_path),
-                    '--filters.python.script={}/pdal_colorize.py'.format(path),
-                    ('--filters.python.pdalargs="{' +
-                    '\\\"wms_url\\\": \\\"{}\\\",'.format(wms_url) +
-                    '\\\"wms_layer\\\": \\\"{}\\\",'.format(wms_layer) +
-                    '\\\"wms_srs\\\": \\\"{}\\\",'.format(wms_srs) +
-                    '\\\"wms_version\\\": \\\"{}\\\",'.format(wms_version) +
-                    '\\\"wms_format\\\": \\\"{}\\\",'.format(wms_format) +
-                    '\\\"wms_ppm\\\": \\\"{}\\\",'.format(wms_ppm) +
-                    '\\\"wms_max_image_size\\\": \\\"{}\\\"}}"'.format(wms_max_image_size)),
-                    '--writers.las.filename={}'.format(output_path),
-                    '--writers.las.a_srs={}'.format(las_srs)])
+def run_pdal(path, input_path, output_path, las_srs, wms):
+    """
+    Colorize a LAS/LAZ file with PDAL. Raises CalledProcessError if PDAL
+    fails.
+
+    Parameters
+    ----------
+    wms : dict
+        The WMS arguments passed to the PDAL filter (see
+        `pdal_colorize.colorize`).
+    """
+    pdalargs = json.dumps({k: str(v) for k, v in wms.items()},
+                          separators=(',', ': '))
+    reader_args, tmp_file = las_io.pdal_reader_args(
+        '{}/pdal_pipeline.json'.format(path), input_path)
+    try:
+        with metrics.stage('pdal_run', file=input_path) as record:
+            subprocess.check_call(['pdal', 'pipeline'] + reader_args + [
+                            '--filters.python.script={}/pdal_colorize.py'.format(path),
+                            '--filters.python.pdalargs="{}"'.format(
+                                pdalargs.replace('"', '\\"')),
+                            '--writers.las.filename={}'.format(output_path),
+                            '--writers.las.a_srs={}'.format(las_srs)])
+            record['points'] = las_io.read_bounds(output_path)[1]
+    finally:
+        if tmp_file is not None:
+            os.remove(tmp_file)
 
 
 def process_files(input_path, output_path, las_srs,
                   wms_url, wms_layer, wms_srs,
                   wms_version, wms_format, wms_ppm,
-                  wms_max_image_size, verbose=False):
+                  wms_max_image_size, verbose=False, jobs=1,
+                  max_memory=None, engine=False, wms_concurrency=4,
+                  wms_cache_dir=None, wms_cache_size=1024,
+                  wms_cache_only=False, interpolation='nearest',
+                  raster=None, wms_rate=None, wms_max_requests=None):
     """
     Run the pdal pipeline using the given arguments.
 
     Parameters
     ----------
     input : str
-        The path to the input LAS/LAZ file.
+        The path to the input LAS/LAZ file or folder.
     output : str
-        The path to the output LAS/LAZ file.
+        The path to the output LAS/LAZ file or folder.
+    jobs : int
+        The number of files to colorize at the same time.
+    max_memory : int
+        The memory budget in bytes of the files colorized at the same
+        time. (default: None, 80% of the available memory)
+    engine : bool
+        Colorize in this process with a single `ColorizeEngine` instead of
+        running a PDAL pipeline per file.
+    wms_concurrency : int
+        The maximum number of simultaneous WMS requests per file.
+    wms_cache_dir : str
+        The folder to cache the WMS images in. (default: None, no cache)
+    wms_cache_size : int
+        The maximum size of the cache in mb.
+    wms_cache_only : bool
+        Only use cached images, do not request any images.
+    interpolation : str
+        How to sample the colors from the image, 'nearest' or 'bilinear'.
+    raster : str
+        A raster file or folder of raster tiles to colorize from instead of
+        the WMS service. (default: None)
+    wms_max_image_size : int
+        The maximum size of a requested image. (None: the MaxWidth and
+        MaxHeight of the WMS service)
+    wms_rate : float
+        The maximum number of WMS requests per second of all files
+        together. (default: None, no limit)
+    wms_max_requests : int
+        The maximum number of simultaneous WMS requests of all files
+        together. (default: None, no limit)
+
+    Returns
+    -------
+    failed : list of Job
+        The files of a folder that failed. A single file that fails raises
+        its error.
     """
     path = os.path.dirname(os.path.realpath(__file__))
 
+    wms = {'wms_url': wms_url,
+           'wms_layer': wms_layer,
+           'wms_srs': wms_srs,
+           'wms_version': wms_version,
+           'wms_format': wms_format,
+           'wms_ppm': wms_ppm,
+           'wms_max_image_size': wms_max_image_size,
+           'wms_concurrency': wms_concurrency,
+           'interpolation': interpolation}
+    if not engine and jobs > 1:
+        # each PDAL process gets its share of the limits
+        if wms_rate:
+            wms_rate = float(wms_rate) / jobs
+        if wms_max_requests:
+            wms_max_requests = max(1, int(wms_max_requests) // jobs)
+    wms['wms_rate'] = wms_rate
+    wms['wms_max_requests'] = wms_max_requests
+    if wms_cache_dir is not None:
+        wms.update({'wms_cache_dir': os.path.abspath(wms_cache_dir),
+                    'wms_cache_size': wms_cache_size,
+                    'wms_cache_only': wms_cache_only})
+    if raster is not None:
+        wms['raster'] = os.path.abspath(raster)
+    if not engine and metrics.current().path is not None:
+        # the PDAL filter appends its stages to the same file
+        wms['metrics_file'] = os.path.abspath(metrics.current().path)
+
+    if engine:
+        from colorize_engine import ColorizeEngine
+        colorize_engine = ColorizeEngine(wms, las_srs)
+        colorize_file = colorize_engine.colorize_file
+    else:
+        def colorize_file(las, out):
+            run_pdal(path, las, out, las_srs, wms)
+
     if os.path.isdir(input_path):
-        for i, f in enumerate(os.listdir(input_path)):
-            if f.endswith(".las") or f.endswith(".laz"):
-                las = os.path.join(input_path, f).replace('\\', '/')
-
-                if os.path.isdir(output_path):
-                    output_path = output_path + '/' if output_path[-1] != '/' else output_path
-                    basename, ext = os.path.splitext(f)
-                    out = '{}{}_color{}'.format(output_path, basename, ext)
-                else:
-                    basename, ext = os.path.splitext(output_path)
-                    out = '{}_{}{}'.format(basename, i, ext)
-
-                if verbose:
-                    print('Colorizing {} ..'.format(las))
-                run_pdal(path, las, out, las_srs, wms_url, wms_layer, wms_srs,
-                         wms_version, wms_format, wms_ppm,  wms_max_image_size)
+        las_index = LasIndex(input_path)
+        if wms_cache_dir is not None and raster is None:
+            import pdal_colorize
+            fetched = pdal_colorize.prefetch_shared_cells(
+                [las_index.bounds(f) for f in las_index.names()], wms)
+            if verbose:
+                print('Prefetched {} WMS cells shared by adjacent '
+                      'files.'.format(fetched))
+
+        batch_jobs = []
+        for i, f in enumerate(las_index.names()):
+            las = os.path.join(input_path, f).replace('\\', '/')
+
+            if os.path.isdir(output_path):
+                output_path = output_path + '/' if output_path[-1] != '/' else output_path
+                basename, ext = os.path.splitext(f)
+                if ext.lower() == las_io.MANIFEST_EXT:
+                    ext = '.laz'
+                out = '{}{}_color{}'.format(output_path, basename, ext)
+            else:
+                basename, ext = os.path.splitext(output_path)
+                out = '{}_{}{}'.format(basename, i, ext)
+
+            job = Job(las, colorize_file, las, out)
+            if engine:
+                # the engine streams the points, only a chunk is in memory
+                job.memory = min(job.memory, las_io.DEFAULT_CHUNK_SIZE *
+                                 MEMORY_PER_POINT)
+            batch_jobs.append(job)
+
+        failed = run_batch(batch_jobs, jobs, max_memory, verbose)
     else:
         if verbose:
             print('Colorizing {} ..'.format(input_path))
-        run_pdal(path, input_path, output_path, las_srs, wms_url, wms_layer,
-                 wms_srs, wms_version, wms_format, wms_ppm, wms_max_image_size)
+        colorize_file(input_path, output_path)
+        failed = []
+
+    if engine and verbose:
+        colorize_engine.print_report()
+    return failed
 
 
 def argument_parser():
@@ -103,7 +213,7 @@ def argument_parser():
                         required=False,
                         default='EPSG:28992')
     parser.add_argument('-f', '--wms_format',
-                        help='The image format of the WMS data to request. (str, default: image/png)',
+                        help='The image format of the WMS data to request, or auto to request JPEG if the service supports it. (str, default: image/png)',
                         required=False,
                         default='image/png')
     parser.add_argument('-v', '--wms_version',
@@ -115,22 +225,83 @@ def argument_parser():
                         required=False,
                         default=4)
     parser.add_argument('-m', '--wms_max_image_size',
-                        help='The maximum size in pixels of the largest side of the requested image. (int, default: sys.maxsize)',
+                        help='The maximum size in pixels of the largest side of the requested image. (int, default: the MaxWidth/MaxHeight of the WMS service, or 4096)',
+                        required=False,
+                        default=None)
+    parser.add_argument('-c', '--wms_concurrency',
+                        help='The maximum number of simultaneous WMS requests per file. (int, default: 4)',
+                        type=int,
+                        required=False,
+                        default=4)
+    parser.add_argument('--wms_rate',
+                        help='The maximum number of WMS requests per second, of all files together. (float, default: 10)',
+                        type=float,
+                        required=False,
+                        default=10)
+    parser.add_argument('--wms_max_requests',
+                        help='The maximum number of simultaneous WMS requests, of all files together. (int, default: 8)',
+                        type=int,
+                        required=False,
+                        default=8)
+    parser.add_argument('--wms_cache_dir',
+                        help='The folder to cache the WMS images in, shared between runs. (str, default: no cache)',
+                        required=False,
+                        default=None)
+    parser.add_argument('--wms_cache_size',
+                        help='The maximum size of the WMS image cache in mb. (int, default: 1024)',
+                        type=int,
+                        required=False,
+                        default=1024)
+    parser.add_argument('--wms_cache_only',
+                        help='Only use cached WMS images, for offline use.',
+                        action='store_true',
+                        required=False,
+                        default=False)
+    parser.add_argument('-n', '--interpolation',
+                        help='How to sample the colors from the image. (str, default: nearest)',
+                        choices=['nearest', 'bilinear'],
+                        required=False,
+                        default='nearest')
+    parser.add_argument('-R', '--raster',
+                        help='A local orthophoto (GeoTIFF, VRT) or folder of orthophoto tiles to colorize from instead of the WMS service. (str, default: None)',
+                        required=False,
+                        default=None)
+    parser.add_argument('-j', '--jobs',
+                        help='The number of files to colorize at the same time. (int, default: 1)',
+                        type=int,
+                        required=False,
+                        default=1)
+    parser.add_argument('--max_memory',
+                        help='The memory in mb the files colorized at the same time may use together. (int, default: 80%% of the available memory)',
+                        type=int,
                         required=False,
-                        default=sys.maxsize)
+                        default=None)
+    parser.add_argument('-e', '--engine', default=False, action="store_true",
+                        help='Colorize all files in this process instead of '
+                             'running a PDAL pipeline per file.')
     parser.add_argument('-V', '--verbose', default=False, action="store_true",
                         help='Set verbose.')
+    metrics.add_arguments(parser)
     args = parser.parse_args()
     return args
 
 
 def main():
     args = argument_parser()
-    process_files(args.input, args.output, args.las_srs,
-                  args.wms_url, args.wms_layer, args.wms_srs,
-                  args.wms_version, args.wms_format,
-                  args.wms_ppm, args.wms_max_image_size,
-                  args.verbose)
+    with metrics.from_args(args):
+        max_memory = args.max_memory * 1048576 if args.max_memory else None
+        failed = process_files(args.input, args.output, args.las_srs,
+                               args.wms_url, args.wms_layer, args.wms_srs,
+                               args.wms_version, args.wms_format,
+                               args.wms_ppm, args.wms_max_image_size,
+                               args.verbose, args.jobs, max_memory,
+                               args.engine, args.wms_concurrency,
+                               args.wms_cache_dir, args.wms_cache_size,
+                               args.wms_cache_only, args.interpolation,
+                               args.raster, args.wms_rate,
+                               args.wms_max_requests)
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -6,36 +6,675 @@ Python3
 """
 
 from io import BytesIO
+import os
 import json
 import math
+import struct
+import time
+import random
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager, nullcontext
+from xml.etree import ElementTree
+from concurrent.futures import (ThreadPoolExecutor, as_completed, wait,
+                                FIRST_COMPLETED)
 import numpy as np
-import matplotlib.image as mpimg
-from owslib.wms import WebMapService
-from requests.exceptions import ReadTimeout
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import Timeout, HTTPError
+from PIL import Image
 
+DEFAULT_CONCURRENCY = 4
+DEFAULT_MAX_IMAGE_SIZE = 4096
+DECODE_WORKERS = min(4, os.cpu_count() or 1)
+# the formats preferred with wms_format 'auto', smallest first
+AUTO_FORMATS = ('image/jpeg', 'image/png')
+RETRIES = 10
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60
+DEFAULT_CACHE_SIZE = 1024
+CACHE_CELL_PIXELS = 1024
+# the file in a cache folder storing the formats negotiated with 'auto'
+CACHE_FORMATS_FILE = 'formats.json'
+MEMMAP_THRESHOLD = 1024 * 1048576
+OCCUPANCY_MAX_CELLS = 4000000
+SAMPLE_CHUNK_SIZE = 1000000
+RASTER_EXTENSIONS = ('.tif', '.tiff', '.vrt')
+# numpy types of the numeric TIFF field types
+TIFF_TYPES = {1: 'u1', 3: 'u2', 4: 'u4', 6: 'i1', 7: 'u1', 8: 'i2',
+              9: 'i4', 11: 'f4', 12: 'f8', 16: 'u8', 17: 'i8', 18: 'u8'}
 
-def request_image(bbox, size, wms_url, wms_layer, wms_srs,
-                  wms_version, wms_format, retries):
+# A context manager timing the WMS requests, decoding and sampling, called
+# as stage_hook(name, **fields) and yielding a dict of fields to record
+# with the time, e.g. `metrics.stage`. (default: None, not timed)
+stage_hook = None
+_clients = {}
+_clients_lock = threading.Lock()
+_caches = {}
+_rasters = {}
+
+
+class WMSError(Exception):
+    pass
+
+
+class CacheMissError(WMSError):
+    pass
+
+
+class RasterError(Exception):
+    pass
+
+
+class ImageCache(object):
+    """
+    A persistent on-disk cache of WMS responses, with a least recently used
+    eviction policy. The cache can be shared by multiple processes.
+
+    Parameters
+    ----------
+    folder : str
+        The folder to store the cached images in.
+    max_size : int
+        The maximum size of the cache in mb.
+    cache_only : bool
+        Never request images, raise a CacheMissError for images that are
+        not in the cache.
+    """
+
+    def __init__(self, folder, max_size=DEFAULT_CACHE_SIZE, cache_only=False):
+        self.folder = folder
+        self.max_size = max_size * 1048576
+        self.cache_only = cache_only
+        self._lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self.size = sum(size for _, _, size in self._entries())
+
+    @staticmethod
+    def key(*args):
+        return hashlib.sha1(repr(args).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], key)
+
+    def _entries(self):
+        for sub in os.listdir(self.folder):
+            sub = os.path.join(self.folder, sub)
+            if not os.path.isdir(sub):
+                continue
+            for name in os.listdir(sub):
+                path = os.path.join(sub, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_mtime, stat.st_size
+
+    def contains(self, key):
+        return os.path.isfile(self._path(key))
 
-    for i in range(retries):
+    def get(self, key):
+        """
+        Get a cached image, or None if it is not in the cache.
+        """
+        path = self._path(key)
         try:
-            wms = WebMapService(wms_url, version=wms_version)
-            wms_img = wms.getmap(layers=[wms_layer],
-                                 srs=wms_srs,
-                                 bbox=bbox,
-                                 size=size,
-                                 format=wms_format,
-                                 transparent=True)
-            break
-        except ReadTimeout as e:
-            if i != retries-1:
-                print("ReadTimeout, trying again..")
-            else:
-                raise e
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data):
+        """
+        Add an image to the cache, evicting the least recently used images
+        if the cache is full.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(),
+                                         threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        try:
+            # an existing image is replaced, its size no longer counts
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self.size += len(data) - old_size
+            if self.size > self.max_size:
+                self.evict()
+
+    def get_format(self, wms_url, wms_layer):
+        """
+        The image format negotiated for a layer with wms_format 'auto' by
+        an earlier run, or None if it is not known.
+        """
+        try:
+            with open(os.path.join(self.folder, CACHE_FORMATS_FILE)) as f:
+                formats = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return formats.get('{} {}'.format(wms_url, wms_layer))
+
+    def put_format(self, wms_url, wms_layer, wms_format):
+        """
+        Store the image format negotiated for a layer with wms_format
+        'auto', so runs with the cache only request the cells in the same
+        format.
+        """
+        if self.get_format(wms_url, wms_layer) == wms_format:
+            return
+        path = os.path.join(self.folder, CACHE_FORMATS_FILE)
+        with self._lock:
+            try:
+                with open(path) as f:
+                    formats = json.load(f)
+            except (OSError, ValueError):
+                formats = {}
+            formats['{} {}'.format(wms_url, wms_layer)] = wms_format
+            tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(),
+                                             threading.get_ident())
+            with open(tmp_path, 'w') as f:
+                json.dump(formats, f, indent=2)
+            os.replace(tmp_path, path)
+
+    def evict(self):
+        """
+        Remove the least recently used images until the cache is at 90% of
+        its maximum size.
+        """
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        self.size = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if self.size <= 0.9 * self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size -= size
+
+
+class OccupancyGrid(object):
+    """
+    A boolean grid marking which parts of a bounding box contain points,
+    used to only request the image cells that are needed.
+
+    Parameters
+    ----------
+    bbox : list of float
+        [xmin, ymin, xmax, ymax]
+    resolution : float
+        The size of a grid cell in meters. (default: None, at least 1 m
+        and at most OCCUPANCY_MAX_CELLS cells)
+    """
+
+    def __init__(self, bbox, resolution=None):
+        self.bbox = bbox
+        x_range = max(bbox[2] - bbox[0], 1e-9)
+        y_range = max(bbox[3] - bbox[1], 1e-9)
+        if resolution is None:
+            resolution = max(1.0, math.sqrt(x_range * y_range /
+                                            OCCUPANCY_MAX_CELLS))
+        self.resolution = resolution
+        self.mask = np.zeros((int(y_range // resolution) + 1,
+                              int(x_range // resolution) + 1), dtype=bool)
+
+    def add(self, X, Y):
+        """
+        Mark the grid cells containing the points.
+        """
+        ix = ((X - self.bbox[0]) // self.resolution).astype(np.intp)
+        iy = ((Y - self.bbox[1]) // self.resolution).astype(np.intp)
+        np.clip(ix, 0, self.mask.shape[1] - 1, out=ix)
+        np.clip(iy, 0, self.mask.shape[0] - 1, out=iy)
+        self.mask[iy, ix] = True
+
+    def any_in(self, bbox):
+        """
+        Whether there are (or may be) points in a bounding box.
+        """
+        x0 = max(0, int((bbox[0] - self.bbox[0]) // self.resolution))
+        y0 = max(0, int((bbox[1] - self.bbox[1]) // self.resolution))
+        x1 = int((bbox[2] - self.bbox[0]) // self.resolution) + 1
+        y1 = int((bbox[3] - self.bbox[1]) // self.resolution) + 1
+        return bool(self.mask[y0:y1, x0:x1].any())
+
+
+def get_cache(folder, max_size=DEFAULT_CACHE_SIZE, cache_only=False):
+    """
+    Get the ImageCache for a folder, created once per process.
+    """
+    key = (os.path.abspath(folder), max_size, cache_only)
+    with _clients_lock:
+        if key not in _caches:
+            _caches[key] = ImageCache(folder, max_size, cache_only)
+        return _caches[key]
+
+
+class RateLimiter(object):
+    """
+    Limits the rate and the number of simultaneous requests to a service,
+    shared by all threads of a process. Use as a context manager around
+    each request.
+
+    Parameters
+    ----------
+    rate : float
+        The maximum number of requests per second. (default: None, no
+        limit)
+    max_requests : int
+        The maximum number of simultaneous requests. (default: None, no
+        limit)
+    """
+
+    def __init__(self, rate=None, max_requests=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+        self._semaphore = (threading.BoundedSemaphore(max_requests)
+                           if max_requests else None)
+
+    def __enter__(self):
+        if self._semaphore is not None:
+            self._semaphore.acquire()
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+        return self
+
+    def __exit__(self, *exc):
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+    def pause(self, seconds):
+        """
+        Do not start requests for a while, e.g. when the service asks to
+        retry later.
+        """
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+
+class WMSClient(object):
+    """
+    A minimal WMS GetMap client on a requests session, so connections are
+    kept alive and shared between (concurrent) requests.
+
+    Parameters
+    ----------
+    wms_url : str
+        The url of the WMS service.
+    wms_version : str
+        The version of the WMS service.
+    pool_size : int
+        The maximum number of connections kept open.
+    rate : float
+        The maximum number of requests per second. (default: None, no
+        limit)
+    max_requests : int
+        The maximum number of simultaneous requests. (default: None, no
+        limit)
+    """
+
+    def __init__(self, wms_url, wms_version, pool_size=DEFAULT_CONCURRENCY,
+                 rate=None, max_requests=None):
+        self.url = wms_url
+        self.version = wms_version
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.rate = rate
+        self.max_requests = max_requests
+        self.limiter = RateLimiter(rate, max_requests)
+        self._capabilities = None
+        self._capabilities_lock = threading.Lock()
+
+    def capabilities(self, timeout=30):
+        """
+        The image size limits and formats of the service, requested once.
+        If the capabilities can not be read an empty dict is returned.
+
+        Returns
+        -------
+        capabilities : dict
+            max_width and max_height (int, if given by the service) and
+            formats (list of str).
+        """
+        with self._capabilities_lock:
+            if self._capabilities is not None:
+                return self._capabilities
+
+            params = {'SERVICE': 'WMS',
+                      'VERSION': self.version,
+                      'REQUEST': 'GetCapabilities'}
+            try:
+                with self.limiter:
+                    r = self.session.get(self.url, params=params,
+                                         timeout=timeout)
+                r.raise_for_status()
+                self._capabilities = parse_capabilities(r.content)
+            except (requests.exceptions.RequestException,
+                    ElementTree.ParseError) as e:
+                print("Could not read the WMS capabilities: {}".format(e))
+                self._capabilities = {}
+            return self._capabilities
+
+    def getmap(self, layer, srs, bbox, size, img_format, timeout=30):
+        """
+        Request an image. Returns the response body.
+        """
+        if self.version == '1.3.0' and srs.upper() == 'EPSG:4326':
+            bbox = [bbox[1], bbox[0], bbox[3], bbox[2]]
+
+        params = {'SERVICE': 'WMS',
+                  'VERSION': self.version,
+                  'REQUEST': 'GetMap',
+                  'LAYERS': layer,
+                  'STYLES': '',
+                  'CRS' if self.version == '1.3.0' else 'SRS': srs,
+                  'BBOX': ','.join(repr(float(c)) for c in bbox),
+                  'WIDTH': str(size[0]),
+                  'HEIGHT': str(size[1]),
+                  'FORMAT': img_format,
+                  'TRANSPARENT': 'FALSE' if 'jpeg' in img_format else 'TRUE'}
+        with self.limiter:
+            # only the request itself is timed, not the wait for the limiter
+            with timed('wms_request', format=img_format,
+                       pixels=size[0]*size[1]) as record:
+                r = self.session.get(self.url, params=params,
+                                     timeout=timeout)
+                record['bytes'] = len(r.content)
+        r.raise_for_status()
+        if 'xml' in r.headers.get('Content-Type', ''):
+            raise WMSError(r.text)
+        return r.content
+
+
+def parse_capabilities(xml):
+    """
+    Read the image size limits and GetMap formats from a WMS
+    GetCapabilities document, of any WMS version.
+    """
+    root = ElementTree.fromstring(xml)
+    capabilities = {'formats': []}
+    for element in root.iter():
+        name = element.tag.rsplit('}', 1)[-1]
+        if name in ('MaxWidth', 'MaxHeight') and element.text:
+            key = 'max_width' if name == 'MaxWidth' else 'max_height'
+            capabilities.setdefault(key, int(element.text))
+        elif name == 'GetMap':
+            capabilities['formats'] = [
+                f.text.strip() for f in element
+                if f.tag.rsplit('}', 1)[-1] == 'Format' and f.text]
+    return capabilities
+
+
+def get_client(wms_url, wms_version, pool_size=DEFAULT_CONCURRENCY,
+               rate=None, max_requests=None):
+    """
+    Get the WMSClient for a url and version, created once per process. The
+    rate limits are shared by all requests to the service, so a ValueError
+    is raised if the client was created with other limits.
+    """
+    key = (wms_url, wms_version)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = WMSClient(wms_url, wms_version, pool_size,
+                                      rate, max_requests)
+        client = _clients[key]
+    if (client.rate, client.max_requests) != (rate, max_requests):
+        raise ValueError("The WMS client of {} was created with rate {} and "
+                         "max_requests {}, not {} and {}.".format(
+                             wms_url, client.rate, client.max_requests,
+                             rate, max_requests))
+    return client
 
-    img = mpimg.imread(BytesIO(wms_img.read()))
 
-    return img
+def wms_client(wms):
+    """
+    Get the WMSClient of the WMS arguments, created once per process.
+    """
+    rate = wms.get('wms_rate')
+    max_requests = wms.get('wms_max_requests')
+    return get_client(wms['wms_url'], wms['wms_version'],
+                      int(wms.get('wms_concurrency', DEFAULT_CONCURRENCY)),
+                      float(rate) if rate not in (None, 'None') else None,
+                      int(max_requests)
+                      if max_requests not in (None, 'None') else None)
+
+
+def max_image_size(wms):
+    """
+    The largest image size to request: the smallest of the given
+    wms_max_image_size and the MaxWidth and MaxHeight of the service, or
+    DEFAULT_MAX_IMAGE_SIZE if none of them is known.
+    """
+    size = wms.get('wms_max_image_size')
+    limits = [int(size)] if size not in (None, 'None', '') else []
+    if str(wms.get('wms_cache_only')) != 'True':
+        capabilities = wms_client(wms).capabilities()
+        limits += [capabilities[k] for k in ('max_width', 'max_height')
+                   if capabilities.get(k)]
+    return min(limits) if limits else DEFAULT_MAX_IMAGE_SIZE
+
+
+def image_format(wms):
+    """
+    The image format to request: wms_format if the service supports it (or
+    does not list its formats), otherwise PNG or the first listed format.
+    With wms_format 'auto' JPEG is requested if the service supports it,
+    as it is several times smaller than PNG for aerial photos. The format
+    chosen is stored in the cache, if any, and used by runs with the cache
+    only (PNG if no format was stored).
+    """
+    img_format = wms['wms_format']
+    cache = wms_cache(wms)
+    if str(wms.get('wms_cache_only')) == 'True':
+        if img_format != 'auto':
+            return img_format
+        stored = (cache.get_format(wms['wms_url'], wms['wms_layer'])
+                  if cache is not None else None)
+        return stored or 'image/png'
+    formats = wms_client(wms).capabilities().get('formats')
+    if img_format == 'auto':
+        img_format = next((f for f in AUTO_FORMATS
+                           if f in (formats or [])), 'image/png')
+        if cache is not None:
+            cache.put_format(wms['wms_url'], wms['wms_layer'], img_format)
+        return img_format
+    if not formats or img_format in formats:
+        return img_format
+    fallback = 'image/png' if 'image/png' in formats else formats[0]
+    print("Format {} not supported by the WMS service, using {}.".format(
+        img_format, fallback))
+    return fallback
+
+
+def backoff_delay(attempt):
+    """
+    The time to wait before retry `attempt`: exponential backoff with full
+    jitter, so workers that failed together do not retry together.
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def retry_after(error):
+    """
+    The time in seconds a service asked to wait, or 0. Raises the error if
+    retrying will not help.
+    """
+    if isinstance(error, (Timeout, requests.exceptions.ConnectionError)):
+        return 0
+    response = getattr(error, 'response', None)
+    if (isinstance(error, HTTPError) and response is not None and
+            (response.status_code == 429 or response.status_code >= 500)):
+        try:
+            return float(response.headers.get('Retry-After', 0))
+        except ValueError:
+            return 0
+    raise error
+
+
+def request_data(bbox, size, wms_url, wms_layer, wms_srs,
+                 wms_version, wms_format, retries, cache=None,
+                 cache_key=None, client=None):
+    """
+    Get the encoded image of a bbox, from the cache if possible. Timeouts,
+    connection errors and overloaded (429 and 5xx) responses are retried
+    with exponential backoff.
+
+    Parameters
+    ----------
+    client : WMSClient
+        The client to request the image with. (default: None, the client
+        of the url and version without rate limits)
+    """
+    data = cache.get(cache_key) if cache is not None else None
+
+    if data is None:
+        if cache is not None and cache.cache_only:
+            raise CacheMissError("Image {} not in the cache.".format(bbox))
+
+        if client is None:
+            client = get_client(wms_url, wms_version)
+        for i in range(retries):
+            try:
+                data = client.getmap(wms_layer, wms_srs, bbox, size,
+                                     wms_format)
+                break
+            except requests.exceptions.RequestException as e:
+                wait = retry_after(e)
+                if i == retries-1:
+                    raise e
+                if wait:
+                    client.limiter.pause(wait)
+                delay = max(wait, backoff_delay(i))
+                print("{}, trying again in {:.1f} s..".format(
+                    type(e).__name__, delay))
+                time.sleep(delay)
+
+        if cache is not None:
+            cache.put(cache_key, data)
+
+    return data
+
+
+def timed(name, **fields):
+    """
+    Time a stage with the `stage_hook`, if set.
+    """
+    if stage_hook is None:
+        return nullcontext(fields)
+    return stage_hook(name, **fields)
+
+
+def metrics_file_hook(path):
+    """
+    A `stage_hook` appending the stages to a JSON lines file, used when
+    running in PDAL.
+    """
+    lock = threading.Lock()
+
+    @contextmanager
+    def hook(name, **fields):
+        start = time.time()
+        yield fields
+        line = {'stage': name, 'start': start,
+                'seconds': time.time() - start, 'pid': os.getpid()}
+        line.update(fields)
+        with lock, open(path, 'a') as f:
+            f.write(json.dumps(line) + '\n')
+    return hook
+
+
+def request_image(bbox, size, wms_url, wms_layer, wms_srs,
+                  wms_version, wms_format, retries, cache=None,
+                  cache_key=None, client=None):
+
+    data = request_data(bbox, size, wms_url, wms_layer, wms_srs,
+                        wms_version, wms_format, retries, cache, cache_key,
+                        client)
+
+    return decode_image(data)
+
+
+def request_cell(bbox, size, max_image_size, wms_url, wms_layer, wms_srs,
+                 wms_version, wms_format, retries, cache=None,
+                 cache_key=None, client=None):
+    """
+    Get the encoded image of a cell, from the cache if possible. A cell
+    larger than `max_image_size` is requested as a grid of smaller images,
+    which are combined and stored in the cache as a single PNG image. So
+    the cached cells are the same whatever the limits of the service, and
+    can be used without knowing them.
+    """
+    if size[0] <= max_image_size and size[1] <= max_image_size:
+        return request_data(bbox, size, wms_url, wms_layer, wms_srs,
+                            wms_version, wms_format, retries, cache,
+                            cache_key, client)
+
+    data = cache.get(cache_key) if cache is not None else None
+    if data is not None:
+        return data
+    if cache is not None and cache.cache_only:
+        raise CacheMissError("Image {} not in the cache.".format(bbox))
+
+    cols = int(math.ceil(size[0] / max_image_size))
+    rows = int(math.ceil(size[1] / max_image_size))
+    x_edges = [int(round(i * size[0] / cols)) for i in range(cols + 1)]
+    y_edges = [int(round(i * size[1] / rows)) for i in range(rows + 1)]
+    res_x = (bbox[2] - bbox[0]) / size[0]
+    res_y = (bbox[3] - bbox[1]) / size[1]
+
+    img = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+    for col in range(cols):
+        for row in range(rows):
+            x0, x1 = x_edges[col], x_edges[col+1]
+            y0, y1 = y_edges[row], y_edges[row+1]
+            part = [bbox[0] + x0*res_x, bbox[3] - y1*res_y,
+                    bbox[0] + x1*res_x, bbox[3] - y0*res_y]
+            img[y0:y1, x0:x1] = request_image(part, (x1-x0, y1-y0),
+                                              wms_url, wms_layer, wms_srs,
+                                              wms_version, wms_format,
+                                              retries, client=client)
+
+    with timed('encode', pixels=size[0]*size[1]):
+        buffer = BytesIO()
+        Image.fromarray(img).save(buffer, format='PNG', compress_level=1)
+        data = buffer.getvalue()
+    if cache is not None:
+        cache.put(cache_key, data)
+    return data
+
+
+def decode_image(data):
+    """
+    Decode an encoded image (PNG, JPEG, ..) directly to 8 bit RGB.
+
+    Returns
+    -------
+    img : array of uint8
+        The RGB image.
+    """
+    with timed('decode', bytes=len(data)) as record, \
+            Image.open(BytesIO(data)) as img:
+        record['format'] = img.format
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        return np.asarray(img)
 
 
 def image_size(bbox, ppm=4):
@@ -48,25 +687,73 @@ def image_size(bbox, ppm=4):
     return img_size
 
 
+def grid_range(bbox, length_x, length_y, origin=(0, 0)):
+    """
+    The columns and rows of the cells of a grid covering a bbox.
+
+    Returns
+    -------
+    col_min, col_max, row_min, row_max : int
+    """
+    [xmin, ymin, xmax, ymax] = bbox
+    col_min = int(math.floor((xmin-origin[0])/length_x))
+    col_max = max(col_min, int(math.ceil((xmax-origin[0])/length_x)) - 1)
+    row_min = int(math.floor((ymin-origin[1])/length_y))
+    row_max = max(row_min, int(math.ceil((ymax-origin[1])/length_y)) - 1)
+    return col_min, col_max, row_min, row_max
+
+
+def grid_cell(col, row, length_x, length_y, origin=(0, 0)):
+    """
+    The bbox of a cell of a grid.
+    """
+    return [origin[0]+col*length_x, origin[1]+row*length_y,
+            origin[0]+(col+1)*length_x, origin[1]+(row+1)*length_y]
+
+
 def retrieve_image(bbox, wms_url, wms_layer, wms_srs,
-                   wms_version, wms_format, ppm, max_image_size):
+                   wms_version, wms_format, ppm, max_image_size,
+                   concurrency=DEFAULT_CONCURRENCY, cache=None,
+                   occupancy=None, rate=None, max_requests=None):
     """
-    Download an orthophoto from the PDOK WMS service.
+    Download an orthophoto from the PDOK WMS service. If the image is
+    larger than `max_image_size` it is requested as the smallest grid of
+    cells of at most `max_image_size` pixels covering it, of
+    which up to `concurrency` are requested at the same time. Each cell is
+    placed in the image as soon as it arrives.
+
+    With a cache the cells are snapped to a fixed world grid of
+    CACHE_CELL_PIXELS pixels, so adjacent and overlapping areas share
+    cached cells. With an occupancy grid only
+    the cells containing points are requested, the other cells are left
+    black. Very large images are stored in a temporary memory-mapped file.
 
     Parameters
     ----------
-    bbox
+    bbox : list of float
+        [xmin, ymin, xmax, ymax]
+    concurrency : int
+        The maximum number of simultaneous requests.
+    cache : ImageCache
+        The cache to look up and store the cells in. (default: None)
+    occupancy : OccupancyGrid
+        The parts of the bbox containing points. (default: None, request
+        all cells)
+    rate : float
+        The maximum number of requests per second. (default: None, no
+        limit)
+    max_requests : int
+        The maximum number of simultaneous requests. (default: None, no
+        limit)
 
     Returns
     -------
-    out_filename : string
-        The path to the output image file.
-
-    Output
-    ------
-    PNG image
+    img : array of uint8
+        The RGB image.
     """
-    retries = 10
+    retries = RETRIES
+    client = get_client(wms_url, wms_version, concurrency, rate,
+                        max_requests)
 
     [xmin, ymin, xmax, ymax] = bbox
 
@@ -74,36 +761,691 @@ def retrieve_image(bbox, wms_url, wms_layer, wms_srs,
     y_range = ymax - ymin
     longest_side = max([x_range, y_range])
 
-    if (longest_side * ppm > max_image_size):
-        length = max_image_size / ppm
-        length_pixels = max_image_size
+    if cache is not None:
+        width = height = CACHE_CELL_PIXELS
+        origin = (0, 0)
+    elif (longest_side * ppm > max_image_size):
+        # the fewest cells covering the bbox, as small as possible
+        cols = int(math.ceil(x_range * ppm / max_image_size))
+        rows = int(math.ceil(y_range * ppm / max_image_size))
+        width = int(math.ceil(x_range * ppm / cols))
+        height = int(math.ceil(y_range * ppm / rows))
+        origin = (xmin, ymin)
+    else:
+        size = image_size(bbox, ppm)
+        return request_image(bbox, size, wms_url, wms_layer, wms_srs,
+                             wms_version, wms_format, retries,
+                             client=client)
+
+    length_x = width / ppm
+    length_y = height / ppm
 
-        rows = int(math.ceil((ymax-ymin)/length))
-        cols = int(math.ceil((xmax-xmin)/length))
+    col_min, col_max, row_min, row_max = grid_range(bbox, length_x, length_y,
+                                                    origin)
+    rows = row_max - row_min + 1
+    cols = col_max - col_min + 1
 
-        img = np.zeros((length_pixels*rows, length_pixels*cols, 3))
+    shape = (height*rows, width*cols, 3)
+    if np.prod(shape) > MEMMAP_THRESHOLD:
+        img = np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode='w+',
+                        shape=shape)
+    else:
+        img = np.zeros(shape, dtype=np.uint8)
 
+    with ThreadPoolExecutor(max_workers=concurrency) as executor, \
+            ThreadPoolExecutor(max_workers=DECODE_WORKERS) as decoder:
+        futures = {}
         for col in range(cols):
             for row in range(rows):
-                cell = [xmin+col*length, ymin+row*length,
-                        xmin+(col+1)*length, ymin+(row+1)*length]
-
-                img_part = request_image(cell, (length_pixels, length_pixels),
+                cell_col = col_min + col
+                cell_row = row_min + row
+                cell = grid_cell(cell_col, cell_row, length_x, length_y,
+                                 origin)
+                if occupancy is not None and not occupancy.any_in(cell):
+                    continue
+                cache_key = None
+                if cache is not None:
+                    cache_key = cache.key(wms_url, wms_layer, wms_srs,
+                                          wms_format, ppm, width,
+                                          cell_col, cell_row)
+                future = executor.submit(request_cell, cell,
+                                         (width, height), max_image_size,
                                          wms_url, wms_layer, wms_srs,
-                                         wms_version, wms_format, retries)
+                                         wms_version, wms_format, retries,
+                                         cache, cache_key, client)
+                futures[future] = (row, col)
 
-                img[((length_pixels*rows)-(row+1) *
-                     length_pixels):(length_pixels*rows)-row*length_pixels,
-                    col*length_pixels:(col+1)*length_pixels] = img_part
+        # the cells are decoded by a separate pool, so the request threads
+        # only wait on the network
+        decodes = {}
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in futures:
+                    data = future.result()
+                    decode = decoder.submit(decode_image, data)
+                    decodes[decode] = futures[future]
+                    pending.add(decode)
+                    continue
 
-        img = img[(length_pixels*rows)-int(y_range*ppm):,
-                  :int(round(x_range*ppm))]
-    else:
-        size = image_size(bbox)
-        img = request_image(bbox, size, wms_url, wms_layer, wms_srs,
-                            wms_version, wms_format, retries)
+                row, col = decodes.pop(future)
+                img_part = future.result()
+
+                img[(height*rows)-(row+1)*height:(height*rows)-row*height,
+                    col*width:(col+1)*width] = img_part
+
+    left = origin[0] + col_min*length_x
+    top = origin[1] + (row_max+1)*length_y
+    x0 = int(round((xmin-left)*ppm))
+    x1 = max(x0+1, int(round((xmax-left)*ppm)))
+    y0 = int(round((top-ymax)*ppm))
+    y1 = max(y0+1, int(round((top-ymin)*ppm)))
+
+    return img[y0:y1, x0:x1]
+
+
+def point_bbox(X, Y):
+    """
+    The bounding box [xmin, ymin, xmax, ymax] of points.
+    """
+    return [float(np.min(X)), float(np.min(Y)),
+            float(np.max(X)), float(np.max(Y))]
+
+
+def sample_image(img, bbox, X, Y, out=None, method='nearest',
+                 chunk_size=SAMPLE_CHUNK_SIZE):
+    """
+    Sample the colors of points from an image covering a bounding box. The
+    points are processed in chunks using preallocated buffers, so the
+    temporary memory use is bounded by the chunk size.
+
+    Parameters
+    ----------
+    img : array of uint8
+        The RGB image, the corners of the bbox are at the centers of the
+        corner pixels.
+    bbox : list of float
+        [xmin, ymin, xmax, ymax]
+    X, Y : array
+        The coordinates of the points.
+    out : array of uint16
+        The (3, n) array to write the colors to. (default: None, a new
+        array is created)
+    method : str
+        'nearest' or 'bilinear' interpolation.
+    chunk_size : int
+        The number of points to process at a time.
+
+    Returns
+    -------
+    out : array of uint16
+        The red, green and blue values of the points, shape (3, n).
+    """
+    [xmin, ymin, xmax, ymax] = bbox
+    n = len(X)
+    if out is None:
+        out = np.empty((3, n), dtype=np.uint16)
+
+    h, w = img.shape[:2]
+    scale_x = (w-1) / (xmax-xmin) if xmax > xmin else 0.0
+    scale_y = (h-1) / (ymax-ymin) if ymax > ymin else 0.0
+
+    chunk_size = min(chunk_size, n)
+    fx = np.empty(chunk_size)
+    fy = np.empty(chunk_size)
+    ix = np.empty(chunk_size, dtype=np.intp)
+    iy = np.empty(chunk_size, dtype=np.intp)
+    if method == 'bilinear':
+        ix1 = np.empty(chunk_size, dtype=np.intp)
+        iy1 = np.empty(chunk_size, dtype=np.intp)
+        acc = np.empty((chunk_size, 3))
+    elif method != 'nearest':
+        raise ValueError("Unknown interpolation method: {}".format(method))
+
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        m = stop - start
+        cx, cy, cix, ciy = fx[:m], fy[:m], ix[:m], iy[:m]
+
+        np.subtract(X[start:stop], xmin, out=cx)
+        cx *= scale_x
+        np.subtract(ymax, Y[start:stop], out=cy)
+        cy *= scale_y
+
+        if method == 'nearest':
+            np.rint(cx, out=cx)
+            np.rint(cy, out=cy)
+            np.copyto(cix, cx, casting='unsafe')
+            np.copyto(ciy, cy, casting='unsafe')
+            np.clip(cix, 0, w-1, out=cix)
+            np.clip(ciy, 0, h-1, out=ciy)
+            out[:, start:stop] = img[ciy, cix].T
+        else:
+            cix1, ciy1, cacc = ix1[:m], iy1[:m], acc[:m]
+            np.clip(cx, 0, w-1, out=cx)
+            np.clip(cy, 0, h-1, out=cy)
+            np.copyto(cix, cx, casting='unsafe')
+            np.copyto(ciy, cy, casting='unsafe')
+            np.minimum(cix + 1, w-1, out=cix1)
+            np.minimum(ciy + 1, h-1, out=ciy1)
+            # fractional parts
+            cx -= cix
+            cy -= ciy
+            wx = cx[:, np.newaxis]
+            wy = cy[:, np.newaxis]
+
+            np.multiply(img[ciy, cix], (1-wx) * (1-wy), out=cacc)
+            cacc += img[ciy, cix1] * (wx * (1-wy))
+            cacc += img[ciy1, cix] * ((1-wx) * wy)
+            cacc += img[ciy1, cix1] * (wx * wy)
+            np.rint(cacc, out=cacc)
+            out[:, start:stop] = cacc.T
+
+    return out
+
+
+def read_tiff_tags(path):
+    """
+    Read the tags of the first image of a (Big)TIFF file.
+
+    Returns
+    -------
+    tags : dict
+        The tag values as numpy arrays by tag number.
+    byteorder : str
+        '<' or '>'.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(16)
+        if header[:2] == b'II':
+            byteorder = '<'
+        elif header[:2] == b'MM':
+            byteorder = '>'
+        else:
+            raise RasterError("{} is not a TIFF file.".format(path))
+        version = struct.unpack(byteorder + 'H', header[2:4])[0]
+        if version == 42:
+            big = False
+            offset = struct.unpack(byteorder + 'I', header[4:8])[0]
+        elif version == 43:
+            big = True
+            offset = struct.unpack(byteorder + 'Q', header[8:16])[0]
+        else:
+            raise RasterError("{} is not a TIFF file.".format(path))
 
-    return img
+        f.seek(offset)
+        count_fmt, entry_size, value_size = (('Q', 20, 8) if big else
+                                             ('H', 12, 4))
+        n = struct.unpack(byteorder + count_fmt,
+                          f.read(struct.calcsize(count_fmt)))[0]
+        entries = f.read(n * entry_size)
+
+        tags = {}
+        for i in range(n):
+            entry = entries[i*entry_size:(i+1)*entry_size]
+            tag, tiff_type = struct.unpack(byteorder + 'HH', entry[:4])
+            count = struct.unpack(byteorder + ('Q' if big else 'I'),
+                                  entry[4:entry_size-value_size])[0]
+            if tiff_type not in TIFF_TYPES:
+                continue
+            dtype = np.dtype(TIFF_TYPES[tiff_type]).newbyteorder(byteorder)
+            size = dtype.itemsize * count
+            if size <= value_size:
+                data = entry[entry_size-value_size:entry_size-value_size+size]
+            else:
+                value_offset = struct.unpack(
+                    byteorder + ('Q' if big else 'I'),
+                    entry[entry_size-value_size:])[0]
+                f.seek(value_offset)
+                data = f.read(size)
+            tags[tag] = np.frombuffer(data, dtype=dtype, count=count)
+
+    return tags, byteorder
+
+
+def world_file(path):
+    """
+    Read the georeferencing of a raster from its world file.
+
+    Returns
+    -------
+    transform : tuple of float
+        (left, top, x resolution, y resolution), or None if there is no
+        world file.
+    """
+    base, ext = os.path.splitext(path)
+    for world_ext in (ext[:2] + ext[-1] + 'w', ext + 'w', '.wld'):
+        for world_path in (base + world_ext, base + world_ext.upper()):
+            if os.path.isfile(world_path):
+                with open(world_path) as f:
+                    a, d, b, e, c, f_ = [float(v) for v in f.read().split()]
+                if b != 0 or d != 0:
+                    raise RasterError(
+                        "Rotated raster {} is not supported.".format(path))
+                return c - a/2, f_ - e/2, a, -e
+    return None
+
+
+class GeoTiffRaster(object):
+    """
+    An uncompressed GeoTIFF, memory-mapped so reading pixels only touches
+    the parts of the file that contain them. Both striped and tiled
+    layouts are supported, as long as the strips or tiles are stored
+    contiguously, as uncompressed files are usually written.
+
+    Parameters
+    ----------
+    path : str
+        The path to the GeoTIFF file. The georeferencing is read from the
+        GeoTIFF tags or from a world file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        tags, byteorder = read_tiff_tags(path)
+
+        def tag(number, default=None):
+            if number in tags:
+                return tags[number]
+            if default is None:
+                raise RasterError("{} misses TIFF tag {}.".format(
+                    path, number))
+            return np.array(default)
+
+        if int(tag(259, [1])[0]) != 1:
+            raise RasterError("{} is compressed.".format(path))
+        if int(tag(284, [1])[0]) != 1:
+            raise RasterError("{} is not pixel interleaved.".format(path))
+
+        self.width = int(tag(256)[0])
+        self.height = int(tag(257)[0])
+        bands = int(tag(277, [1])[0])
+        bits = int(tag(258, [8])[0])
+        if bits not in (8, 16) or int(tag(339, [1])[0]) != 1:
+            raise RasterError("{} is not 8 or 16 bit unsigned.".format(path))
+        dtype = np.dtype('u{}'.format(bits // 8)).newbyteorder(byteorder)
+
+        if 322 in tags:
+            tile_width = int(tag(322)[0])
+            tile_height = int(tag(323)[0])
+            offsets = tag(324)
+            counts = tag(325)
+            shape = ((self.height + tile_height - 1) // tile_height,
+                     (self.width + tile_width - 1) // tile_width,
+                     tile_height, tile_width, bands)
+            self.tile_size = (tile_height, tile_width)
+        else:
+            offsets = tag(273)
+            counts = tag(279)
+            shape = (self.height, self.width, bands)
+            self.tile_size = None
+
+        if np.any(offsets[1:] != offsets[:-1] + counts[:-1]):
+            raise RasterError("The strips or tiles of {} are not stored "
+                              "contiguously.".format(path))
+        self.data = np.memmap(path, dtype=dtype, mode='r',
+                              offset=int(offsets[0]), shape=shape)
+
+        transform = world_file(path)
+        if transform is None:
+            if 33550 not in tags or 33922 not in tags:
+                raise RasterError("{} is not georeferenced.".format(path))
+            res_x, res_y = tags[33550][:2]
+            i, j, _, x, y, _ = tags[33922][:6]
+            left = x - i*res_x
+            top = y + j*res_y
+            # GTRasterTypeGeoKey, PixelIsPoint refers to the pixel center
+            keys = tags.get(34735, np.zeros(4)).reshape(-1, 4)
+            if any(k[0] == 1025 and k[3] == 2 for k in keys[1:]):
+                left -= res_x / 2
+                top += res_y / 2
+            transform = (left, top, res_x, res_y)
+        self.left, self.top, self.res_x, self.res_y = [
+            float(v) for v in transform]
+
+    def pixels(self, rows, cols):
+        """
+        The values of the pixels at the rows and columns.
+        """
+        if self.tile_size is None:
+            return self.data[rows, cols]
+        th, tw = self.tile_size
+        return self.data[rows // th, cols // tw, rows % th, cols % tw]
+
+
+class GDALRaster(object):
+    """
+    A raster read with GDAL, for formats that can not be memory-mapped
+    (VRT, compressed GeoTIFF, ...). The pixels are read in windows.
+    """
+
+    def __init__(self, path):
+        try:
+            from osgeo import gdal
+        except ImportError:
+            raise RasterError("{} can only be read with GDAL, which is not "
+                              "installed.".format(path))
+        self.path = path
+        self.dataset = gdal.Open(path)
+        if self.dataset is None:
+            raise RasterError("Could not open {}.".format(path))
+        left, res_x, rot_x, top, rot_y, res_y = \
+            self.dataset.GetGeoTransform()
+        if rot_x != 0 or rot_y != 0:
+            raise RasterError(
+                "Rotated raster {} is not supported.".format(path))
+        self.left, self.top, self.res_x, self.res_y = left, top, res_x, -res_y
+        self.width = self.dataset.RasterXSize
+        self.height = self.dataset.RasterYSize
+        self.bands = list(range(1, min(3, self.dataset.RasterCount) + 1))
+        self._lock = threading.Lock()
+
+    def pixels(self, rows, cols):
+        """
+        The values of the pixels at the rows and columns, read as a single
+        window.
+        """
+        r0, r1 = int(rows.min()), int(rows.max())
+        c0, c1 = int(cols.min()), int(cols.max())
+        with self._lock:
+            window = self.dataset.ReadAsArray(c0, r0, c1-c0+1, r1-r0+1,
+                                              band_list=self.bands)
+        if window.ndim == 2:
+            window = window[np.newaxis]
+        return window[:, rows-r0, cols-c0].T
+
+
+def open_raster(path):
+    """
+    Open a raster, memory-mapped if it is an uncompressed GeoTIFF and with
+    GDAL otherwise.
+    """
+    if path.lower().endswith(('.tif', '.tiff')):
+        try:
+            return GeoTiffRaster(path)
+        except RasterError:
+            pass
+    return GDALRaster(path)
+
+
+class RasterSource(object):
+    """
+    Local orthophotos to colorize from instead of a WMS service: a raster
+    file or a folder of raster tiles. Points are sampled directly from the
+    (memory-mapped) rasters, only reading the pixels that are needed.
+
+    Parameters
+    ----------
+    path : str
+        The path to a raster file (GeoTIFF, VRT, or anything GDAL reads) or
+        a folder of raster tiles.
+    """
+
+    def __init__(self, path):
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, f) for f in os.listdir(path)
+                           if f.lower().endswith(RASTER_EXTENSIONS))
+        else:
+            files = [path]
+        if not files:
+            raise RasterError("No rasters found in {}.".format(path))
+
+        self.rasters = [open_raster(f) for f in files]
+        self.bounds = np.array([[r.left, r.top - r.height*r.res_y,
+                                 r.left + r.width*r.res_x, r.top]
+                                for r in self.rasters])
+
+    def sample(self, X, Y, out=None, method='nearest',
+               chunk_size=SAMPLE_CHUNK_SIZE):
+        """
+        Sample the colors of points. Points outside the rasters are black.
+
+        Parameters
+        ----------
+        X, Y : array
+            The coordinates of the points.
+        out : array of uint16
+            The (3, n) array to write the colors to. (default: None, a new
+            array is created)
+        method : str
+            'nearest' or 'bilinear' interpolation.
+        chunk_size : int
+            The number of points to process at a time.
+
+        Returns
+        -------
+        out : array of uint16
+            The red, green and blue values of the points, shape (3, n).
+        """
+        if method not in ('nearest', 'bilinear'):
+            raise ValueError("Unknown interpolation method: {}".format(method))
+        n = len(X)
+        if out is None:
+            out = np.zeros((3, n), dtype=np.uint16)
+
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            cX = np.asarray(X[start:stop])
+            cY = np.asarray(Y[start:stop])
+            bbox = point_bbox(cX, cY)
+            overlap = ((self.bounds[:, 0] <= bbox[2]) &
+                       (self.bounds[:, 2] >= bbox[0]) &
+                       (self.bounds[:, 1] <= bbox[3]) &
+                       (self.bounds[:, 3] >= bbox[1]))
+            # A point on the border of two rasters is sampled from the
+            # raster east or south of it. Points on the outer east and south
+            # borders of the rasters are left for a second pass including
+            # those borders.
+            todo = np.ones(len(cX), dtype=bool)
+            for closed in (False, True):
+                for i in np.flatnonzero(overlap):
+                    raster = self.rasters[i]
+                    xmin, ymin, xmax, ymax = self.bounds[i]
+                    if closed:
+                        inside = np.flatnonzero(todo &
+                                                (cX >= xmin) & (cX <= xmax) &
+                                                (cY >= ymin) & (cY <= ymax))
+                    else:
+                        inside = np.flatnonzero((cX >= xmin) & (cX < xmax) &
+                                                (cY > ymin) & (cY <= ymax))
+                    if len(inside) == 0:
+                        continue
+                    col = (cX[inside] - raster.left) / raster.res_x
+                    row = (raster.top - cY[inside]) / raster.res_y
+                    out[:, start + inside] = self._sample(raster, row, col,
+                                                          method).T
+                    todo[inside] = False
+                if not todo.any():
+                    break
+        return out
+
+    @staticmethod
+    def _sample(raster, row, col, method):
+        w, h = raster.width, raster.height
+        if method == 'nearest':
+            cols = np.clip(col.astype(np.intp), 0, w-1)
+            rows = np.clip(row.astype(np.intp), 0, h-1)
+            return raster_rgb(raster.pixels(rows, cols))
+
+        # relative to the pixel centers
+        col = np.clip(col - 0.5, 0, w-1)
+        row = np.clip(row - 0.5, 0, h-1)
+        c0 = col.astype(np.intp)
+        r0 = row.astype(np.intp)
+        c1 = np.minimum(c0 + 1, w-1)
+        r1 = np.minimum(r0 + 1, h-1)
+        wx = (col - c0)[:, np.newaxis]
+        wy = (row - r0)[:, np.newaxis]
+        rgb = (raster_rgb(raster.pixels(r0, c0)) * ((1-wx) * (1-wy)) +
+               raster_rgb(raster.pixels(r0, c1)) * (wx * (1-wy)) +
+               raster_rgb(raster.pixels(r1, c0)) * ((1-wx) * wy) +
+               raster_rgb(raster.pixels(r1, c1)) * (wx * wy))
+        return np.rint(rgb)
+
+
+def raster_rgb(values):
+    """
+    Convert the band values of pixels to 8 bit RGB, shape (n, 3).
+    """
+    if values.ndim == 1:
+        values = values[:, np.newaxis]
+    if values.shape[1] < 3:
+        values = values[:, :1].repeat(3, axis=1)
+    values = values[:, :3]
+    if values.dtype.itemsize == 2:
+        values = values >> 8
+    return values.astype(np.uint8)
+
+
+def get_raster(path):
+    """
+    Get the RasterSource for a path, opened once per process.
+    """
+    key = os.path.abspath(path)
+    with _clients_lock:
+        if key not in _rasters:
+            _rasters[key] = RasterSource(path)
+        return _rasters[key]
+
+
+def wms_image(bbox, wms, occupancy=None):
+    """
+    Retrieve the orthophoto of a bounding box with the WMS arguments.
+
+    Parameters
+    ----------
+    bbox : list of float
+        [xmin, ymin, xmax, ymax]
+    wms : dict
+        The WMS arguments (wms_url, wms_layer, wms_srs, wms_version,
+        wms_format, wms_ppm, wms_max_image_size and optionally
+        wms_concurrency, wms_rate, wms_max_requests, wms_cache_dir,
+        wms_cache_size and wms_cache_only).
+    occupancy : OccupancyGrid
+        The parts of the bbox containing points. (default: None, request
+        the whole bbox)
+
+    Returns
+    -------
+    img : array of uint8
+        The RGB image.
+    """
+    client = wms_client(wms)
+    return retrieve_image(bbox, wms['wms_url'], wms['wms_layer'],
+                          wms['wms_srs'], wms['wms_version'],
+                          image_format(wms), int(wms['wms_ppm']),
+                          max_image_size(wms),
+                          int(wms.get('wms_concurrency', DEFAULT_CONCURRENCY)),
+                          wms_cache(wms), occupancy, client.rate,
+                          client.max_requests)
+
+
+def wms_cache(wms):
+    """
+    The image cache of the WMS arguments, or None if there is no cache.
+    """
+    if not wms.get('wms_cache_dir'):
+        return None
+    return get_cache(wms['wms_cache_dir'],
+                     int(wms.get('wms_cache_size', DEFAULT_CACHE_SIZE)),
+                     str(wms.get('wms_cache_only')) == 'True')
+
+
+def prefetch_shared_cells(bboxes, wms, min_count=2):
+    """
+    Request the cache cells shared by the bounding boxes of multiple files
+    once, before the files are colorized. Otherwise files processed at the
+    same time request the cells on their common border separately.
+
+    Parameters
+    ----------
+    bboxes : list of list of float
+        The [xmin, ymin, xmax, ymax] of each file.
+    wms : dict
+        The WMS arguments, with a cache (see `wms_image`).
+    min_count : int
+        The minimum number of files sharing a cell to prefetch it.
+
+    Returns
+    -------
+    fetched : int
+        The number of cells requested.
+    """
+    cache = wms_cache(wms)
+    if cache is None or cache.cache_only:
+        return 0
+
+    ppm = int(wms['wms_ppm'])
+    wms_format = image_format(wms)
+    max_size = max_image_size(wms)
+    length_pixels = CACHE_CELL_PIXELS
+    length = length_pixels / ppm
+    counts = {}
+    for bbox in bboxes:
+        col_min, col_max, row_min, row_max = grid_range(bbox, length, length)
+        for col in range(col_min, col_max + 1):
+            for row in range(row_min, row_max + 1):
+                counts[(col, row)] = counts.get((col, row), 0) + 1
+
+    cells = []
+    for (col, row), count in counts.items():
+        key = cache.key(wms['wms_url'], wms['wms_layer'], wms['wms_srs'],
+                        wms_format, ppm, length_pixels, col, row)
+        if count >= min_count and not cache.contains(key):
+            cells.append((grid_cell(col, row, length, length), key))
+
+    concurrency = int(wms.get('wms_concurrency', DEFAULT_CONCURRENCY))
+    client = wms_client(wms)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(request_cell, cell,
+                                   (length_pixels, length_pixels), max_size,
+                                   wms['wms_url'], wms['wms_layer'],
+                                   wms['wms_srs'], wms['wms_version'],
+                                   wms_format, RETRIES, cache, key, client)
+                   for cell, key in cells]
+        for future in as_completed(futures):
+            future.result()
+
+    return len(cells)
+
+
+def colorize(X, Y, wms, method='nearest'):
+    """
+    Compute the colors of points from an orthophoto of their bounding box,
+    or from local rasters if the `raster` argument is given.
+
+    Parameters
+    ----------
+    X, Y : array
+        The coordinates of the points.
+    wms : dict
+        The WMS arguments, see `wms_image`, and optionally the path to a
+        raster file or folder of raster tiles (raster).
+    method : str
+        'nearest' or 'bilinear' interpolation.
+
+    Returns
+    -------
+    red, green, blue : array of uint16
+    """
+    if wms.get('raster'):
+        with timed('sampling', points=len(X)):
+            red, green, blue = get_raster(wms['raster']).sample(
+                X, Y, method=method)
+        return red, green, blue
+
+    bbox = point_bbox(X, Y)
+
+    occupancy = OccupancyGrid(bbox)
+    occupancy.add(X, Y)
+
+    img = wms_image(bbox, wms, occupancy)
+
+    with timed('sampling', points=len(X)):
+        red, green, blue = sample_image(img, bbox, X, Y, method=method)
+
+    return red, green, blue
 
 
 def las_colorize(ins, outs):
@@ -115,30 +1457,14 @@ def las_colorize(ins, outs):
     ----------
 
     """
+    global stage_hook
     wms = pdalargs
     if isinstance(pdalargs, str):
         wms = json.loads(pdalargs)
-    X = ins['X']
-    Y = ins['Y']
-
-    [xmin, ymin, xmax, ymax] = bbox = [min(X), min(Y), max(X), max(Y)]
-
-    img = retrieve_image(bbox, wms['wms_url'], wms['wms_layer'],
-                         wms['wms_srs'], wms['wms_version'],
-                         wms['wms_format'], int(wms['wms_ppm']),
-                         int(wms['wms_max_image_size']))
-
-    img_size = img.shape[:2]
-
-    x_img = np.round(((X - xmin) / (xmax-xmin)) *
-                     (img_size[1]-1)).astype(int)
-    y_img = np.round(((ymax - Y) / (ymax-ymin)) *
-                     (img_size[0]-1)).astype(int)
-
-    rgb = img[y_img, x_img] * 255
+    if wms.get('metrics_file') and stage_hook is None:
+        stage_hook = metrics_file_hook(wms['metrics_file'])
 
-    outs['Red'] = np.array(rgb[:, 0], dtype=np.uint16)
-    outs['Green'] = np.array(rgb[:, 1], dtype=np.uint16)
-    outs['Blue'] = np.array(rgb[:, 2], dtype=np.uint16)
+    outs['Red'], outs['Green'], outs['Blue'] = colorize(
+        ins['X'], ins['Y'], wms, wms.get('interpolation', 'nearest'))
 
     return True
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+@author: Chris Lucas
+
+Tests that the colorize engine gives the same colors as the PDAL filter
+(`pdal_colorize.las_colorize`) for the same points, against the fake WMS
+service of the benchmarks. Run with pytest.
+"""
+
+import os
+import sys
+import numpy as np
+import pytest
+import laspy
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'benchmark'))
+import pdal_colorize  # noqa: E402
+from colorize_engine import ColorizeEngine  # noqa: E402
+from fake_services import FakeWMS  # noqa: E402
+from synthetic import synthetic_tile  # noqa: E402
+
+BOUNDS = [120000, 487000, 120150, 487100]
+
+
+@pytest.fixture(scope='module')
+def wms_service():
+    with FakeWMS(max_size=500, latency=0) as service:
+        yield service
+
+
+@pytest.fixture(scope='module')
+def tile(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('tiles') / 'tile.laz')
+    synthetic_tile(path, BOUNDS, 10, seed=1)
+    return path
+
+
+def wms_args(service, interpolation):
+    return {'wms_url': service.url,
+            'wms_layer': service.layer,
+            'wms_srs': 'EPSG:28992',
+            'wms_version': '1.3.0',
+            'wms_format': 'image/png',
+            'wms_ppm': 4,
+            'wms_max_image_size': None,
+            'wms_concurrency': 2,
+            'interpolation': interpolation}
+
+
+@pytest.mark.parametrize('interpolation', ['nearest', 'bilinear'])
+@pytest.mark.parametrize('chunk_size', [10000000, 50000])
+def test_engine_matches_pdal_filter(tmp_path, wms_service, tile,
+                                    interpolation, chunk_size):
+    wms = wms_args(wms_service, interpolation)
+    output = str(tmp_path / 'tile_color.laz')
+    ColorizeEngine(wms, chunk_size=chunk_size).colorize_file(tile, output)
+    colored = laspy.read(output)
+
+    points = laspy.read(tile)
+    outs = {}
+    pdal_colorize.pdalargs = wms
+    pdal_colorize.las_colorize({'X': np.asarray(points.x),
+                                'Y': np.asarray(points.y)}, outs)
+
+    assert colored.header.point_count == len(points.x)
+    for name, dimension in (('Red', 'red'), ('Green', 'green'),
+                            ('Blue', 'blue')):
+        assert np.array_equal(np.asarray(colored[dimension]), outs[name])
+    # the colors come from the image, not a blank fallback
+    assert np.count_nonzero(outs['Red']) > 0
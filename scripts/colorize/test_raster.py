@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+@author: Chris Lucas
+
+Tests of colorizing from local rasters: a small uncompressed GeoTIFF
+written with Pillow, sampled at the pixel centers and inside the pixels.
+Run with pytest.
+"""
+
+import numpy as np
+import pytest
+from PIL import Image, TiffImagePlugin
+
+from pdal_colorize import RasterSource
+
+LEFT = 1000.0
+TOP = 2000.0
+RES = 0.5
+WIDTH = 40
+HEIGHT = 30
+
+
+@pytest.fixture(scope='module')
+def image():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (HEIGHT, WIDTH, 3), dtype=np.uint8)
+
+
+@pytest.fixture(scope='module')
+def geotiff(tmp_path_factory, image):
+    # georeferenced with the ModelPixelScale and ModelTiepoint tags
+    path = str(tmp_path_factory.mktemp('raster') / 'ortho.tif')
+    info = TiffImagePlugin.ImageFileDirectory_v2()
+    info[33550] = (RES, RES, 0.0)
+    info.tagtype[33550] = 12  # DOUBLE
+    info[33922] = (0.0, 0.0, 0.0, LEFT, TOP, 0.0)
+    info.tagtype[33922] = 12  # DOUBLE
+    Image.fromarray(image).save(path, tiffinfo=info)
+    return path
+
+
+@pytest.fixture(scope='module')
+def world_file_tiff(tmp_path_factory, image):
+    # georeferenced with a world file, which refers to the pixel center
+    folder = tmp_path_factory.mktemp('world')
+    path = str(folder / 'ortho.tif')
+    Image.fromarray(image).save(path)
+    with open(str(folder / 'ortho.tfw'), 'w') as f:
+        f.write('\n'.join(str(v) for v in (RES, 0, 0, -RES, LEFT + RES/2,
+                                           TOP - RES/2)))
+    return path
+
+
+def pixel_centers():
+    rows, cols = np.mgrid[0:HEIGHT, 0:WIDTH]
+    rows = rows.ravel()
+    cols = cols.ravel()
+    return (LEFT + (cols + 0.5) * RES, TOP - (rows + 0.5) * RES, rows, cols)
+
+
+def bilinear(image, X, Y):
+    col = np.clip((X - LEFT) / RES - 0.5, 0, WIDTH - 1)
+    row = np.clip((TOP - Y) / RES - 0.5, 0, HEIGHT - 1)
+    c0 = np.floor(col).astype(int)
+    r0 = np.floor(row).astype(int)
+    c1 = np.minimum(c0 + 1, WIDTH - 1)
+    r1 = np.minimum(r0 + 1, HEIGHT - 1)
+    wx = (col - c0)[:, np.newaxis]
+    wy = (row - r0)[:, np.newaxis]
+    img = image.astype(float)
+    rgb = (img[r0, c0] * (1-wx) * (1-wy) + img[r0, c1] * wx * (1-wy) +
+           img[r1, c0] * (1-wx) * wy + img[r1, c1] * wx * wy)
+    return rgb.T
+
+
+@pytest.mark.parametrize('raster', ['geotiff', 'world_file_tiff'])
+@pytest.mark.parametrize('method', ['nearest', 'bilinear'])
+def test_pixel_centers(request, image, raster, method):
+    source = RasterSource(request.getfixturevalue(raster))
+    X, Y, rows, cols = pixel_centers()
+    rgb = source.sample(X, Y, method=method)
+    assert np.array_equal(rgb, image[rows, cols].T)
+
+
+def test_nearest_inside_pixels(geotiff, image):
+    source = RasterSource(geotiff)
+    X, Y, rows, cols = pixel_centers()
+    rng = np.random.default_rng(1)
+    X = X + rng.uniform(-0.49, 0.49, len(X)) * RES
+    Y = Y + rng.uniform(-0.49, 0.49, len(Y)) * RES
+    rgb = source.sample(X, Y, method='nearest')
+    assert np.array_equal(rgb, image[rows, cols].T)
+
+
+def test_bilinear_inside_pixels(geotiff, image):
+    source = RasterSource(geotiff)
+    rng = np.random.default_rng(2)
+    X = rng.uniform(LEFT, LEFT + WIDTH * RES, 10000)
+    Y = rng.uniform(TOP - HEIGHT * RES, TOP, 10000)
+    rgb = source.sample(X, Y, method='bilinear')
+    expected = bilinear(image, X, Y)
+    assert np.abs(rgb.astype(float) - expected).max() <= 0.5 + 1e-6
+
+
+@pytest.mark.parametrize('method', ['nearest', 'bilinear'])
+def test_outer_edges(geotiff, image, method):
+    # points on the outer borders get the colors of the border pixels
+    source = RasterSource(geotiff)
+    rows = np.arange(HEIGHT)
+    cols = np.arange(WIDTH)
+    east = LEFT + WIDTH * RES
+    south = TOP - HEIGHT * RES
+    X = np.concatenate([np.full(HEIGHT, east), LEFT + (cols + 0.5) * RES,
+                        np.full(HEIGHT, LEFT), LEFT + (cols + 0.5) * RES])
+    Y = np.concatenate([TOP - (rows + 0.5) * RES, np.full(WIDTH, south),
+                        TOP - (rows + 0.5) * RES, np.full(WIDTH, TOP)])
+    rgb = source.sample(X, Y, method=method)
+    expected = np.concatenate([image[rows, WIDTH - 1], image[HEIGHT - 1, cols],
+                               image[rows, 0], image[0, cols]])
+    assert np.array_equal(rgb, expected.T)
+
+
+def test_outside_is_black(geotiff):
+    source = RasterSource(geotiff)
+    rgb = source.sample(np.array([LEFT - 1, LEFT + 1]),
+                        np.array([TOP - 1, TOP + 1]))
+    assert not rgb.any()
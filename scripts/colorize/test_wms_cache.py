@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+@author: Chris Lucas
+
+Tests of the WMS image cache: a run with the cache only (wms_cache_only)
+finds the cells cached by an online run, against the fake WMS service of
+the benchmarks. Run with pytest.
+"""
+
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'benchmark'))
+import pdal_colorize  # noqa: E402
+from fake_services import FakeWMS  # noqa: E402
+
+BOUNDS = [120000, 487000, 120400, 487300]
+
+
+@pytest.fixture(scope='module')
+def wms_service():
+    # smaller than the cached cells, which are requested in parts
+    with FakeWMS(max_size=500, latency=0) as service:
+        yield service
+
+
+@pytest.fixture(scope='module')
+def points():
+    rng = np.random.default_rng(0)
+    X = rng.uniform(BOUNDS[0], BOUNDS[2], 20000)
+    Y = rng.uniform(BOUNDS[1], BOUNDS[3], 20000)
+    return X, Y
+
+
+def wms_args(service, wms_format='image/png', cache_dir=None,
+             cache_only=False):
+    wms = {'wms_url': service.url,
+           'wms_layer': service.layer,
+           'wms_srs': 'EPSG:28992',
+           'wms_version': '1.3.0',
+           'wms_format': wms_format,
+           'wms_ppm': 4,
+           'wms_max_image_size': None,
+           'wms_concurrency': 2}
+    if cache_dir is not None:
+        wms.update({'wms_cache_dir': cache_dir,
+                    'wms_cache_size': 100,
+                    'wms_cache_only': cache_only})
+    return wms
+
+
+@pytest.mark.parametrize('method', ['nearest', 'bilinear'])
+def test_cache_only_after_online(tmp_path, wms_service, points, method):
+    X, Y = points
+    cache_dir = str(tmp_path / 'cache')
+    expected = pdal_colorize.colorize(X, Y, wms_args(wms_service), method)
+
+    online = pdal_colorize.colorize(
+        X, Y, wms_args(wms_service, cache_dir=cache_dir), method)
+    requests = wms_service.stats['requests']
+    cached = pdal_colorize.colorize(
+        X, Y, wms_args(wms_service, cache_dir=cache_dir, cache_only=True),
+        method)
+
+    assert wms_service.stats['requests'] == requests
+    for e, o, c in zip(expected, online, cached):
+        assert np.array_equal(o, e)
+        assert np.array_equal(c, e)
+
+
+def test_prefetch_shared_cells(tmp_path, wms_service):
+    cache_dir = str(tmp_path / 'cache')
+    wms = wms_args(wms_service, cache_dir=cache_dir)
+    bboxes = [[120000, 487000, 120300, 487100],
+              [120200, 487000, 120500, 487100]]
+    assert pdal_colorize.prefetch_shared_cells(bboxes, wms) == 1
+
+    X = np.array([120250.0, 120260.0])
+    Y = np.array([487050.0, 487060.0])
+    colors = pdal_colorize.colorize(
+        X, Y, wms_args(wms_service, cache_dir=cache_dir, cache_only=True))
+    assert np.array_equal(colors, pdal_colorize.colorize(
+        X, Y, wms_args(wms_service)))
+
+
+def test_cache_only_auto_format(tmp_path, wms_service, points):
+    # the service supports JPEG, which 'auto' prefers to PNG
+    X, Y = points
+    cache_dir = str(tmp_path / 'cache')
+    online = pdal_colorize.colorize(
+        X, Y, wms_args(wms_service, 'auto', cache_dir))
+    requests = wms_service.stats['requests']
+    wms = wms_args(wms_service, 'auto', cache_dir, cache_only=True)
+    assert pdal_colorize.image_format(wms) == 'image/jpeg'
+    cached = pdal_colorize.colorize(X, Y, wms)
+
+    assert wms_service.stats['requests'] == requests
+    for o, c in zip(online, cached):
+        assert np.array_equal(c, o)
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+Chris Lucas
+
+Run a batch of per-file jobs on a pool of workers, with a memory budget.
+"""
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import las_io
+
+# Rough memory use of PDAL per point (all dimensions stored as doubles)
+MEMORY_PER_POINT = 100
+
+
+def available_memory():
+    """
+    The available memory in bytes, or None if it can not be determined.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+class Job(object):
+    """
+    A job processing a single point cloud file.
+
+    Parameters
+    ----------
+    name : str
+        The path of the input file.
+    func : callable
+        The function to call, raising an exception if the job failed.
+    *args
+        The arguments to call `func` with.
+    """
+
+    def __init__(self, name, func, *args):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.size = sum(os.path.getsize(f) for f in las_io.source_files(name))
+        try:
+            self.point_count = las_io.read_bounds(name)[1]
+        except Exception:
+            self.point_count = None
+        self.memory = (self.point_count or 0) * MEMORY_PER_POINT
+        self.elapsed = None
+        self.error = None
+
+    def run(self):
+        start = time.time()
+        try:
+            self.func(*self.args)
+        except Exception as e:
+            self.error = e
+        self.elapsed = time.time() - start
+        return self
+
+
+class MemoryBudget(object):
+    """
+    Limits the combined estimated memory of the running jobs. A job that
+    exceeds the budget on its own runs once nothing else is running.
+    """
+
+    def __init__(self, max_memory=None):
+        self.max_memory = max_memory
+        self.reserved = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, memory):
+        with self._condition:
+            if self.max_memory is not None:
+                self._condition.wait_for(
+                    lambda: (self.reserved == 0 or
+                             self.reserved + memory <= self.max_memory))
+            self.reserved += memory
+
+    def release(self, memory):
+        with self._condition:
+            self.reserved -= memory
+            self._condition.notify_all()
+
+
+def run_batch(jobs, workers=1, max_memory=None, verbose=False):
+    """
+    Run the jobs on a pool of workers, largest input first. A failing job
+    is reported without stopping the batch.
+
+    Parameters
+    ----------
+    jobs : list of Job
+        The jobs to run.
+    workers : int
+        The maximum number of jobs to run at the same time.
+    max_memory : int
+        The memory budget in bytes for all running jobs together.
+        (default: None, 80% of the available memory)
+    verbose : bool
+        Print each job when it finishes.
+
+    Returns
+    -------
+    failed : list of Job
+        The jobs that failed.
+    """
+    if max_memory is None:
+        available = available_memory()
+        max_memory = int(available * 0.8) if available else None
+    budget = MemoryBudget(max_memory)
+    jobs = sorted(jobs, key=lambda j: j.size, reverse=True)
+
+    def run(job):
+        budget.acquire(job.memory)
+        try:
+            if verbose:
+                print('Processing {} ..'.format(job.name))
+            return job.run()
+        finally:
+            budget.release(job.memory)
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for job in executor.map(run, jobs):
+            if verbose and job.error is not None:
+                print('Failed {}: {}'.format(job.name, job.error))
+    elapsed = time.time() - start
+
+    print_summary(jobs, elapsed)
+    return [j for j in jobs if j.error is not None]
+
+
+def print_summary(jobs, elapsed):
+    """
+    Print the time and throughput of each job and of the whole batch.
+    """
+    print('{:<40}{:>10}{:>10}{:>14}  {}'.format(
+        'file', 'time (s)', 'mb/s', 'points/s', 'status'))
+    for job in jobs:
+        name = os.path.basename(job.name)
+        elapsed_job = max(job.elapsed, 1e-9)
+        points = ('{:>14.0f}'.format(job.point_count / elapsed_job)
+                  if job.point_count is not None else '{:>14}'.format('-'))
+        status = 'ok' if job.error is None else 'FAILED: {}'.format(job.error)
+        print('{:<40}{:>10.1f}{:>10.2f}{}  {}'.format(
+            name[-40:], job.elapsed, job.size / 1048576 / elapsed_job,
+            points, status))
+
+    total_size = sum(j.size for j in jobs)
+    failed = sum(1 for j in jobs if j.error is not None)
+    print('{} files ({} failed), {:.1f} mb in {:.1f} s ({:.2f} mb/s)'.format(
+        len(jobs), failed, total_size / 1048576, elapsed,
+        total_size / 1048576 / max(elapsed, 1e-9)))
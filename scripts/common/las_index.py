@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+Chris Lucas
+
+A persistent spatial index of the point cloud files in a folder, built from
+the LAS header bounds. The index is stored next to the data and only the
+files that were added or changed (by modification time and size) since the
+last run are read again.
+"""
+
+import os
+import json
+import numpy as np
+import las_io
+
+INDEX_FILE = '.las_index.json'
+INDEX_VERSION = 1
+
+
+class LasIndex(object):
+    """
+    The header bounds of the LAS/LAZ files and virtual datasets in a
+    folder.
+
+    Parameters
+    ----------
+    folder : str
+        The folder containing the point cloud files.
+    update : bool
+        Bring the index up to date with the folder when loading it.
+    """
+
+    def __init__(self, folder, update=True):
+        self.folder = folder
+        self.path = os.path.join(folder, INDEX_FILE)
+        self.entries = {}
+        try:
+            with open(self.path) as f:
+                index = json.load(f)
+            if index.get('version') == INDEX_VERSION:
+                self.entries = index['files']
+        except (IOError, ValueError):
+            pass
+        if update:
+            self.update()
+
+    def update(self):
+        """
+        Read the bounds of new and changed files and drop removed files.
+        The index file is rewritten if anything changed.
+
+        Returns
+        -------
+        changed : int
+            The number of files (re)read or removed.
+        """
+        names = las_io.list_point_files(self.folder)
+        changed = 0
+        for name in set(self.entries) - set(names):
+            del self.entries[name]
+            changed += 1
+
+        for name in names:
+            stat = os.stat(os.path.join(self.folder, name))
+            entry = self.entries.get(name)
+            if (entry is not None and entry['size'] == stat.st_size and
+                    entry['mtime'] == stat.st_mtime):
+                continue
+            bounds, point_count = las_io.read_bounds(
+                os.path.join(self.folder, name))
+            self.entries[name] = {'size': stat.st_size,
+                                  'mtime': stat.st_mtime,
+                                  'bounds': [float(b) for b in bounds],
+                                  'point_count': int(point_count)}
+            changed += 1
+
+        if changed:
+            self.save()
+        return changed
+
+    def save(self):
+        """
+        Write the index next to the data. A read-only folder is not an
+        error, the index is then rebuilt on the next run.
+        """
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': INDEX_VERSION, 'files': self.entries},
+                          f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError):
+            pass
+
+    def names(self):
+        return sorted(self.entries)
+
+    def bounds(self, name):
+        """
+        The 2D bounds [xmin, ymin, xmax, ymax] of a file.
+        """
+        b = self.entries[name]['bounds']
+        return [b[0], b[1], b[3], b[4]]
+
+    def point_count(self, name):
+        return self.entries[name]['point_count']
+
+    def intersecting(self, bbox):
+        """
+        The files whose bounds intersect a bounding box.
+
+        Parameters
+        ----------
+        bbox : list of float
+            [xmin, ymin, xmax, ymax]
+        """
+        names = self.names()
+        if not names:
+            return []
+        bounds = np.array([self.bounds(n) for n in names])
+        hits = ((bounds[:, 0] <= bbox[2]) & (bounds[:, 2] >= bbox[0]) &
+                (bounds[:, 1] <= bbox[3]) & (bounds[:, 3] >= bbox[1]))
+        return [n for n, hit in zip(names, hits) if hit]
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+Chris Lucas
+
+Chunked reading and writing of LAS/LAZ files and virtual datasets.
+
+A virtual dataset (.lasvrt) is a small JSON manifest listing several
+LAS/LAZ files with their combined header bounds and point count. It can be
+read as a single point cloud without merging the files.
+"""
+
+import os
+import json
+import tempfile
+import numpy as np
+import laspy
+from laspy.point import dims
+
+LAS_EXTENSIONS = ('.las', '.laz')
+MANIFEST_EXT = '.lasvrt'
+DEFAULT_CHUNK_SIZE = 1000000
+
+
+def is_manifest(path):
+    return path.lower().endswith(MANIFEST_EXT)
+
+
+def is_point_file(path):
+    return path.lower().endswith(LAS_EXTENSIONS + (MANIFEST_EXT,))
+
+
+def read_manifest(path):
+    """
+    Read a virtual dataset manifest. The file paths in the manifest are
+    relative to the manifest and are returned as absolute paths.
+    """
+    with open(path) as f:
+        manifest = json.load(f)
+    folder = os.path.dirname(os.path.abspath(path))
+    manifest['files'] = [os.path.join(folder, f) for f in manifest['files']]
+    return manifest
+
+
+def write_manifest(inputs, output):
+    """
+    Write a virtual dataset manifest combining the given LAS/LAZ files.
+
+    Parameters
+    ----------
+    inputs : list of str
+        The paths to the LAS/LAZ files.
+    output : str
+        The path to the manifest to write (.lasvrt).
+
+    Returns
+    -------
+    manifest : dict
+        The written manifest.
+    """
+    if not inputs:
+        raise ValueError("No input files to combine.")
+    folder = os.path.dirname(os.path.abspath(output))
+    mins = []
+    maxs = []
+    point_count = 0
+    for path in inputs:
+        with laspy.open(path) as reader:
+            mins.append(reader.header.mins)
+            maxs.append(reader.header.maxs)
+            point_count += reader.header.point_count
+
+    manifest = {'type': 'lasvrt',
+                'version': 1,
+                'files': [os.path.relpath(os.path.abspath(p), folder)
+                          .replace('\\', '/') for p in inputs],
+                'point_count': int(point_count),
+                'bounds': (np.min(mins, axis=0).tolist() +
+                           np.max(maxs, axis=0).tolist())}
+
+    with open(output, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    return manifest
+
+
+def source_files(path):
+    """
+    The LAS/LAZ files making up a point cloud file or virtual dataset.
+    """
+    if is_manifest(path):
+        return read_manifest(path)['files']
+    return [path]
+
+
+def list_point_files(folder):
+    """
+    List the LAS/LAZ files and virtual datasets in a folder. Files that are
+    part of a virtual dataset in the same folder are left out, so every
+    point is listed once.
+    """
+    names = sorted(f for f in os.listdir(folder) if is_point_file(f))
+    members = set()
+    for f in names:
+        if is_manifest(f):
+            members.update(os.path.abspath(p) for p in
+                           source_files(os.path.join(folder, f)))
+    return [f for f in names
+            if os.path.abspath(os.path.join(folder, f)) not in members]
+
+
+def read_bounds(path):
+    """
+    Read the bounds of a point cloud file or virtual dataset from the
+    header(s), without reading any points.
+
+    Returns
+    -------
+    bounds : list of float
+        [xmin, ymin, zmin, xmax, ymax, zmax]
+    point_count : int
+    """
+    if is_manifest(path):
+        manifest = read_manifest(path)
+        return manifest['bounds'], manifest['point_count']
+    with laspy.open(path) as reader:
+        header = reader.header
+        return (list(header.mins) + list(header.maxs),
+                int(header.point_count))
+
+
+def read_header(path):
+    """
+    The header of a point cloud file, or of the first file of a virtual
+    dataset.
+    """
+    with laspy.open(source_files(path)[0]) as reader:
+        return reader.header
+
+
+def iter_chunks(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Iterate over the points of a point cloud file or virtual dataset in
+    chunks of at most `chunk_size` points.
+    """
+    for filename in source_files(path):
+        with laspy.open(filename) as reader:
+            for chunk in reader.chunk_iterator(chunk_size):
+                yield chunk
+
+
+def output_header(header, point_format=None):
+    """
+    Create a header for a new file, based on the header of an input file.
+    The scales, offsets and VLRs (e.g. the CRS) are copied.
+
+    Parameters
+    ----------
+    header : laspy.LasHeader
+        The header of the input file.
+    point_format : int
+        The point format of the new file. (default: None, the point format
+        of the input file)
+    """
+    if point_format is None or point_format == header.point_format.id:
+        point_format = laspy.PointFormat(header.point_format.id)
+        for dim in header.point_format.extra_dimensions:
+            point_format.add_extra_dimension(laspy.ExtraBytesParams(
+                dim.name, dim.dtype))
+        version = header.version
+    else:
+        point_format = laspy.PointFormat(point_format)
+        version = header.version
+        if not dims.is_point_fmt_compatible_with_version(point_format.id,
+                                                         str(version)):
+            version = dims.preferred_file_version_for_point_format(
+                point_format.id)
+
+    new_header = laspy.LasHeader(point_format=point_format,
+                                 version=str(version))
+    new_header.scales = header.scales
+    new_header.offsets = header.offsets
+    for vlr in header.vlrs:
+        if not isinstance(vlr, laspy.vlrs.known.ExtraBytesVlr):
+            new_header.vlrs.append(vlr)
+    return new_header
+
+
+def rgb_point_format(point_format_id):
+    """
+    The point format to write colorized points of the given point format
+    in. Formats without RGB get the RGB format PDAL would write them as.
+    """
+    if 'red' in laspy.PointFormat(point_format_id).dimension_names:
+        return point_format_id
+    return {4: 5, 6: 7, 9: 10}.get(point_format_id, 3)
+
+
+def convert_points(points, header):
+    """
+    Convert points to the point format, scales and offsets of a header.
+    Dimensions missing in the input are set to zero.
+    """
+    if (points.point_format == header.point_format and
+            np.all(points.scales == header.scales) and
+            np.all(points.offsets == header.offsets)):
+        return points
+
+    out = laspy.ScaleAwarePointRecord.zeros(len(points), header=header)
+    in_dims = set(points.point_format.dimension_names)
+    for name in out.point_format.dimension_names:
+        if name not in ('X', 'Y', 'Z') and name in in_dims:
+            out[name] = points[name]
+    out.x = points.x
+    out.y = points.y
+    out.z = points.z
+    return out
+
+
+def scaled_xy(points, header):
+    """
+    The x and y coordinates of points as they are stored with the scales
+    and offsets of a header, without converting the other dimensions.
+    """
+    xy = []
+    for i, name in enumerate(('x', 'y')):
+        values = np.asarray(points[name])
+        if (points.scales[i] != header.scales[i] or
+                points.offsets[i] != header.offsets[i]):
+            values = (np.round((values - header.offsets[i]) /
+                               header.scales[i]) *
+                      header.scales[i] + header.offsets[i])
+        xy.append(values)
+    return xy
+
+
+def merge_las(inputs, output, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Merge LAS/LAZ files into a single file, streaming the points chunk by
+    chunk so memory use is bounded by the chunk size. The header of the
+    first file is used for the output.
+
+    Parameters
+    ----------
+    inputs : list of str
+        The paths to the LAS/LAZ files (or virtual datasets) to merge.
+    output : str
+        The path to the merged LAS/LAZ file.
+    chunk_size : int
+        The number of points to read at a time.
+
+    Returns
+    -------
+    point_count : int
+        The number of points written.
+    """
+    if not inputs:
+        raise ValueError("No input files to merge.")
+    header = output_header(read_header(inputs[0]))
+
+    point_count = 0
+    with laspy.open(output, mode='w', header=header) as writer:
+        for path in inputs:
+            for chunk in iter_chunks(path, chunk_size):
+                writer.write_points(convert_points(chunk, writer.header))
+                point_count += len(chunk)
+
+    return point_count
+
+
+def pdal_reader_args(pipeline_file, input_path):
+    """
+    The arguments to pass to `pdal pipeline` to read a LAS/LAZ file or
+    virtual dataset. For a virtual dataset a temporary copy of the pipeline
+    is created with a reader for each file, followed by a merge filter.
+
+    Parameters
+    ----------
+    pipeline_file : str
+        The path to the pipeline, with a single readers.las stage.
+    input_path : str
+        The path to the LAS/LAZ file or virtual dataset.
+
+    Returns
+    -------
+    args : list of str
+        The pipeline path and reader options.
+    tmp_file : str or None
+        The path to the temporary pipeline, remove it when done.
+    """
+    if not is_manifest(input_path):
+        return ([pipeline_file,
+                 '--readers.las.filename={}'.format(input_path)], None)
+
+    with open(pipeline_file) as f:
+        pipeline = json.load(f)
+
+    stages = []
+    for stage in pipeline['pipeline']:
+        if isinstance(stage, dict) and stage.get('type') == 'readers.las':
+            for filename in source_files(input_path):
+                reader = dict(stage)
+                reader['filename'] = filename.replace('\\', '/')
+                stages.append(reader)
+            stages.append({'type': 'filters.merge'})
+        else:
+            stages.append(stage)
+    pipeline['pipeline'] = stages
+
+    fd, tmp_file = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(pipeline, f)
+
+    return [tmp_file], tmp_file
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+Chris Lucas
+
+Record where the time of a run goes: the duration of each stage (feed
+fetch, download, unzip, merge, clip, WMS request, decode, sampling, PDAL
+run, ..) with the bytes and points it processed, written as JSON lines.
+Optionally the hot stages are profiled with cProfile, to track
+performance regressions between releases.
+
+The stages are recorded by the module level `stage` context manager, which
+only measures the time until `configure` is called, so the functions of
+the scripts can be timed without passing a recorder around:
+
+    with metrics.stage('download', tile=tile_id) as record:
+        ...
+        record['bytes'] = downloaded
+"""
+
+import os
+import json
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+
+# The stages profiled with --profile, those doing the work in the calling
+# thread (the other stages mostly wait on the network or a subprocess)
+PROFILE_STAGES = ('unzip', 'merge', 'clip', 'colorize', 'decode',
+                  'sampling')
+
+
+class Metrics(object):
+    """
+    Records the stages of a run.
+
+    Parameters
+    ----------
+    path : str
+        The JSON lines file to append a line per stage to. (default: None,
+        no file)
+    profile_dir : str
+        The folder to write a cProfile dump (<stage>.prof) of each profiled
+        stage to, with the stats of all its runs added up. (default: None,
+        no profiling)
+    profile_stages : list of str
+        The stages to profile. (default: PROFILE_STAGES)
+    """
+
+    def __init__(self, path=None, profile_dir=None,
+                 profile_stages=PROFILE_STAGES):
+        self.path = path
+        self.profile_dir = profile_dir
+        self.profile_stages = set(profile_stages)
+        self.totals = {}
+        self.profiles = {}
+        self._lock = threading.Lock()
+        # the profiled stage of each thread, nested stages are part of it
+        self._profiling = threading.local()
+        self._file = None
+        if path is not None:
+            folder = os.path.dirname(os.path.abspath(path))
+            os.makedirs(folder, exist_ok=True)
+            self._file = open(path, 'a')
+        if profile_dir is not None:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """
+        Time a stage. The yielded dict is written with the timing, so the
+        bytes and points processed can be added to it when they are known.
+        A stage that raises is recorded with the error.
+        """
+        record = dict(fields)
+        profiler = None
+        if (self.profile_dir is not None and
+                name in self.profile_stages and
+                not getattr(self._profiling, 'active', False)):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                self._profiling.active = True
+            except ValueError:
+                # Python 3.12+ profiles one thread at a time
+                profiler = None
+        start = time.time()
+        try:
+            yield record
+        except Exception as e:
+            record['error'] = str(e)
+            raise
+        finally:
+            seconds = time.time() - start
+            if profiler is not None:
+                profiler.disable()
+                self._profiling.active = False
+                self.add_profile(name, profiler)
+            self.record(name, seconds, start, **record)
+
+    def record(self, name, seconds, start=None, **fields):
+        """
+        Record a stage timed elsewhere.
+        """
+        line = {'stage': name,
+                'start': start if start is not None else time.time() - seconds,
+                'seconds': seconds}
+        line.update(fields)
+        with self._lock:
+            totals = self.totals.setdefault(
+                name, {'count': 0, 'seconds': 0, 'bytes': 0, 'points': 0})
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            totals['bytes'] += fields.get('bytes') or 0
+            totals['points'] += fields.get('points') or 0
+            if self._file is not None:
+                self._file.write(json.dumps(line) + '\n')
+                self._file.flush()
+
+    def add_profile(self, name, profiler):
+        with self._lock:
+            if name in self.profiles:
+                self.profiles[name].add(profiler)
+            else:
+                self.profiles[name] = pstats.Stats(profiler)
+
+    def close(self):
+        """
+        Write the profiles and close the metrics file.
+        """
+        with self._lock:
+            for name, stats in self.profiles.items():
+                stats.dump_stats(os.path.join(self.profile_dir,
+                                              '{}.prof'.format(name)))
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def print_summary(self):
+        """
+        Print the total time, bytes and points of each stage. The stages
+        overlap when they run concurrently or inside each other.
+        """
+        print('{:<16}{:>8}{:>12}{:>10}{:>10}{:>14}'.format(
+            'stage', 'count', 'time (s)', 'mb', 'mb/s', 'points/s'))
+        for name, t in sorted(self.totals.items(),
+                              key=lambda item: -item[1]['seconds']):
+            seconds = max(t['seconds'], 1e-9)
+            print('{:<16}{:>8}{:>12.2f}{:>10.1f}{:>10.2f}{:>14.0f}'.format(
+                name[:16], t['count'], t['seconds'], t['bytes'] / 1048576,
+                t['bytes'] / 1048576 / seconds, t['points'] / seconds))
+
+
+_current = Metrics()
+
+
+def configure(path=None, profile_dir=None, profile_stages=PROFILE_STAGES):
+    """
+    Start recording the stages of this process.
+
+    Returns
+    -------
+    metrics : Metrics
+    """
+    global _current
+    _current = Metrics(path, profile_dir, profile_stages)
+    return _current
+
+
+def current():
+    return _current
+
+
+def stage(name, **fields):
+    """
+    Time a stage with the recorder of this process, see `Metrics.stage`.
+    """
+    return _current.stage(name, **fields)
+
+
+def record(name, seconds, start=None, **fields):
+    _current.record(name, seconds, start, **fields)
+
+
+def add_arguments(parser):
+    """
+    Add the --metrics_file and --profile arguments to an argument parser.
+    """
+    parser.add_argument('--metrics_file',
+                        help='A file to append the time, bytes and points of each stage to, as JSON lines. (str, default: None)',
+                        required=False,
+                        default=None)
+    parser.add_argument('--profile',
+                        help='A folder to write cProfile dumps of the hot stages to, one <stage>.prof per stage. (str, default: None)',
+                        required=False,
+                        default=None)
+
+
+@contextmanager
+def from_args(args):
+    """
+    Record the stages of a run if --metrics_file or --profile is given,
+    and print a summary of the stages at the end.
+    """
+    if args.metrics_file is None and args.profile is None:
+        yield None
+        return
+    metrics = configure(args.metrics_file, args.profile)
+    try:
+        yield metrics
+    finally:
+        metrics.close()
+        metrics.print_summary()
@@ -0,0 +1,439 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+@author: Chris Lucas
+
+Run the whole chain for a set of AHN2 tiles: download -> merge -> clip and
+colorize -> 3D tiles.
+
+Each tile goes through the stages on its own, so while one tile is being
+colorized the next one is downloaded. A stage is skipped if its inputs
+(by size and modification time) and parameters did not change since it
+last ran, as recorded in a manifest in the output folder. The points are
+streamed between stages where possible: the filtered and remaining data
+are merged into a virtual dataset without recompressing them, and the
+points are clipped while they are colorized, so only the downloaded and
+the colorized files are written.
+"""
+
+import sys
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+_scripts = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+for _folder in ('common', 'ahn2_download', 'clip', 'colorize', 'tile'):
+    sys.path.append(os.path.join(_scripts, _folder))
+import las_io
+import metrics
+import ahn2_downloader
+from ahn2_feed import DEFAULT_CACHE_DIR
+from point_in_polygon import (PreparedPolygon, OUTSIDE, INSIDE,
+                              VERSION as POLYGON_VERSION)
+from colorize_engine import ColorizeEngine
+import pnts_tiler
+
+MANIFEST_FILE = '.pipeline_manifest.json'
+
+
+def fingerprint(paths):
+    """
+    The size and modification time of files, by path.
+    """
+    return {p: [os.path.getsize(p), os.path.getmtime(p)] for p in paths}
+
+
+def params_hash(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True)
+                        .encode('utf-8')).hexdigest()
+
+
+class Manifest(object):
+    """
+    The inputs, parameters and outputs of the stages that ran for each
+    tile, to skip the stages that are up to date.
+
+    Parameters
+    ----------
+    folder : str
+        The output folder of the pipeline.
+    """
+
+    def __init__(self, folder):
+        self.path = os.path.join(folder, MANIFEST_FILE)
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.stages = json.load(f)
+        except (IOError, ValueError):
+            self.stages = {}
+
+    def up_to_date(self, tile_id, stage, params, inputs):
+        """
+        Whether a stage ran with the same parameters and inputs, and its
+        outputs did not change since.
+        """
+        with self._lock:
+            record = self.stages.get(tile_id, {}).get(stage)
+        if record is None or record['params'] != params_hash(params):
+            return False
+        try:
+            return (record['inputs'] == fingerprint(inputs) and
+                    record['outputs'] == fingerprint(record['outputs']))
+        except OSError:
+            return False
+
+    def record(self, tile_id, stage, params, inputs, outputs):
+        """
+        Record a stage that ran successfully.
+        """
+        with self._lock:
+            self.stages.setdefault(tile_id, {})[stage] = {
+                'params': params_hash(params),
+                'inputs': fingerprint(inputs),
+                'outputs': fingerprint(outputs)}
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(self.stages, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+    def outputs(self, tile_id, stage):
+        with self._lock:
+            record = self.stages.get(tile_id, {}).get(stage)
+        return list(record['outputs']) if record else []
+
+
+def remove_file(path):
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def read_polygon(shp_path):
+    """
+    Prepare the polygons of a shapefile as a single polygon. The polygons
+    should not overlap, points inside an even number of them are outside.
+    """
+    from las_clip import read_features
+    from point_in_polygon import geometry_rings
+    rings = []
+    for geometry in read_features(shp_path)[1]:
+        rings.extend(geometry_rings(geometry))
+    return PreparedPolygon(rings)
+
+
+class Pipeline(object):
+    """
+    Runs the stages of the tiles on a pool of workers. At most
+    `download_jobs` tiles are downloaded and at most `jobs` tiles are
+    clipped and colorized at the same time.
+
+    Parameters
+    ----------
+    output_folder : str
+        The folder to write the downloads (download/), colorized tiles
+        (color/) and 3D tiles (tiles/) to.
+    wms : dict
+        The WMS arguments, see `ColorizeEngine`.
+    las_srs : str
+        The spatial reference system of the LAS data.
+    polygon : str
+        The shapefile to clip the tiles to. (default: None, no clipping)
+    feed_urls : dict
+        The urls of the atom feeds by prefix. (default: None, the PDOK
+        AHN2 feeds)
+    feed_cache : str
+        The folder to cache the atom feeds in, None to disable caching.
+    """
+
+    def __init__(self, output_folder, wms, las_srs, polygon=None,
+                 feed_urls=None, feed_cache=DEFAULT_CACHE_DIR, jobs=2,
+                 download_jobs=4, verbose=False):
+        output_folder = os.path.abspath(output_folder)
+        self.folders = {name: os.path.join(output_folder, name)
+                        for name in ('download', 'color', 'tiles')}
+        for folder in self.folders.values():
+            os.makedirs(folder, exist_ok=True)
+        self.manifest = Manifest(output_folder)
+        self.wms = wms
+        self.las_srs = las_srs
+        self.polygon_path = polygon
+        self.polygon = read_polygon(polygon) if polygon else None
+        self.feed_urls = feed_urls or ahn2_downloader.FEED_URLS
+        self.feed_cache = feed_cache
+        self.jobs = jobs
+        self.download_jobs = download_jobs
+        self.verbose = verbose
+        self.limits = {'download': threading.BoundedSemaphore(download_jobs),
+                       'colorize': threading.BoundedSemaphore(jobs)}
+        self.session = None
+        self.feeds = None
+        self.engine = None
+        self._setup_lock = threading.Lock()
+
+    def _setup(self):
+        """
+        Load the feeds and start the colorize engine once, when they are
+        first needed.
+        """
+        with self._setup_lock:
+            if self.feeds is None:
+                self.session = ahn2_downloader.create_session(
+                    pool_size=2*self.download_jobs)
+                self.feeds = ahn2_downloader.request_feeds(
+                    self.session, self.feed_cache, self.feed_urls)
+            if self.engine is None:
+                self.engine = ColorizeEngine(self.wms, self.las_srs)
+
+    def run_stage(self, tile_id, stage, params, inputs, func):
+        """
+        Run a stage of a tile, unless it is up to date.
+
+        Returns
+        -------
+        outputs : list of str
+            The output files of the stage.
+        ran : bool
+            Whether the stage ran.
+        """
+        if self.manifest.up_to_date(tile_id, stage, params, inputs):
+            return self.manifest.outputs(tile_id, stage), False
+        self._setup()
+        limit = self.limits.get(stage)
+        if limit is not None:
+            with limit:
+                outputs = func()
+        else:
+            outputs = func()
+        self.manifest.record(tile_id, stage, params, inputs, outputs)
+        return outputs, True
+
+    def download(self, tile_id):
+        folder = self.folders['download'] + '/'
+        _, found = ahn2_downloader.request_tile(
+            tile_id, folder, session=self.session, feeds=self.feeds)
+        if not found:
+            raise ValueError("Tile not found.")
+        return [f for f in ['{}{}{}.laz'.format(folder, p, tile_id)
+                            for p in ('g', 'u')] if os.path.isfile(f)]
+
+    def merge(self, tile_id):
+        folder = self.folders['download'] + '/'
+        if not ahn2_downloader.merge_tile(tile_id, folder,
+                                          merge_mode='virtual'):
+            raise RuntimeError("Merging failed.")
+        return [ahn2_downloader.merged_file(tile_id, folder, 'virtual')]
+
+    def colorize(self, tile_id, merged):
+        output = os.path.join(self.folders['color'], tile_id + '.laz')
+        if os.path.isfile(output):
+            os.remove(output)
+        point_filter = None
+        if self.polygon is not None:
+            bounds = las_io.read_bounds(merged)[0]
+            state = self.polygon.box_state([bounds[0], bounds[1],
+                                            bounds[3], bounds[4]])
+            if state == OUTSIDE:
+                return []
+            if state != INSIDE:
+                point_filter = self.polygon.contains
+
+        tmp_file = os.path.join(self.folders['color'],
+                                tile_id + '.part.laz')
+        try:
+            stats = self.engine.colorize_file(merged, tmp_file, point_filter)
+        except Exception:
+            remove_file(tmp_file)
+            raise
+        if not stats['points']:
+            os.remove(tmp_file)
+            return []
+        os.replace(tmp_file, output)
+        return [output]
+
+    def run_tile(self, tile_id):
+        """
+        Run the stages of a tile.
+
+        Returns
+        -------
+        ran : list of str
+            The stages that ran, the other stages were up to date.
+        """
+        ran = []
+        downloads, r = self.run_stage(tile_id, 'download',
+                                      {'feeds': self.feed_urls}, [],
+                                      lambda: self.download(tile_id))
+        if r:
+            ran.append('download')
+        merged, r = self.run_stage(tile_id, 'merge', {}, downloads,
+                                   lambda: self.merge(tile_id))
+        if r:
+            ran.append('merge')
+        params = {'wms': self.wms, 'las_srs': self.las_srs}
+        inputs = merged + downloads
+        if self.polygon_path:
+            params['polygon'] = os.path.abspath(self.polygon_path)
+            params['polygon_version'] = POLYGON_VERSION
+            inputs = inputs + [self.polygon_path]
+        _, r = self.run_stage(tile_id, 'colorize', params, inputs,
+                              lambda: self.colorize(tile_id, merged[0]))
+        if r:
+            ran.append('colorize')
+        return ran
+
+    def run(self, tile_ids, tiles=True):
+        """
+        Run the stages of all tiles, then build or update the 3D tiles of
+        the colorized tiles. A failing tile does not stop the other tiles.
+
+        Returns
+        -------
+        failed : dict
+            The error message by tile id of the tiles that failed.
+        """
+        start = time.time()
+        failed = {}
+        workers = max(1, min(len(tile_ids), self.jobs + self.download_jobs))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self.run_tile, t): t
+                       for t in tile_ids}
+            for i, future in enumerate(as_completed(futures)):
+                tile_id = futures[future]
+                try:
+                    ran = future.result()
+                    status = ('ran {}'.format(', '.join(ran)) if ran
+                              else 'up to date')
+                except Exception as e:
+                    failed[tile_id] = str(e)
+                    status = 'failed ({})'.format(e)
+                if self.verbose:
+                    print("[{}/{}] {} {}".format(i+1, len(tile_ids),
+                                                 tile_id, status))
+
+        if tiles and os.listdir(self.folders['color']):
+            if self.verbose:
+                print("Building the 3D tiles..")
+            pnts_tiler.tile_las(self.folders['color'], self.folders['tiles'],
+                                self.las_srs, self.jobs,
+                                verbose=self.verbose)
+
+        print("Processed {} of {} tiles in {:.1f} s.".format(
+            len(tile_ids) - len(failed), len(tile_ids),
+            time.time() - start))
+        if failed:
+            print("Failed tiles: {}".format(', '.join(sorted(failed))))
+        return failed
+
+
+def argument_parser():
+    """
+    Define and return the arguments.
+    """
+    description = ("Download, merge, clip, colorize and tile AHN2 tiles, "
+                   "skipping the stages that are up to date.")
+    parser = argparse.ArgumentParser(description=description)
+    required_named = parser.add_argument_group('required named arguments')
+    tiles = required_named.add_mutually_exclusive_group(required=True)
+    tiles.add_argument('-t', '--tileid',
+                       help='The ID(s) of the tile(s) to process.',
+                       nargs='+')
+    tiles.add_argument('-f', '--tilefile',
+                       help='A file with the IDs of the tiles to process, '
+                            'one per line.')
+    required_named.add_argument('-o', '--output',
+                                help='The folder to write the data to.',
+                                required=True)
+    parser.add_argument('-p', '--polygon',
+                        help='The shapefile with the polygon(s) to clip the tiles to. (default: no clipping)',
+                        required=False,
+                        default=None)
+    parser.add_argument('-s', '--las_srs',
+                        help='The spatial reference system of the LAS data. (str, default: EPSG:28992)',
+                        required=False,
+                        default='EPSG:28992')
+    parser.add_argument('-u', '--wms_url',
+                        help='The url of the WMS service to use. (str, default: https://geodata.nationaalgeoregister.nl/luchtfoto/rgb/wms?)',
+                        required=False,
+                        default='https://geodata.nationaalgeoregister.nl/luchtfoto/rgb/wms?')
+    parser.add_argument('-l', '--wms_layer',
+                        help='The layer of the WMS service to use. (str, default: Actueel_ortho25)',
+                        required=False,
+                        default='Actueel_ortho25')
+    parser.add_argument('--wms_format',
+                        help='The image format of the WMS data to request, or auto. (str, default: image/png)',
+                        required=False,
+                        default='image/png')
+    parser.add_argument('--wms_ppm',
+                        help='The approximate desired pixels per meter of the image. (int, default: 4)',
+                        type=int,
+                        required=False,
+                        default=4)
+    parser.add_argument('--wms_cache_dir',
+                        help='The folder to cache the WMS images in. (str, default: no cache)',
+                        required=False,
+                        default=None)
+    parser.add_argument('--feed_urls',
+                        help='The urls of the uitgefilterd and gefilterd AHN2 atom feeds. (default: the PDOK feeds)',
+                        nargs=2,
+                        required=False,
+                        default=None)
+    parser.add_argument('-c', '--feed_cache',
+                        help='The folder to cache the AHN2 atom feeds in. (default: ~/.cache/ahn2)',
+                        required=False,
+                        default=DEFAULT_CACHE_DIR)
+    parser.add_argument('-j', '--jobs',
+                        help='The number of tiles to colorize at the same time, and the number of tiler processes. (default: 2)',
+                        type=int,
+                        required=False,
+                        default=2)
+    parser.add_argument('-d', '--download_jobs',
+                        help='The number of tiles to download at the same time. (default: 4)',
+                        type=int,
+                        required=False,
+                        default=4)
+    parser.add_argument('--no_tiles',
+                        help='Do not build the 3D tiles.',
+                        action='store_true',
+                        required=False,
+                        default=False)
+    parser.add_argument('-v', '--verbose',
+                        help='Print out the progress.',
+                        action='store_true',
+                        required=False,
+                        default=False)
+    metrics.add_arguments(parser)
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = argument_parser()
+    wms = {'wms_url': args.wms_url,
+           'wms_layer': args.wms_layer,
+           'wms_srs': args.las_srs,
+           'wms_version': '1.3.0',
+           'wms_format': args.wms_format,
+           'wms_ppm': args.wms_ppm,
+           'wms_max_image_size': None,
+           'wms_concurrency': 4,
+           'wms_cache_dir': args.wms_cache_dir}
+    feed_urls = (dict(zip(('u', 'g'), args.feed_urls))
+                 if args.feed_urls else None)
+    tile_ids = ahn2_downloader.read_tile_ids(args.tileid, args.tilefile)
+
+    with metrics.from_args(args):
+        pipeline = Pipeline(args.output, wms, args.las_srs, args.polygon,
+                            feed_urls, args.feed_cache, args.jobs,
+                            args.download_jobs, args.verbose)
+        failed = pipeline.run(tile_ids, not args.no_tiles)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+@author: Chris Lucas
+
+Writing Cesium 3D Tiles point clouds: Point Cloud (.pnts) tile content,
+bounding volumes in Earth-centered Earth-fixed (ECEF) coordinates and the
+tileset JSON.
+"""
+
+import os
+import json
+import struct
+import numpy as np
+
+ECEF_SRS = 'EPSG:4978'
+PNTS_VERSION = 1
+# The points of a tile while building the tiles: source coordinates and 8
+# bit colors
+POINT_DTYPE = np.dtype([('x', 'f8'), ('y', 'f8'), ('z', 'f8'),
+                        ('rgb', 'u1', 3)])
+
+_transformers = {}
+
+
+def to_ecef(srs, x, y, z):
+    """
+    Transform coordinates to ECEF, with a transformer created once per
+    process and source reference system.
+
+    Returns
+    -------
+    positions : array of float64
+        The (n, 3) ECEF coordinates.
+    """
+    transformer = _transformers.get(srs)
+    if transformer is None:
+        import pyproj
+        transformer = pyproj.Transformer.from_crs(srs, ECEF_SRS,
+                                                  always_xy=True)
+        _transformers[srs] = transformer
+    ex, ey, ez = transformer.transform(np.asarray(x, dtype=np.float64),
+                                       np.asarray(y, dtype=np.float64),
+                                       np.asarray(z, dtype=np.float64))
+    return np.column_stack([ex, ey, ez])
+
+
+def bounds_corners(bounds):
+    """
+    The 8 corners of 3D bounds [xmin, ymin, zmin, xmax, ymax, zmax].
+    """
+    xs = [bounds[0], bounds[3]]
+    ys = [bounds[1], bounds[4]]
+    zs = [bounds[2], bounds[5]]
+    corners = np.array([[x, y, z] for x in xs for y in ys for z in zs])
+    return corners[:, 0], corners[:, 1], corners[:, 2]
+
+
+def ecef_box(srs, bounds):
+    """
+    The axis-aligned ECEF box [xmin, ymin, zmin, xmax, ymax, zmax]
+    containing source bounds, from the transformed corners.
+    """
+    positions = to_ecef(srs, *bounds_corners(bounds))
+    return positions.min(axis=0).tolist() + positions.max(axis=0).tolist()
+
+
+def union_box(boxes):
+    """
+    The box containing all given boxes.
+    """
+    boxes = np.array(boxes)
+    return boxes[:, :3].min(axis=0).tolist() + boxes[:, 3:].max(axis=0).tolist()
+
+
+def bounding_volume(box):
+    """
+    The 3D Tiles bounding volume of an axis-aligned ECEF box.
+    """
+    center = [(box[i] + box[i+3]) / 2 for i in range(3)]
+    half = [(box[i+3] - box[i]) / 2 for i in range(3)]
+    return {'box': center + [half[0], 0, 0, 0, half[1], 0, 0, 0, half[2]]}
+
+
+def _padded(data, offset, pad=b' '):
+    """
+    Pad data so it ends on an 8 byte boundary, starting at `offset`.
+    """
+    return data + pad * ((8 - (offset + len(data)) % 8) % 8)
+
+
+def write_pnts(path, positions, rgb=None):
+    """
+    Write a Point Cloud tile. The positions are stored as 32 bit floats
+    relative to their center (RTC_CENTER).
+
+    Parameters
+    ----------
+    path : str
+        The path of the .pnts file.
+    positions : array of float64
+        The (n, 3) ECEF coordinates.
+    rgb : array of uint8
+        The (n, 3) colors. (default: None, no colors)
+    """
+    n = len(positions)
+    center = positions.mean(axis=0) if n else np.zeros(3)
+    feature_table = {'POINTS_LENGTH': n,
+                     'RTC_CENTER': [float(c) for c in center],
+                     'POSITION': {'byteOffset': 0}}
+    body = [(positions - center).astype('<f4').tobytes()]
+    if rgb is not None:
+        feature_table['RGB'] = {'byteOffset': len(body[0])}
+        body.append(np.ascontiguousarray(rgb, dtype=np.uint8).tobytes())
+
+    header_length = 28
+    feature_json = _padded(json.dumps(feature_table).encode('utf-8'),
+                           header_length)
+    feature_binary = _padded(b''.join(body), 0, b'\x00')
+    byte_length = header_length + len(feature_json) + len(feature_binary)
+
+    header = struct.pack('<4sIIIIII', b'pnts', PNTS_VERSION, byte_length,
+                         len(feature_json), len(feature_binary), 0, 0)
+    with open(path, 'wb') as f:
+        f.write(header)
+        f.write(feature_json)
+        f.write(feature_binary)
+
+
+def write_tileset(path, root, geometric_error):
+    """
+    Write a tileset JSON, through a temporary file so a viewer never reads
+    a partially written tileset.
+    """
+    tileset = {'asset': {'version': '1.0'},
+               'geometricError': geometric_error,
+               'root': root}
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(tileset, f, separators=(',', ':'))
+    os.replace(tmp_path, path)
@@ -0,0 +1,981 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+@author: Chris Lucas
+
+Build Cesium 3D Tiles (tileset.json and .pnts tiles) from LAS/LAZ files,
+without Entwine.
+
+The points are indexed out-of-core in an octree:
+
+1. The points are counted in a grid to split the octree into chunks of at
+   most `chunk_points` points.
+2. The points are read again and distributed to a spill file per chunk.
+3. Each chunk is indexed in memory by a worker process. A tile keeps a
+   level of detail (LOD) sample of one point per grid cell, the remaining
+   points are passed on to its eight children (additive refinement).
+4. The tiles above the chunks take their LOD samples from the roots of
+   the chunks below them.
+
+The memory use is bounded by the chunk size per worker, whatever the size
+of the input.
+
+The spill files (per chunk and input file), the point counts and the LOD
+samples of the chunk roots are kept, so when input files are added,
+replaced or removed only the chunks they contribute to and the tiles above
+those chunks are built again.
+"""
+
+import sys
+import os
+import re
+import time
+import math
+import json
+import shutil
+import argparse
+import resource
+import multiprocessing
+import numpy as np
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'common'))
+import las_io
+from las_index import LasIndex
+import pnts
+
+DEFAULT_CHUNK_POINTS = 5000000
+# The maximum number of points of a tile without children
+TILE_POINTS = 100000
+# A LOD sample keeps one point per cell of a grid of SPACING_CELLS cells
+# along each side of the tile
+SPACING_CELLS = 128
+MAX_LEVEL = 24
+MAX_COUNT_LEVEL = 16
+WORK_FOLDER = '.tiler'
+STATE_FILE = 'state.json'
+STATE_VERSION = 1
+# The tiles and chunk tilesets written by the tiler, named by node key
+TILE_FILE = re.compile(r'^\d+-\d+-\d+-\d+\.(pnts|json)$')
+
+
+def octree_cube(bounds):
+    """
+    The cube of the octree root: the minimum of the bounds rounded down to
+    whole meters, and a power of two length.
+
+    Returns
+    -------
+    origin : list of float
+    length : float
+    """
+    origin = [float(math.floor(b)) for b in bounds[:3]]
+    extent = max(bounds[i+3] - origin[i] for i in range(3))
+    length = 2.0 ** math.ceil(math.log2(max(extent, 1)))
+    return origin, length
+
+
+def count_level(point_count, chunk_points):
+    """
+    The level of the grid the points are counted in, fine enough to split
+    surface data into chunks of `chunk_points` points.
+    """
+    cells = 8 * point_count / chunk_points
+    level = int(math.ceil(math.log(max(cells, 1), 4))) + 1
+    return min(max(level, 1), MAX_COUNT_LEVEL)
+
+
+def _spread_bits(v):
+    """
+    Spread the lowest 21 bits of v to every third bit.
+    """
+    v = v.astype(np.uint64) & np.uint64(0x1fffff)
+    for shift, mask in ((32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff),
+                        (8, 0x100f00f00f00f00f), (4, 0x10c30c30c30c30c3),
+                        (2, 0x1249249249249249)):
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def morton_codes(ix, iy, iz):
+    """
+    The Morton (z-order) codes of grid cells. The children of a cell with
+    code c have codes 8c to 8c+7, so all cells of an octree node form a
+    contiguous range of codes.
+    """
+    return (_spread_bits(ix) | (_spread_bits(iy) << np.uint64(1)) |
+            (_spread_bits(iz) << np.uint64(2)))
+
+
+def morton_key(level, code):
+    """
+    The octree node key (level, x, y, z) of a Morton code at a level.
+    """
+    x = y = z = 0
+    for i in range(level):
+        x |= ((code >> (3*i)) & 1) << i
+        y |= ((code >> (3*i + 1)) & 1) << i
+        z |= ((code >> (3*i + 2)) & 1) << i
+    return (level, x, y, z)
+
+
+def key_name(key):
+    return '{}-{}-{}-{}'.format(*key)
+
+
+def name_key(name):
+    return tuple(int(v) for v in name.split('-'))
+
+
+def child_key(key, octant):
+    return (key[0] + 1, 2*key[1] + (octant & 1), 2*key[2] + (octant >> 1 & 1),
+            2*key[3] + (octant >> 2 & 1))
+
+
+def parent_key(key):
+    return (key[0] - 1, key[1] // 2, key[2] // 2, key[3] // 2)
+
+
+def node_cube(key, origin, length):
+    """
+    The minimum corner and length of the cube of an octree node.
+    """
+    size = length / 2 ** key[0]
+    return [origin[i] + key[i+1] * size for i in range(3)], size
+
+
+def cell_indices(points, corner, size, cells):
+    """
+    The indices of the cells of a grid of `cells` cells along each side of
+    a cube that points are in.
+    """
+    cell_size = size / cells
+    return [np.clip(((points[d] - corner[i]) / cell_size).astype(np.int64),
+                    0, cells - 1)
+            for i, d in enumerate(('x', 'y', 'z'))]
+
+
+def grid_sample(points, corner, size):
+    """
+    Select one point per cell of a grid of SPACING_CELLS cells along each
+    side of a cube.
+
+    Returns
+    -------
+    selected : array of bool
+    """
+    ix, iy, iz = cell_indices(points, corner, size, SPACING_CELLS)
+    cells = (iz * SPACING_CELLS + iy) * SPACING_CELLS + ix
+    selected = np.zeros(len(points), dtype=bool)
+    selected[np.unique(cells, return_index=True)[1]] = True
+    return selected
+
+
+def chunk_xyz(chunk):
+    return {'x': np.asarray(chunk.x), 'y': np.asarray(chunk.y),
+            'z': np.asarray(chunk.z)}
+
+
+def chunk_points_array(chunk, color_shift):
+    """
+    Convert a chunk of LAS points to the tiler's point records.
+    """
+    points = np.zeros(len(chunk), dtype=pnts.POINT_DTYPE)
+    points['x'] = chunk.x
+    points['y'] = chunk.y
+    points['z'] = chunk.z
+    if 'red' in chunk.point_format.dimension_names:
+        for i, name in enumerate(('red', 'green', 'blue')):
+            points['rgb'][:, i] = np.minimum(
+                np.asarray(chunk[name]) >> color_shift, 255)
+    return points
+
+
+def merge_counts(codes, counts):
+    """
+    Sum the point counts of the same cells.
+    """
+    codes = np.concatenate(codes)
+    counts = np.concatenate(counts)
+    unique, inverse = np.unique(codes, return_inverse=True)
+    return unique, np.bincount(inverse, weights=counts,
+                               minlength=len(unique)).astype(np.int64)
+
+
+def count_points(args):
+    """
+    Count the points of a file per cell of the counting grid.
+
+    Returns
+    -------
+    codes : array of uint64
+        The sorted Morton codes of the cells containing points.
+    counts : array of int64
+        The number of points in each cell.
+    rgb_max : int
+        The largest color value.
+    """
+    path, origin, length, level = args
+    codes = [np.zeros(0, dtype=np.uint64)]
+    counts = [np.zeros(0, dtype=np.int64)]
+    rgb_max = 0
+    for chunk in las_io.iter_chunks(path):
+        c, n = np.unique(morton_codes(*cell_indices(chunk_xyz(chunk), origin,
+                                                    length, 2 ** level)),
+                         return_counts=True)
+        codes.append(c)
+        counts.append(n)
+        if 'red' in chunk.point_format.dimension_names and len(chunk):
+            rgb_max = max(rgb_max, *(int(np.max(chunk[name])) for name in
+                                     ('red', 'green', 'blue')))
+    return merge_counts(codes, counts) + (rgb_max,)
+
+
+def partition(codes, counts, level, chunk_points, existing=()):
+    """
+    Split the octree into chunks, the largest nodes with at most
+    `chunk_points` points (or the cells of the counting grid). Existing
+    chunks are kept as long as they are not too large, so an update only
+    changes the chunks of the changed area.
+
+    Returns
+    -------
+    chunks : list of tuple
+        The (key, point count) of each chunk, in Morton order.
+    """
+    cumulative = np.concatenate([[0], np.cumsum(counts)])
+    above_existing = ancestors(existing)
+    chunks = []
+    stack = [(0, 0)]
+    while stack:
+        node_level, code = stack.pop()
+        shift = 3 * (level - node_level)
+        start = np.searchsorted(codes, np.uint64(code << shift))
+        end = np.searchsorted(codes, np.uint64((code + 1) << shift))
+        count = int(cumulative[end] - cumulative[start])
+        if count == 0:
+            continue
+        key = morton_key(node_level, code)
+        if key not in above_existing and (count <= chunk_points or
+                                          node_level == level):
+            chunks.append((code << shift, key, count))
+        else:
+            stack.extend((node_level + 1, code*8 + i) for i in range(8))
+    return [(key, count) for _, key, count in sorted(chunks)]
+
+
+def spill_name(source):
+    return source + '.bin'
+
+
+def chunk_starts(chunks, level):
+    """
+    The first Morton code in the counting grid of each chunk.
+    """
+    return np.array([morton_codes(*(np.array([k[i+1] << (level - k[0])])
+                                    for i in range(3)))[0]
+                     for k in chunks], dtype=np.uint64)
+
+
+def spill_points(points, codes, starts, names, work_folder, source):
+    """
+    Append points to the spill files of the chunks they are in, one spill
+    file per chunk and source file.
+
+    Returns
+    -------
+    names : set of str
+        The chunks the points were written to.
+    """
+    index = np.searchsorted(starts, codes, side='right') - 1
+    order = np.argsort(index, kind='stable')
+    groups = np.split(order, np.flatnonzero(np.diff(index[order])) + 1)
+    written = set()
+    for group in groups:
+        if not len(group):
+            continue
+        name = names[index[group[0]]]
+        folder = os.path.join(work_folder, 'chunks', name)
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, spill_name(source)), 'ab') as f:
+            points[group].tofile(f)
+        written.add(name)
+    return written
+
+
+def distribute_points(args):
+    """
+    Distribute the points of a source file to the spill files of the
+    chunks.
+
+    Returns
+    -------
+    source : str
+    names : list of str
+        The chunks containing points of the source.
+    point_count : int
+    """
+    (path, source, origin, length, level, starts, names, color_shift,
+     work_folder) = args
+    point_count = 0
+    written = set()
+    for chunk in las_io.iter_chunks(path):
+        points = chunk_points_array(chunk, color_shift)
+        codes = morton_codes(*cell_indices(points, origin, length,
+                                           2 ** level))
+        written |= spill_points(points, codes, starts, names, work_folder,
+                                source)
+        point_count += len(points)
+    return source, sorted(written), point_count
+
+
+def redistribute_chunk(args):
+    """
+    Move the spill files of a chunk that was split to the new, smaller
+    chunks.
+
+    Returns
+    -------
+    moved : dict
+        The chunks the points of each source went to.
+    """
+    name, origin, length, level, starts, names, work_folder = args
+    folder = os.path.join(work_folder, 'chunks', name)
+    moved = {}
+    for f in sorted(os.listdir(folder)):
+        points = np.fromfile(os.path.join(folder, f), dtype=pnts.POINT_DTYPE)
+        codes = morton_codes(*cell_indices(points, origin, length,
+                                           2 ** level))
+        source = f[:-len(spill_name(''))]
+        moved[source] = sorted(spill_points(points, codes, starts, names,
+                                            work_folder, source))
+    shutil.rmtree(folder)
+    return moved
+
+
+class TileWriter(object):
+    """
+    Writes the .pnts tiles of the octree nodes and keeps track of their
+    ECEF bounding boxes.
+    """
+
+    def __init__(self, output_folder, srs, origin, length, with_rgb):
+        self.output_folder = output_folder
+        self.srs = srs
+        self.origin = origin
+        self.length = length
+        self.with_rgb = with_rgb
+
+    def positions(self, points):
+        return pnts.to_ecef(self.srs, points['x'], points['y'], points['z'])
+
+    def write(self, key, points, positions=None):
+        """
+        Write the points of a node. Returns the ECEF box of the points.
+        """
+        if positions is None:
+            positions = self.positions(points)
+        pnts.write_pnts(os.path.join(self.output_folder,
+                                     key_name(key) + '.pnts'),
+                        positions, points['rgb'] if self.with_rgb else None)
+        return self.box(positions)
+
+    @staticmethod
+    def box(positions):
+        if not len(positions):
+            return None
+        return positions.min(axis=0).tolist() + positions.max(axis=0).tolist()
+
+    def tile(self, key, box, child_tiles, has_content=True):
+        """
+        The tileset entry of a node.
+        """
+        size = node_cube(key, self.origin, self.length)[1]
+        boxes = [box] if box is not None else []
+        boxes += [t['box'] for t in child_tiles]
+        tile = {'boundingVolume': pnts.bounding_volume(pnts.union_box(boxes)),
+                'geometricError': size / SPACING_CELLS if child_tiles else 0,
+                'box': pnts.union_box(boxes)}
+        if has_content:
+            tile['content'] = {'uri': key_name(key) + '.pnts'}
+        if child_tiles:
+            tile['children'] = child_tiles
+        return tile
+
+
+def strip_boxes(tile):
+    """
+    Remove the ECEF boxes kept with the tiles while building them.
+    """
+    tile.pop('box', None)
+    for child in tile.get('children', []):
+        strip_boxes(child)
+    return tile
+
+
+def build_tile(writer, key, points, root_key, lod_folder):
+    """
+    Index the points of a node and its descendants. The points of the root
+    of a chunk are saved to `lod_folder` instead, to take the LOD samples
+    of the tiles above the chunk from.
+    """
+    child_tiles = []
+    if len(points) > TILE_POINTS and key[0] < MAX_LEVEL:
+        corner, size = node_cube(key, writer.origin, writer.length)
+        selected = grid_sample(points, corner, size)
+        rest = points[~selected]
+        points = points[selected]
+        ix, iy, iz = cell_indices(rest, corner, size, 2)
+        octants = ix + 2*iy + 4*iz
+        for octant in np.unique(octants):
+            child_tiles.append(build_tile(writer, child_key(key, octant),
+                                          rest[octants == octant], root_key,
+                                          lod_folder))
+        del rest
+
+    if key == root_key:
+        np.save(os.path.join(lod_folder, key_name(key) + '.npy'), points)
+        box = writer.box(writer.positions(points))
+    else:
+        box = writer.write(key, points)
+    return writer.tile(key, box, child_tiles)
+
+
+def index_chunk(args):
+    """
+    Index the points of a chunk, writing the tiles below the chunk root and
+    the chunk's tileset.
+
+    Returns
+    -------
+    key : tuple
+    summary : dict
+        The ECEF box and geometric error of the chunk.
+    point_count : int
+    """
+    (key, work_folder, output_folder, srs, origin, length,
+     with_rgb) = args
+    name = key_name(key)
+    folder = os.path.join(work_folder, 'chunks', name)
+    points = np.concatenate([np.fromfile(os.path.join(folder, f),
+                                         dtype=pnts.POINT_DTYPE)
+                             for f in sorted(os.listdir(folder))])
+    # shuffled, so the LOD samples do not favor the first flight lines
+    points = points[np.random.default_rng(key).permutation(len(points))]
+
+    writer = TileWriter(output_folder, srs, origin, length, with_rgb)
+    tile = build_tile(writer, key, points, key,
+                      os.path.join(work_folder, 'lod'))
+    tile['refine'] = 'ADD'
+    summary = {'box': tile['box'], 'geometricError': tile['geometricError']}
+    pnts.write_tileset(os.path.join(output_folder, name + '.json'),
+                       strip_boxes(tile), tile['geometricError'])
+    return key, summary, len(points)
+
+
+def remove_chunk_content(output_folder, key):
+    """
+    Remove the content of the root tile of a chunk tileset, whose points
+    all went to the tiles above it.
+    """
+    path = os.path.join(output_folder, key_name(key) + '.json')
+    with open(path) as f:
+        tileset = json.load(f)
+    tileset['root'].pop('content', None)
+    pnts.write_tileset(path, tileset['root'], tileset['geometricError'])
+
+
+def remove_chunk_tiles(output_folder, name):
+    """
+    Remove the tileset of a chunk and all its tiles.
+    """
+    path = os.path.join(output_folder, name + '.json')
+    if not os.path.isfile(path):
+        return
+    with open(path) as f:
+        tiles = [json.load(f)['root']]
+    while tiles:
+        tile = tiles.pop()
+        uri = tile.get('content', {}).get('uri')
+        if uri and os.path.isfile(os.path.join(output_folder, uri)):
+            os.remove(os.path.join(output_folder, uri))
+        tiles.extend(tile.get('children', []))
+    os.remove(path)
+
+
+def remove_file(path):
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def ancestors(keys):
+    """
+    The children of the ancestors of octree nodes, by ancestor.
+    """
+    children = {}
+    for key in keys:
+        while key[0] > 0:
+            parent = parent_key(key)
+            children.setdefault(parent, set()).add(key)
+            key = parent
+    return children
+
+
+def build_upper_tiles(writer, tiles, chunks, affected, lod_folder):
+    """
+    Build the tiles above the affected chunks, deepest first. Each tile
+    takes its LOD sample from the points of its children that were not
+    sampled by a tile above them, and the children are written without the
+    sampled points. The children of a tile do not share cells of its
+    sampling grid, so the tiles of unaffected children stay the same.
+
+    Parameters
+    ----------
+    tiles : dict
+        The ECEF box, geometric error, content and children of the tiles
+        by name, updated in place.
+    chunks : set of tuple
+        The keys of all chunks.
+    affected : set of tuple
+        The keys of the chunks that were (re)indexed or removed.
+    """
+    def pending(key):
+        return np.load(os.path.join(lod_folder, key_name(key) + '.npy'))
+
+    def finish(key, points):
+        if len(points):
+            writer.write(key, points)
+        elif key in chunks:
+            # the root tile of the chunk tileset
+            remove_chunk_content(writer.output_folder, key)
+        if key not in chunks:
+            tiles[key_name(key)]['content'] = bool(len(points))
+
+    children = ancestors(chunks)
+    rebuild = set()
+    for key in affected:
+        while key[0] > 0:
+            key = parent_key(key)
+            if key in children:
+                rebuild.add(key)
+    changed = set(affected) | rebuild
+
+    for key in sorted(rebuild, key=lambda k: -k[0]):
+        child_keys = sorted(children[key])
+        parts = [pending(c) for c in child_keys]
+        points = np.concatenate(parts)
+        corner, size = node_cube(key, writer.origin, writer.length)
+        selected = grid_sample(points, corner, size)
+
+        start = 0
+        for child, part in zip(child_keys, parts):
+            if child in changed:
+                finish(child, part[~selected[start:start+len(part)]])
+            start += len(part)
+
+        points = points[selected]
+        np.save(os.path.join(lod_folder, key_name(key) + '.npy'), points)
+        box = writer.box(writer.positions(points))
+        boxes = [tiles[key_name(c)]['box'] for c in child_keys]
+        tiles[key_name(key)] = {
+            'box': pnts.union_box(boxes + [box]),
+            'geometricError': size / SPACING_CELLS,
+            'content': True,
+            'children': [key_name(c) for c in child_keys]}
+
+    root_key = (0, 0, 0, 0)
+    if root_key in changed:
+        finish(root_key, pending(root_key))
+
+
+def tileset_tile(tiles, chunks, key):
+    """
+    The tileset entry of a tile and the tiles below it, down to the chunk
+    tilesets.
+    """
+    name = key_name(key)
+    summary = tiles[name]
+    tile = {'boundingVolume': pnts.bounding_volume(summary['box']),
+            'geometricError': summary['geometricError']}
+    if key in chunks:
+        tile['content'] = {'uri': name + '.json'}
+        return tile
+    if summary['content']:
+        tile['content'] = {'uri': name + '.pnts'}
+    tile['children'] = [tileset_tile(tiles, chunks, name_key(c))
+                        for c in summary['children']]
+    return tile
+
+
+def run_parallel(func, tasks, jobs):
+    """
+    Run func on each task, in `jobs` worker processes if jobs > 1. The
+    results are yielded in the order of the tasks.
+    """
+    if jobs <= 1:
+        for task in tasks:
+            yield func(task)
+        return
+    # spawn, the LAZ backend does not survive a fork of a process using it
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(jobs) as pool:
+        for result in pool.imap(func, tasks):
+            yield result
+
+
+def input_files(input_path):
+    """
+    The point cloud files and their bounds and point counts.
+
+    Returns
+    -------
+    files : dict
+        The paths of the files by file name.
+    bounds : list of float
+        The combined 3D bounds [xmin, ymin, zmin, xmax, ymax, zmax].
+    point_count : int
+    """
+    if os.path.isdir(input_path):
+        index = LasIndex(input_path)
+        files = {n: os.path.join(input_path, n) for n in index.names()}
+        all_bounds = [index.entries[n]['bounds'] for n in index.names()]
+        point_count = sum(index.point_count(n) for n in index.names())
+    else:
+        files = {os.path.basename(input_path): input_path}
+        b, point_count = las_io.read_bounds(input_path)
+        all_bounds = [b]
+    if not files:
+        raise ValueError("No LAS/LAZ files found in {}.".format(input_path))
+    all_bounds = np.array(all_bounds)
+    bounds = (all_bounds[:, :3].min(axis=0).tolist() +
+              all_bounds[:, 3:].max(axis=0).tolist())
+    return files, bounds, point_count
+
+
+def source_stat(path):
+    """
+    The size and modification time of a source file, or of the files of a
+    virtual dataset, to detect changes.
+    """
+    stats = [os.stat(f) for f in las_io.source_files(path)]
+    return {'size': sum(s.st_size for s in stats),
+            'mtime': max(s.st_mtime for s in stats)}
+
+
+def load_state(work_folder):
+    """
+    The state of the previous run, or None.
+    """
+    try:
+        with open(os.path.join(work_folder, STATE_FILE)) as f:
+            state = json.load(f)
+    except (IOError, ValueError):
+        return None
+    return state if state.get('version') == STATE_VERSION else None
+
+
+def save_state(work_folder, state):
+    path = os.path.join(work_folder, STATE_FILE)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def can_update(state, srs, chunk_points, with_rgb, bounds):
+    """
+    Whether the tiles of a previous run can be updated: the settings are
+    the same, the previous run finished and the data fits in its octree.
+    """
+    origin = state['origin']
+    length = state['length']
+    return (not state['pending'] and state['srs'] == srs and
+            state['chunk_points'] == chunk_points and
+            state['with_rgb'] == with_rgb and
+            all(origin[i] <= bounds[i] and bounds[i+3] <= origin[i] + length
+                for i in range(3)))
+
+
+def peak_memory():
+    """
+    The peak resident memory in mb of this process and of its (finished)
+    worker processes.
+    """
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+
+def tile_las(input_path, output_path, srs, jobs=1,
+             chunk_points=DEFAULT_CHUNK_POINTS, verbose=False, rebuild=False):
+    """
+    Build or update a Cesium 3D Tiles point cloud of a LAS/LAZ file or
+    folder.
+
+    The spill files, point counts and LOD samples are kept in the output
+    folder. When the tiles are built again, only the chunks containing
+    points of added, changed (by size and modification time) or removed
+    files are indexed again, followed by the tiles above them.
+
+    Parameters
+    ----------
+    input_path : str
+        The LAS/LAZ file or folder.
+    output_path : str
+        The folder to write tileset.json and the tiles to.
+    srs : str
+        The spatial reference system of the LAS data.
+    jobs : int
+        The number of worker processes.
+    chunk_points : int
+        The maximum number of points a worker indexes at a time. A worker
+        uses roughly 100 bytes per point.
+    rebuild : bool
+        Build all tiles, even if they can be updated.
+
+    Returns
+    -------
+    stats : dict
+        The number of points read, tiles, changed sources and indexed
+        chunks, the time (s) per stage and in total and the peak memory
+        (mb).
+    """
+    start = time.time()
+    stages = {}
+    os.makedirs(output_path, exist_ok=True)
+    work_folder = os.path.join(output_path, WORK_FOLDER)
+    lod_folder = os.path.join(work_folder, 'lod')
+    counts_folder = os.path.join(work_folder, 'counts')
+
+    files, bounds, point_count = input_files(input_path)
+    with_rgb = any('red' in las_io.read_header(f).point_format
+                   .dimension_names for f in files.values())
+
+    state = None if rebuild else load_state(work_folder)
+    if state is not None and not can_update(state, srs, chunk_points,
+                                            with_rgb, bounds):
+        if verbose:
+            print('The tiles can not be updated, building all tiles..')
+        state = None
+    if state is None:
+        for f in os.listdir(output_path):
+            if TILE_FILE.match(f) or f == 'tileset.json':
+                os.remove(os.path.join(output_path, f))
+        if os.path.isdir(work_folder):
+            shutil.rmtree(work_folder)
+        origin, length = octree_cube(bounds)
+        state = {'version': STATE_VERSION,
+                 'srs': srs,
+                 'chunk_points': chunk_points,
+                 'with_rgb': with_rgb,
+                 'origin': origin,
+                 'length': length,
+                 'level': count_level(point_count, chunk_points),
+                 'pending': False,
+                 'sources': {},
+                 'chunks': [],
+                 'tiles': {}}
+    for folder in (lod_folder, counts_folder):
+        os.makedirs(folder, exist_ok=True)
+    origin = state['origin']
+    length = state['length']
+    level = state['level']
+    tiles = state['tiles']
+
+    stat = {name: source_stat(path) for name, path in files.items()}
+    sources = state['sources']
+    changed = sorted(n for n in files
+                     if n not in sources or
+                     {k: sources[n][k] for k in stat[n]} != stat[n])
+    removed = sorted(n for n in sources if n not in files)
+    stats = {'points': 0, 'sources': len(changed) + len(removed),
+             'chunks': 0, 'stages': stages}
+    if not changed and not removed:
+        if verbose:
+            print('The tiles are up to date.')
+        stats.update(tiles=sum(1 for f in os.listdir(output_path)
+                               if f.endswith('.pnts')),
+                     time=time.time() - start)
+        return stats
+
+    state['pending'] = True
+    save_state(work_folder, state)
+
+    # remove the points of changed and removed files
+    touched = set()
+    for name in changed + removed:
+        for chunk in sources.get(name, {}).get('chunks', []):
+            remove_file(os.path.join(work_folder, 'chunks', chunk,
+                                     spill_name(name)))
+            touched.add(chunk)
+        if name in removed:
+            remove_file(os.path.join(counts_folder, name + '.npz'))
+            del sources[name]
+
+    stage_start = time.time()
+    tasks = [(files[n], origin, length, level) for n in changed]
+    for name, (c, n, m) in zip(changed, run_parallel(count_points, tasks,
+                                                     jobs)):
+        np.savez(os.path.join(counts_folder, name + '.npz'), codes=c,
+                 counts=n, rgb_max=m)
+    codes = []
+    counts = []
+    rgb_max = {}
+    for name in files:
+        with np.load(os.path.join(counts_folder, name + '.npz')) as f:
+            codes.append(f['codes'])
+            counts.append(f['counts'])
+            rgb_max[name] = int(f['rgb_max'])
+    codes, counts = merge_counts(codes, counts)
+    old_chunks = set(name_key(c) for c in state['chunks'])
+    chunks = [k for k, _ in partition(codes, counts, level, chunk_points,
+                                      old_chunks)]
+    del codes, counts
+    stages['count'] = time.time() - stage_start
+    if verbose:
+        print('Counted {} changed and {} removed files, {} chunks.'.format(
+            len(changed), len(removed), len(chunks)))
+
+    # move the points of chunks that grew too large to the smaller chunks
+    # they were split into
+    stage_start = time.time()
+    starts = chunk_starts(chunks, level)
+    names = [key_name(k) for k in chunks]
+    gone = old_chunks - set(chunks)
+    split = [key_name(k) for k in gone
+             if os.path.isdir(os.path.join(work_folder, 'chunks',
+                                           key_name(k)))]
+    tasks = [(name, origin, length, level, starts, names, work_folder)
+             for name in split]
+    for name, moved in zip(split, run_parallel(redistribute_chunk, tasks,
+                                               jobs)):
+        for source, written in moved.items():
+            source_chunks = set(sources[source]['chunks'])
+            source_chunks.discard(name)
+            sources[source]['chunks'] = sorted(source_chunks | set(written))
+            touched.update(written)
+
+    tasks = [(files[n], n, origin, length, level, starts, names,
+              8 if rgb_max[n] > 255 else 0, work_folder) for n in changed]
+    for name, written, n in run_parallel(distribute_points, tasks, jobs):
+        sources[name] = dict(stat[name], chunks=written)
+        touched.update(written)
+        stats['points'] += n
+    stages['distribute'] = time.time() - stage_start
+
+    # remove the tiles that are rebuilt or no longer exist
+    chunk_set = set(chunks)
+    reindex = sorted(k for k in chunk_set if key_name(k) in touched)
+    upper = ancestors(chunk_set)
+    for key in gone | set(reindex):
+        remove_chunk_tiles(output_path, key_name(key))
+    for key in gone:
+        remove_file(os.path.join(lod_folder, key_name(key) + '.npy'))
+        tiles.pop(key_name(key), None)
+    for name in [n for n, t in tiles.items() if 'children' in t]:
+        if name_key(name) not in upper:
+            remove_file(os.path.join(output_path, name + '.pnts'))
+            remove_file(os.path.join(lod_folder, name + '.npy'))
+            del tiles[name]
+
+    stage_start = time.time()
+    tasks = [(k, work_folder, output_path, srs, origin, length, with_rgb)
+             for k in reindex]
+    for i, (key, summary, n) in enumerate(run_parallel(index_chunk, tasks,
+                                                       jobs)):
+        tiles[key_name(key)] = summary
+        if verbose:
+            print('Indexed chunk {} ({} points), {}/{}.'.format(
+                key_name(key), n, i + 1, len(reindex)))
+    stages['index'] = time.time() - stage_start
+    stats['chunks'] = len(reindex)
+
+    stage_start = time.time()
+    writer = TileWriter(output_path, srs, origin, length, with_rgb)
+    build_upper_tiles(writer, tiles, chunk_set, set(reindex) | gone,
+                      lod_folder)
+    tileset_path = os.path.join(output_path, 'tileset.json')
+    if chunks:
+        root = tileset_tile(tiles, chunk_set, (0, 0, 0, 0))
+        root['refine'] = 'ADD'
+        pnts.write_tileset(tileset_path, root, length)
+    else:
+        remove_file(tileset_path)
+    stages['lod'] = time.time() - stage_start
+
+    state['chunks'] = names
+    state['pending'] = False
+    save_state(work_folder, state)
+
+    elapsed = time.time() - start
+    main_memory, worker_memory = peak_memory()
+    stats.update(tiles=sum(1 for f in os.listdir(output_path)
+                           if f.endswith('.pnts')),
+                 time=elapsed,
+                 points_per_second=stats['points'] / max(elapsed, 1e-9),
+                 peak_memory=main_memory,
+                 peak_worker_memory=worker_memory)
+    return stats
+
+
+def argument_parser():
+    """
+    Define and return the arguments.
+    """
+    description = ("Build or update Cesium 3D Tiles (.pnts) from LAS/LAZ "
+                   "files, without Entwine.")
+    parser = argparse.ArgumentParser(description=description)
+    required_named = parser.add_argument_group('required named arguments')
+    required_named.add_argument('-i', '--input',
+                                help='The input LAS/LAZ file or folder.',
+                                required=True)
+    required_named.add_argument('-o', '--output',
+                                help='The output folder for tileset.json and the tiles.',
+                                required=True)
+    parser.add_argument('-s', '--las_srs',
+                        help='The spatial reference system of the LAS data. (Default: EPSG:28992)',
+                        required=False,
+                        default='EPSG:28992')
+    parser.add_argument('-j', '--jobs',
+                        help='The number of worker processes. (Default: 1)',
+                        type=int,
+                        required=False,
+                        default=1)
+    parser.add_argument('-c', '--chunk_points',
+                        help='The maximum number of points a worker indexes at a time, roughly 100 bytes each. (Default: 5000000)',
+                        type=int,
+                        required=False,
+                        default=DEFAULT_CHUNK_POINTS)
+    parser.add_argument('-r', '--rebuild',
+                        help='Build all tiles, instead of updating the tiles of the changed files.',
+                        action='store_true',
+                        required=False,
+                        default=False)
+    parser.add_argument('-v', '--verbose',
+                        help='Print out the progress.',
+                        action='store_true',
+                        required=False,
+                        default=False)
+
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = argument_parser()
+    stats = tile_las(args.input, args.output, args.las_srs, args.jobs,
+                     args.chunk_points, args.verbose, args.rebuild)
+    if not stats['sources']:
+        return
+    if args.verbose:
+        print(', '.join('{} {:.1f} s'.format(stage, t)
+                        for stage, t in stats['stages'].items()))
+    print('{} changed files, {} points read and {} chunks indexed in {:.1f} '
+          's ({:.0f} points/s), {} tiles. Peak memory {:.0f} mb (workers '
+          '{:.0f} mb).'.format(
+              stats['sources'], stats['points'], stats['chunks'],
+              stats['time'], stats['points_per_second'], stats['tiles'],
+              stats['peak_memory'], stats['peak_worker_memory']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Python3
+
+@author: Chris Lucas
+
+Tests of updating the tiles of `pnts_tiler.py` after input files are
+replaced and removed, on synthetic tiles. Run with pytest.
+"""
+
+import os
+import sys
+import json
+import struct
+import pytest
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'benchmark'))
+import pnts_tiler  # noqa: E402
+from synthetic import synthetic_tile, ORIGIN  # noqa: E402
+
+TILE_SIZE = 100
+DENSITY = 4
+CHUNK_POINTS = 20000
+OLD_MTIME = 1000000000
+
+
+def tile_bounds(i):
+    xmin = ORIGIN[0] + (i % 2) * TILE_SIZE
+    ymin = ORIGIN[1] + (i // 2) * TILE_SIZE
+    return [xmin, ymin, xmin + TILE_SIZE, ymin + TILE_SIZE]
+
+
+def pnts_points(path):
+    """
+    The number of points of a .pnts tile, from its feature table.
+    """
+    with open(path, 'rb') as f:
+        header = struct.unpack('<4sIIIIII', f.read(28))
+        feature_table = json.loads(f.read(header[3]).decode('utf-8'))
+    return feature_table['POINTS_LENGTH']
+
+
+def referenced_tiles(folder, name='tileset.json'):
+    """
+    The .pnts tiles referenced by a tileset and the tilesets it refers
+    to.
+    """
+    with open(os.path.join(folder, name)) as f:
+        tiles = [json.load(f)['root']]
+    found = set()
+    while tiles:
+        tile = tiles.pop()
+        uri = tile.get('content', {}).get('uri')
+        if uri and uri.endswith('.json'):
+            found |= referenced_tiles(folder, uri)
+        elif uri:
+            found.add(uri)
+        tiles.extend(tile.get('children', []))
+    return found
+
+
+def chunk_tilesets(folder):
+    return set(f for f in os.listdir(folder)
+               if pnts_tiler.TILE_FILE.match(f) and f.endswith('.json'))
+
+
+def load_state(output):
+    return pnts_tiler.load_state(os.path.join(output, pnts_tiler.WORK_FOLDER))
+
+
+def check_tiles(output, point_count):
+    """
+    Every tile on disk is part of the tileset, and every point is in one
+    tile.
+    """
+    tiles = referenced_tiles(output)
+    on_disk = set(f for f in os.listdir(output) if f.endswith('.pnts'))
+    assert tiles == on_disk
+    assert sum(pnts_points(os.path.join(output, f)) for f in tiles) == \
+        point_count
+
+
+@pytest.fixture
+def tiles(tmp_path):
+    folder = tmp_path / 'tiles'
+    folder.mkdir()
+    counts = {}
+    for i in range(4):
+        name = 'tile_{}.laz'.format(i)
+        counts[name] = synthetic_tile(str(folder / name), tile_bounds(i),
+                                      DENSITY, seed=i)
+    return str(folder), counts
+
+
+def test_replace_and_remove(tmp_path, tiles):
+    folder, counts = tiles
+    output = str(tmp_path / 'cesium')
+    stats = pnts_tiler.tile_las(folder, output, 'EPSG:28992',
+                                chunk_points=CHUNK_POINTS)
+    assert stats['points'] == sum(counts.values())
+    check_tiles(output, sum(counts.values()))
+    before = load_state(output)
+    assert len(before['chunks']) > 4
+
+    # mark the chunk tilesets, to see which ones are written again
+    for f in chunk_tilesets(output):
+        os.utime(os.path.join(output, f), (OLD_MTIME, OLD_MTIME))
+
+    replaced = 'tile_1.laz'
+    removed = 'tile_2.laz'
+    os.remove(os.path.join(folder, replaced))
+    counts[replaced] = synthetic_tile(os.path.join(folder, replaced),
+                                      tile_bounds(1), DENSITY / 2, seed=10)
+    os.remove(os.path.join(folder, removed))
+    del counts[removed]
+
+    stats = pnts_tiler.tile_las(folder, output, 'EPSG:28992',
+                                chunk_points=CHUNK_POINTS)
+    assert stats['sources'] == 2
+    assert stats['points'] == counts[replaced]
+    check_tiles(output, sum(counts.values()))
+
+    after = load_state(output)
+    assert replaced in after['sources']
+    assert removed not in after['sources']
+    assert set(after['chunks']) <= set(before['chunks'])
+    affected = (set(before['sources'][replaced]['chunks']) |
+                set(before['sources'][removed]['chunks']) |
+                set(after['sources'][replaced]['chunks']))
+    rebuilt = set(name for name in after['chunks'] if name in affected)
+    assert stats['chunks'] == len(rebuilt) < len(after['chunks'])
+
+    assert chunk_tilesets(output) == set(n + '.json'
+                                         for n in after['chunks'])
+    for name in after['chunks']:
+        mtime = os.path.getmtime(os.path.join(output, name + '.json'))
+        assert (mtime != OLD_MTIME) == (name in rebuilt), name
+
+    # nothing changed, nothing is done
+    stats = pnts_tiler.tile_las(folder, output, 'EPSG:28992',
+                                chunk_points=CHUNK_POINTS)
+    assert stats['sources'] == 0